@@ -0,0 +1,242 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import flight_controller as fc
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is optional; NPZ needs only NumPy
+    pa = None
+
+# -------------------------------------------------------------------------------------------------------
+#                                  SECTION 1: CHUNKED VIDEO READING
+# -------------------------------------------------------------------------------------------------------
+
+# Frames processed (and discarded) before each chunk so per-frame state that carries over, the
+# prefilter's "auto" blob counts, matches a sequential run at the chunk's first frame.
+CHUNK_WARMUP_FRAMES = 1
+
+def video_info(path):
+    """(frame count, fps) of a video file; the count is 0 when the container doesn't say"""
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError(f"Could not open video file: {path}")
+    frame_count = max(0, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    cap.release()
+    return frame_count, fps
+
+def open_at(path, frame_index):
+    """
+    Open a video with its next read() returning frame `frame_index`. Seeks when the backend
+    reports landing exactly on the frame, otherwise grabs forward from the start.
+    """
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError(f"Could not open video file: {path}")
+    if frame_index:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != frame_index:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            for _ in range(frame_index):
+                if not cap.grab():
+                    break
+    return cap
+
+def plan_chunks(frame_count, chunk_frames):
+    """(start, stop) frame ranges; the last one is open-ended, as frame counts can be estimates"""
+    starts = list(range(0, frame_count, chunk_frames)) or [0]
+    return [(start, start + chunk_frames) for start in starts[:-1]] + [(starts[-1], None)]
+
+# -------------------------------------------------------------------------------------------------------
+#                                    SECTION 2: CHUNK WORKERS
+# -------------------------------------------------------------------------------------------------------
+
+def _init_worker(settings):
+    """Workers are spawned, so they start from the module defaults; apply the parent's settings"""
+    # The settings may hold fc.color_ranges and fc.DETECTION_RULES themselves when run in-process
+    color_ranges = dict(settings['color_ranges'])
+    fc.color_ranges.clear()
+    fc.color_ranges.update(color_ranges)
+    fc.DETECTION_RULES[:] = list(settings['detection_rules'])
+    fc.MIN_CONTOUR_AREA = settings['min_contour_area']
+    fc.COARSE_DOWNSCALE = settings['downscale']
+    fc.AVOIDANCE_PLANNER = settings['planner']
+    cv2.setNumThreads(1)  # Parallelism comes from the processes
+
+def analyze_chunk(path, start, stop, fps):
+    """
+    Detection and avoidance for frames [start, stop) of a video, with stateless processing (no
+    tracking, motion gate or load shedding) so results don't depend on where chunks begin.
+    Returns the per-frame and per-detection columns of the chunk.
+    """
+    first = max(0, start - CHUNK_WARMUP_FRAMES)
+    cap = open_at(path, first)
+    processor = fc.FrameProcessor(tracking=False, deadline=0, motion_gate=False)
+    classification_codes = {name: code for code, name in enumerate(fc.rule_table.compiled().classifications)}
+    frames, commands, closest, counts = [], [], [], []
+    det_frames, det_classes, det_centers, det_boxes = [], [], [], []
+    index = first
+    try:
+        while stop is None or index < stop:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            result = processor.process(frame, index, index / fps)
+            if index >= start:
+                frames.append(index)
+                commands.append(fc.COMMAND_CODES[result.command])
+                closest.append(result.closest_obstacle or (-1, -1))
+                counts.append(len(result.detections))
+                for detection in result.detections:
+                    det_frames.append(index)
+                    det_classes.append(classification_codes[detection.classification])
+                    det_centers.append(detection.center)
+                    det_boxes.append(cv2.boundingRect(detection.contour))
+            index += 1
+    finally:
+        cap.release()
+    return {
+        'frame': np.array(frames, dtype=np.int32),
+        'command': np.array(commands, dtype=np.uint8),
+        'closest': np.array(closest, dtype=np.int32).reshape(-1, 2),
+        'detection_count': np.array(counts, dtype=np.uint16),
+        'det_frame': np.array(det_frames, dtype=np.int32),
+        'det_classification': np.array(det_classes, dtype=np.uint8),
+        'det_center': np.array(det_centers, dtype=np.int32).reshape(-1, 2),
+        'det_box': np.array(det_boxes, dtype=np.int32).reshape(-1, 4),
+    }
+
+# -------------------------------------------------------------------------------------------------------
+#                                  SECTION 3: MERGING AND OUTPUT
+# -------------------------------------------------------------------------------------------------------
+
+def merge_chunks(chunks, fps):
+    """Concatenate chunk columns (in frame order) and derive the time and command timeline columns"""
+    columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+    columns['time'] = columns['frame'] / fps
+    # Command timeline: one segment per run of identical commands, as [start, end] frames
+    changes = np.flatnonzero(np.diff(columns['command'])) + 1
+    starts = np.concatenate([[0], changes]) if len(columns['frame']) else np.zeros(0, dtype=np.int64)
+    ends = np.concatenate([changes, [len(columns['frame'])]]) - 1 if len(columns['frame']) else starts
+    columns['segment_start'] = columns['frame'][starts]
+    columns['segment_end'] = columns['frame'][ends]
+    columns['segment_command'] = columns['command'][starts]
+    return columns
+
+def write_npz(path, columns, source, fps):
+    np.savez_compressed(path, source=source, fps=fps,
+                        command_names=np.array([fc.COMMAND_NAMES[code] for code in sorted(fc.COMMAND_NAMES)]),
+                        classification_names=np.array(fc.rule_table.compiled().classifications), **columns)
+
+def write_parquet(path, columns, source, fps):
+    """One row per frame; the frame's detections are a list column"""
+    if pa is None:
+        raise RuntimeError("Parquet output needs pyarrow (pip install pyarrow); use --format npz")
+    splits = np.cumsum(columns['detection_count'])[:-1]
+    names = fc.rule_table.compiled().classifications
+    detections = [
+        [{'classification': names[c], 'x': int(x), 'y': int(y),
+          'box_x': int(bx), 'box_y': int(by), 'box_w': int(bw), 'box_h': int(bh)}
+         for c, (x, y), (bx, by, bw, bh) in zip(classes, centers, boxes)]
+        for classes, centers, boxes in zip(np.split(columns['det_classification'], splits),
+                                           np.split(columns['det_center'], splits),
+                                           np.split(columns['det_box'], splits))]
+    table = pa.table({
+        'frame': columns['frame'],
+        'time': columns['time'],
+        'command': [fc.COMMAND_NAMES[code] for code in columns['command'].tolist()],
+        'closest_x': columns['closest'][:, 0],
+        'closest_y': columns['closest'][:, 1],
+        'detections': detections,
+    }).replace_schema_metadata({'source': source, 'fps': str(fps)})
+    pq.write_table(table, path)
+
+def print_summary(label, columns, elapsed):
+    frames = len(columns['frame'])
+    print(f"--- {label} ---")
+    print(f"Frames          : {frames} in {elapsed:.1f} s ({frames / elapsed if elapsed else 0.0:.1f} FPS)")
+    print(f"Command changes : {len(columns['segment_start']) - 1 if frames else 0}")
+    for code, count in zip(*np.unique(columns['command'], return_counts=True)):
+        print(f"  {fc.COMMAND_NAMES[code]:<16}: {count / frames:.1%} of frames")
+    names = fc.rule_table.compiled().classifications
+    for code, count in zip(*np.unique(columns['det_classification'], return_counts=True)):
+        print(f"  {names[code]:<18}: {count} detections")
+
+# -------------------------------------------------------------------------------------------------------
+#                                    SECTION 4: COMMAND LINE
+# -------------------------------------------------------------------------------------------------------
+
+def analyze_videos(paths, workers, chunk_frames, settings):
+    """
+    Analyze every video, with all their chunks spread over one process pool.
+    Yields (path, columns, fps, elapsed) per video, in order.
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(settings,)) as executor:
+        started = time.perf_counter()
+        jobs = []
+        for path in paths:
+            frame_count, fps = video_info(path)
+            futures = [executor.submit(analyze_chunk, path, start, stop, fps)
+                       for start, stop in plan_chunks(frame_count, chunk_frames)]
+            jobs.append((path, fps, futures))
+        for path, fps, futures in jobs:
+            columns = merge_chunks([future.result() for future in futures], fps)
+            yield path, columns, fps, time.perf_counter() - started
+
+def analyze_sequentially(path, settings):
+    """The reference: one chunk covering the whole video, in this process"""
+    _init_worker(settings)
+    _, fps = video_info(path)
+    return merge_chunks([analyze_chunk(path, 0, None, fps)], fps)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Command timelines and detection statistics for recorded flight videos, "
+                    "processed in chunks across a process pool")
+    parser.add_argument('paths', nargs='+', help="Video files")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes (default: all cores)")
+    parser.add_argument('--chunk-frames', type=int, default=300, help="Frames per chunk (default: %(default)s)")
+    parser.add_argument('--format', choices=('npz', 'parquet'), default='npz')
+    parser.add_argument('--output-dir', default='.', help="Where to write <video name>.npz/.parquet")
+    parser.add_argument('--min-area', type=float, default=fc.MIN_CONTOUR_AREA)
+    parser.add_argument('--downscale', type=int, default=fc.COARSE_DOWNSCALE)
+    parser.add_argument('--planner', choices=('grid', 'closest'), default=fc.AVOIDANCE_PLANNER)
+    parser.add_argument('--verify', action='store_true',
+                        help="Also run each video sequentially and check the chunked results are identical")
+    args = parser.parse_args(argv)
+    if args.format == 'parquet' and pa is None:
+        parser.error("--format parquet needs pyarrow (pip install pyarrow)")
+
+    settings = {'color_ranges': fc.color_ranges, 'detection_rules': fc.DETECTION_RULES,
+                'min_contour_area': args.min_area, 'downscale': args.downscale, 'planner': args.planner}
+    writer = write_parquet if args.format == 'parquet' else write_npz
+    os.makedirs(args.output_dir, exist_ok=True)
+    failed = False
+    for path, columns, fps, elapsed in analyze_videos(args.paths, args.workers, args.chunk_frames, settings):
+        output = os.path.join(args.output_dir, os.path.splitext(os.path.basename(path))[0] + '.' + args.format)
+        writer(output, columns, path, fps)
+        print_summary(f"{path} ({args.workers} workers)", columns, elapsed)
+        print(f"Written to {output}")
+        if args.verify:
+            reference = analyze_sequentially(path, settings)
+            differing = [name for name in reference if not np.array_equal(reference[name], columns[name])]
+            if differing:
+                print(f"FAIL: chunked results differ from a sequential run in {', '.join(differing)}")
+                failed = True
+            else:
+                print("Chunked results are identical to a sequential run")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,728 @@
+import argparse
+import copy
+import math
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+import flight_controller as fc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# -------------------------------------------------------------------------------------------------------
+#                                   SECTION 1: FRAME SOURCES
+# -------------------------------------------------------------------------------------------------------
+
+def reference_avoidance(triangles, center, planner=None):
+    """
+    The avoidance command a drawn layout calls for, worked out triangle by triangle from the
+    planner's definition (default fc.AVOIDANCE_PLANNER) rather than by fc.compute_avoidance, so
+    the benchmark checks the planner instead of comparing it with itself. `triangles` are the
+    (x, y, area) of the drawn triangles.
+    """
+    if not triangles:
+        return "Clear"
+    center_x, center_y = center
+    if (planner or fc.AVOIDANCE_PLANNER) == "closest":
+        x, y, _ = min(triangles, key=lambda triangle: math.hypot(triangle[0] - center_x, triangle[1] - center_y))
+        dx, dy = x - center_x, y - center_y
+        if abs(dx) > abs(dy):
+            return "Roll Left" if dx > 0 else "Roll Right"
+        return "Pitch Up" if dy > 0 else "Pitch Down"
+
+    # Grid: per cell, the summed weight and weighted unit direction of its triangles
+    cells = {}
+    for x, y, area in triangles:
+        dx, dy = x - center_x, y - center_y
+        nx, ny = dx / center_x, dy / center_y
+        weight = area / (1 + (nx * nx + ny * ny) / fc.AVOIDANCE_DISTANCE_SCALE ** 2)
+        cell = tuple(min(max(int(math.floor((n + 1) * fc.AVOIDANCE_GRID / 2)), 0), fc.AVOIDANCE_GRID - 1)
+                     for n in (nx, ny))
+        length = math.hypot(dx, dy) or 1
+        total, sum_x, sum_y = cells.get(cell, (0.0, 0.0, 0.0))
+        cells[cell] = (total + weight, sum_x + weight * dx / length, sum_y + weight * dy / length)
+    costs = {}
+    for command, (ux, uy) in fc.AVOIDANCE_DIRECTIONS.items():
+        costs[command] = 0.0
+        for total, sum_x, sum_y in cells.values():
+            cosine = (ux * sum_x + uy * sum_y) / (math.hypot(sum_x, sum_y) or 1)
+            costs[command] += total * ((1 + cosine) / 2) ** 2
+    return min(costs, key=costs.get)
+
+class SyntheticFrameSource:
+    """
+    Generates frames with a known layout of red triangles, blue squares and green circles on a
+    gray background, plus optional uniform noise. Implements the same read() interface as
+    LatestFrameReader, and keeps the expected command of every frame in `expected_commands`.
+
+    Expected commands come from reference_avoidance() on the drawn layout. Layouts are drawn so
+    that they are unambiguous: shapes don't overlap, the command doesn't change when a triangle
+    moves by a few pixels or its area by 10% (as detection can measure them), and with the closest
+    planner the closest triangle is neither tied with another one nor close to the diagonal
+    where the avoidance logic switches between rolling and pitching.
+
+    Each layout is kept for `hold` frames (a static scene, with fresh noise every frame), during
+    which the circles drift `drift` pixels per frame to the right, underneath the other shapes.
+    """
+
+    def __init__(self, width=1280, height=720, triangles=2, squares=2, circles=2, noise=0,
+                 frames=200, seed=0, hold=1, drift=0):
+        self.width = width
+        self.height = height
+        self.counts = {'triangle': triangles, 'square': squares, 'circle': circles}
+        self.noise = noise
+        self.frames = frames
+        self.hold = hold
+        self.drift = drift
+        self.rng = np.random.default_rng(seed)
+        self.expected_commands = []
+        self._seq = 0
+        self._placements = None
+
+    def _place_shapes(self):
+        """Pick non-overlapping (shape, x, y, size) placements"""
+        placements = []
+        margin = 10
+        for shape, count in self.counts.items():
+            for _ in range(count):
+                for _attempt in range(100):
+                    size = int(self.rng.integers(30, max(31, min(self.width, self.height) // 8)))
+                    x = int(self.rng.integers(size + margin, self.width - size - margin))
+                    y = int(self.rng.integers(size + margin, self.height - size - margin))
+                    if all(abs(x - px) > size + psize + margin or abs(y - py) > size + psize + margin
+                           for _, px, py, psize in placements):
+                        placements.append((shape, x, y, size))
+                        break
+        return placements
+
+    def _is_unambiguous(self, placements):
+        center = center_x, center_y = self.width // 2, self.height // 2
+        triangles = [(x, y + size // 3, 2 * size * size) for shape, x, y, size in placements if shape == 'triangle']
+        if not triangles:
+            return True
+        if fc.AVOIDANCE_PLANNER == "closest":
+            distances = sorted(math.hypot(x - center_x, y - center_y) for x, y, _ in triangles)
+            if len(distances) > 1 and distances[1] - distances[0] < 20:
+                return False
+            x, y, _ = min(triangles, key=lambda triangle: math.hypot(triangle[0] - center_x, triangle[1] - center_y))
+            if abs(abs(x - center_x) - abs(y - center_y)) <= 20:
+                return False
+        expected = reference_avoidance(triangles, center)
+        for index, (x, y, area) in enumerate(triangles):
+            for moved in ((x - 4, y, area), (x + 4, y, area), (x, y - 4, area), (x, y + 4, area),
+                          (x, y, area * 0.9), (x, y, area * 1.1)):
+                if reference_avoidance(triangles[:index] + [moved] + triangles[index + 1:], center) != expected:
+                    return False
+        return True
+
+    def make_frame(self):
+        """Draw one frame and return (frame, expected_command)"""
+        if self._placements is None or self._seq % self.hold == 0:
+            for _attempt in range(100):
+                placements = self._place_shapes()
+                if self._is_unambiguous(placements):
+                    break
+            # Circles first, so drifting ones pass underneath the other shapes
+            self._placements = sorted(placements, key=lambda placement: placement[0] != 'circle')
+        offset = self.drift * (self._seq % self.hold)
+
+        frame = np.full((self.height, self.width, 3), 128, dtype=np.uint8)
+        triangles = []
+        for shape, x, y, size in self._placements:
+            if shape == 'triangle':
+                points = np.array([[x, y - size], [x - size, y + size], [x + size, y + size]], dtype=np.int32)
+                cv2.fillPoly(frame, [points], (0, 0, 220))
+                triangles.append((x, y + size // 3, 2 * size * size))  # Centroid and area of the triangle
+            elif shape == 'square':
+                cv2.rectangle(frame, (x - size, y - size), (x + size, y + size), (220, 0, 0), -1)
+            else:
+                cv2.circle(frame, (x + offset, y), size, (0, 200, 0), -1)
+
+        if self.noise:
+            noise = self.rng.integers(-self.noise, self.noise + 1, frame.shape, dtype=np.int16)
+            frame = np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+        return frame, reference_avoidance(triangles, (self.width // 2, self.height // 2))
+
+    def read(self, timeout=None):
+        if self._seq >= self.frames:
+            return False, None, self._seq, 0.0
+        frame, command = self.make_frame()
+        self.expected_commands.append(command)
+        self._seq += 1
+        return True, frame, self._seq, time.monotonic()
+
+    def release(self):
+        pass
+
+class VideoFileSource:
+    """Reads every frame of a recorded video file in order (no frame dropping)"""
+
+    def __init__(self, path):
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise IOError(f"Could not open video file: {path}")
+        self.expected_commands = None
+        self._seq = 0
+
+    def read(self, timeout=None):
+        ret, frame = self.cap.read()
+        if not ret:
+            return False, None, self._seq, 0.0
+        self._seq += 1
+        return True, frame, self._seq, time.monotonic()
+
+    def release(self):
+        self.cap.release()
+
+class MjpegStandInServer:
+    """
+    Local stand-in for the IP camera: serves JPEG frames as a multipart MJPEG stream at
+    http://127.0.0.1:<port>/video, paced to `fps` (None: as fast as the client reads), and ends
+    the stream after the last frame. Use it to test and benchmark MjpegFrameReader offline.
+    """
+
+    def __init__(self, jpegs, fps=30, host="127.0.0.1", port=0):
+        self.jpegs = jpegs
+        self.fps = fps
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.url = f"http://{host}:{self.server.server_address[1]}/video"
+        self._thread = None
+
+    def _make_handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+                self.end_headers()
+                interval = 1.0 / stand_in.fps if stand_in.fps else 0.0
+                next_frame = time.monotonic()
+                try:
+                    for jpeg in stand_in.jpegs:
+                        if interval:
+                            time.sleep(max(0.0, next_frame - time.monotonic()))
+                            next_frame += interval
+                        self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\n'
+                                         b'Content-Length: %d\r\n\r\n' % len(jpeg))
+                        self.wfile.write(jpeg)
+                        self.wfile.write(b'\r\n')
+                    self.wfile.write(b'--frame--\r\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def encode_frames(source, quality=90):
+    """Read every frame of a source and JPEG-encode it; returns the list of JPEG bytes"""
+    jpegs = []
+    while True:
+        ret, frame, frame_seq, frame_timestamp = source.read()
+        if not ret:
+            return jpegs
+        jpegs.append(cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes())
+
+# -------------------------------------------------------------------------------------------------------
+#                                  SECTION 2: BENCHMARK RUNNER
+# -------------------------------------------------------------------------------------------------------
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB, or None where it can't be measured"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_benchmark(source, downscale=None, warmup=5, on_result=None, deadline=0, motion_gate=False):
+    """
+    Run detection and avoidance (FrameProcessor.process(), Sections 4-5) over every frame of a source.
+    Returns a dict with fps, latency percentiles (ms), peak memory (MB) and accuracy when the
+    source knows the expected commands, plus the processor's buffer pool size and the growth of
+    peak memory after warmup. `on_result` is called with every FrameResult.
+
+    With a `deadline` (s) the processor's load shedder is active; a frame it skips keeps the
+    previous command, and the level changes are added to the results. With `motion_gate` the
+    processor's MotionGate is active and its summary is added. While fc.metrics is set, every
+    frame also updates it (inside the timed region, to measure the overhead).
+    """
+    processor = fc.FrameProcessor(downscale=downscale, deadline=deadline, motion_gate=motion_gate)
+    shedder = processor.shedder
+    latencies = []
+    commands = []
+    warm_memory = None
+    while True:
+        ret, frame, frame_seq, frame_timestamp = source.read()
+        if not ret:
+            break
+        if not shedder.should_process():
+            commands.append(commands[-1] if commands else "Clear")
+            continue
+        fc.tracer.begin_frame(frame_seq)
+        t0 = time.perf_counter()
+        result = processor.process(frame, frame_seq, frame_timestamp, shedder.resolution_scale, shedder.min_area)
+        if fc.metrics:
+            fc.metrics.frame_processed(result.command, [d.classification for d in result.detections],
+                                       round((time.perf_counter() - t0) * 1e9))
+        t1 = time.perf_counter()
+        fc.tracer.end_frame()
+        shedder.update(t1 - t0, frame_seq)
+        if on_result:
+            on_result(result)
+        commands.append(result.command)
+        if frame_seq <= warmup:
+            warm_memory = peak_memory_mb()
+            continue
+        latencies.append(t1 - t0)
+    source.release()
+    results = summarize(latencies, sum(latencies), commands, source.expected_commands)
+    results['buffer_mb'] = processor.buffers.nbytes / (1024 * 1024)
+    results['buffer_allocations'] = processor.buffers.allocations
+    if deadline:
+        results['shedding_decisions'] = shedder.decisions
+        results['frames_shed'] = shedder.frames_skipped
+    if processor.motion_gate:
+        results['motion_gate'] = processor.motion_gate.summary()
+    if warm_memory is not None and results['peak_memory_mb'] is not None:
+        results['memory_growth_mb'] = results['peak_memory_mb'] - warm_memory
+    return results
+
+def run_pipeline_benchmark(source, workers, downscale=None, expected_commands=None, warmup=5):
+    """
+    Run the multi-process FramePipeline over a source (a path, or a picklable frame source such as
+    SyntheticFrameSource). No frames are dropped. Latency is measured from capture to the
+    re-ordered result, and throughput is frames per wall-clock second.
+    """
+    pipeline = fc.FramePipeline(source, workers=workers, downscale=downscale, drop_frames=False)
+    if not pipeline.open():
+        raise IOError(f"Could not open source: {source}")
+    latencies = []
+    commands = []
+    started = None
+    try:
+        for result in pipeline.results():
+            now = time.monotonic()
+            height, width = result.frame_shape[:2]
+            dangerous = [(center, area) for classification, center, area in result.detections
+                         if fc.is_dangerous(classification)]
+            # The (N, 2) array form of compute_avoidance's input; the other loops pass lists
+            command, _ = fc.compute_avoidance(np.array([center for center, area in dangerous]).reshape(-1, 2),
+                                              (width // 2, height // 2), [area for center, area in dangerous])
+            commands.append(command)
+            if result.seq == warmup:
+                started = now
+            elif result.seq > warmup:
+                latencies.append(now - result.timestamp)
+        finished = time.monotonic()
+    finally:
+        pipeline.release()
+    elapsed = finished - started if started is not None else 0.0
+    return summarize(latencies, elapsed, commands, expected_commands)
+
+def run_multi_camera_benchmark(sources, downscale=None, warmup=5):
+    """
+    Run every source as one camera of a MultiCameraRunner (a process per camera) and fuse their
+    results. Returns a list of (camera name, results) plus a combined 'all cameras' entry; latency
+    is measured from capture to fusion. Each camera's commands come from its own obstacles and
+    are checked against the source's expected commands.
+    """
+    expected = {}
+    for index, source in enumerate(sources):
+        # Replay each (seeded) source locally to learn its expected commands
+        replica = copy.deepcopy(source)
+        while replica.read()[0]:
+            pass
+        expected[f"camera{index + 1}"] = replica.expected_commands
+    cameras = [{'name': f"camera{index + 1}", 'source': source} for index, source in enumerate(sources)]
+    runner = fc.MultiCameraRunner(cameras, downscale=downscale)
+    fusion = fc.CommandFusion(cameras)
+    if not runner.open():
+        raise IOError("Could not open the cameras")
+    arrivals = {name: [] for name in expected}
+    latencies = {name: [] for name in expected}
+    commands = {name: {} for name in expected}
+    try:
+        for result in runner.results():
+            now = time.monotonic()
+            fusion.update(result)
+            height, width = result.frame_shape[:2]
+            commands[result.camera][result.seq] = fc.compute_avoidance(result.dangerous_obstacles,
+                                                                       (width // 2, height // 2),
+                                                                       result.dangerous_areas)[0]
+            if result.seq > warmup:
+                arrivals[result.camera].append(now)
+                latencies[result.camera].append(now - result.timestamp)
+    finally:
+        runner.release()
+
+    runs = []
+    for name in expected:
+        elapsed = arrivals[name][-1] - arrivals[name][0] if len(arrivals[name]) > 1 else 0.0
+        camera_commands = [commands[name][seq] for seq in sorted(commands[name])]
+        runs.append((name, summarize(latencies[name][1:], elapsed, camera_commands, expected[name])))
+    all_arrivals = sorted(now for times in arrivals.values() for now in times)
+    all_latencies = [latency for name in expected for latency in latencies[name][1:]]
+    elapsed = all_arrivals[-1] - all_arrivals[0] if len(all_arrivals) > 1 else 0.0
+    runs.append(("all cameras", summarize(all_latencies, elapsed, [], None)))
+    return runs
+
+def run_udp_benchmark(source, downscale=None, warmup=5):
+    """
+    run_benchmark() with the UDP command output enabled: decisions go through a StateBus to a
+    CommandSender aimed at a loopback CommandReceiver. Adds packet counts and the capture-to-packet
+    latency percentiles (ms) to the results.
+    """
+    receiver = fc.CommandReceiver().start()
+    sender = fc.CommandSender(receiver.address)
+    bus = fc.StateBus()
+    bus.subscribe(sender)
+
+    def publish(result):
+        bus.publish(result.seq, result.timestamp, result.command, result.closest_obstacle, result.frame_center)
+
+    try:
+        results = run_benchmark(source, downscale, warmup, on_result=publish)
+        time.sleep(0.2)  # Let the last packets arrive
+    finally:
+        receiver.stop()
+        sender.close()
+    latencies_ms = np.array(receiver.latencies) * 1000.0
+    results['packets_sent'] = sender.packets_sent
+    results['packets_received'] = len(receiver.packets)
+    results['packets_deduplicated'] = sender.packets_deduplicated
+    results['packets_rate_limited'] = sender.packets_rate_limited
+    for percentile in (50, 95, 99):
+        results[f'udp_p{percentile}_ms'] = float(np.percentile(latencies_ms, percentile)) if len(latencies_ms) else 0.0
+    return results
+
+def run_mjpeg_benchmark(make_source, scale, fps=30, downscale=None, warmup=5):
+    """
+    Serve a source's frames from a local MjpegStandInServer and run detection on them through
+    MjpegFrameReader decoding at 1/`scale`, with MIN_CONTOUR_AREA scaled to match. Adds the mean
+    decode time (ms) and the frames dropped before decoding to the results. Command accuracy is
+    only reported when no frame was dropped, since frame numbers no longer line up otherwise.
+    """
+    source = make_source()
+    server = MjpegStandInServer(encode_frames(source), fps=fps).start()
+    reader = fc.MjpegFrameReader(server.url, scale=scale)
+    min_contour_area = fc.MIN_CONTOUR_AREA
+    fc.MIN_CONTOUR_AREA = min_contour_area / scale ** 2
+    try:
+        if not reader.open():
+            raise IOError(f"Could not open MJPEG stream: {server.url}")
+        reader.expected_commands = source.expected_commands
+        results = run_benchmark(reader, downscale, warmup)
+    finally:
+        fc.MIN_CONTOUR_AREA = min_contour_area
+        server.stop()
+    decoded = reader.frames_captured - reader.frames_dropped - reader.frames_corrupt
+    results['decode_ms'] = reader.decode_seconds / decoded * 1000.0 if decoded else 0.0
+    results['frames_dropped'] = reader.frames_dropped
+    if reader.frames_dropped:
+        results['accuracy'] = None
+        results['mismatches'] = []
+    return results
+
+def run_gui_benchmark(make_source, downscale=None, interval=0.05):
+    """
+    Measure what the Animation mode GUI costs the detection thread. Detection runs on a thread,
+    as in video_processing_thread(), while this thread ticks the airplane every `interval`
+    seconds like the GUI timer: not at all (Performance mode), with the legacy full-figure
+    redraw, and with the blitted renderer. Drawing goes to an offscreen Agg canvas.
+    Yields (renderer, results) with the mean GUI tick time (ms) added to each results dict.
+    """
+    plt = fc.import_animation_modules()
+    plt.switch_backend('Agg')
+
+    def publish(result):
+        fc.state_bus.publish(result.seq, result.timestamp, result.command, result.closest_obstacle,
+                             result.frame_center)
+
+    for renderer in ('none', 'legacy', 'blitted'):
+        gui = fc.AirplaneGUI(blit=(renderer == 'blitted')) if renderer != 'none' else None
+        if gui:
+            gui.fig.canvas.draw()
+        source = make_source()
+        results = {}
+        thread = threading.Thread(target=lambda: results.update(run_benchmark(source, downscale, on_result=publish)))
+        thread.start()
+        tick_times = []
+        while thread.is_alive():
+            started = time.perf_counter()
+            if renderer == 'legacy':
+                # What FuncAnimation(blit=False) did: redraw the whole figure on every tick
+                gui.update_airplane(None)
+                gui.fig.canvas.draw()
+            elif renderer == 'blitted':
+                gui.tick()
+            tick_times.append(time.perf_counter() - started)
+            thread.join(max(0.0, interval - tick_times[-1]))
+        if gui:
+            plt.close(gui.fig)
+        results['gui_tick_ms'] = float(np.mean(tick_times)) * 1000.0 if gui else 0.0
+        yield renderer, results
+
+def run_frame_check(source, check):
+    """
+    Run an equivalence check such as fc.verify_coarse_to_fine() or fc.verify_prefilter() (given
+    as a function of the frames) over every frame of a source, one frame in memory at a time.
+    Returns (frames checked, mismatches); frame indices in the mismatches start at 1 (None for
+    a frame the check made up itself).
+    """
+    frames = 0
+
+    def read_frames():
+        nonlocal frames
+        while True:
+            ret, frame, _, _ = source.read()
+            if not ret:
+                return
+            frames += 1
+            yield frame
+
+    try:
+        mismatches = check(read_frames())
+    finally:
+        source.release()
+    return frames, [(None if index is None else index + 1, full, coarse) for index, full, coarse in mismatches]
+
+def summarize(latencies, elapsed, commands, expected_commands):
+    """Build the results dict from per-frame latencies (s) and the time they took in total (s)"""
+    latencies_ms = np.array(latencies) * 1000.0
+    results = {
+        'frames': len(latencies),
+        'fps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': float(np.percentile(latencies_ms, 50)) if len(latencies) else 0.0,
+        'p95_ms': float(np.percentile(latencies_ms, 95)) if len(latencies) else 0.0,
+        'p99_ms': float(np.percentile(latencies_ms, 99)) if len(latencies) else 0.0,
+        'peak_memory_mb': peak_memory_mb(),
+        'accuracy': None,
+        'mismatches': [],
+    }
+    if expected_commands is not None and commands:
+        mismatches = [(index + 1, expected, actual)
+                      for index, (expected, actual) in enumerate(zip(expected_commands, commands))
+                      if expected != actual]
+        results['accuracy'] = 1.0 - len(mismatches) / len(commands)
+        results['mismatches'] = mismatches
+    return results
+
+def print_results(label, results):
+    print(f"--- {label} ---")
+    print(f"Frames measured : {results['frames']}")
+    print(f"Throughput      : {results['fps']:.1f} FPS")
+    print(f"Latency p50/p95/p99 : {results['p50_ms']:.2f} / {results['p95_ms']:.2f} / {results['p99_ms']:.2f} ms")
+    if results['peak_memory_mb'] is not None:
+        print(f"Peak memory (RSS)   : {results['peak_memory_mb']:.1f} MB")
+    if results.get('memory_growth_mb') is not None:
+        print(f"Growth after warmup : {results['memory_growth_mb']:.1f} MB")
+    if 'shedding_decisions' in results:
+        print(f"Load shedding       : {len(results['shedding_decisions'])} level changes, "
+              f"{results['frames_shed']} frames skipped")
+    if 'motion_gate' in results:
+        print(f"Motion gate         : {results['motion_gate']}")
+    if 'decode_ms' in results:
+        print(f"JPEG decode (mean)  : {results['decode_ms']:.2f} ms, {results['frames_dropped']} frames dropped undecoded")
+    if 'packets_sent' in results:
+        print(f"UDP packets sent/received : {results['packets_sent']} / {results['packets_received']} "
+              f"({results['packets_deduplicated']} deduplicated, {results['packets_rate_limited']} rate-limited)")
+        print(f"Capture-to-packet p50/p95/p99 : {results['udp_p50_ms']:.2f} / {results['udp_p95_ms']:.2f} / "
+              f"{results['udp_p99_ms']:.2f} ms")
+    if results.get('gui_tick_ms'):
+        print(f"GUI tick (mean)     : {results['gui_tick_ms']:.2f} ms")
+    if 'buffer_mb' in results:
+        print(f"Frame buffers       : {results['buffer_mb']:.1f} MB in {results['buffer_allocations']} allocations")
+    if results['accuracy'] is not None:
+        print(f"Command accuracy    : {results['accuracy'] * 100:.1f}%")
+        for frame_seq, expected, actual in results['mismatches'][:10]:
+            print(f"  frame {frame_seq}: expected '{expected}', got '{actual}'")
+
+# -------------------------------------------------------------------------------------------------------
+#                                  SECTION 3: COMMAND LINE
+# -------------------------------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the obstacle detector")
+    subparsers = parser.add_subparsers(dest='source', required=True)
+
+    synthetic = subparsers.add_parser('synthetic', help="Synthetic frames with a known layout")
+    synthetic.add_argument('--width', type=int, default=1280)
+    synthetic.add_argument('--height', type=int, default=720)
+    synthetic.add_argument('--triangles', type=int, default=2, help="Red triangles per frame")
+    synthetic.add_argument('--squares', type=int, default=2, help="Blue squares per frame")
+    synthetic.add_argument('--circles', type=int, default=2, help="Green circles per frame")
+    synthetic.add_argument('--noise', type=int, default=0, help="Uniform noise amplitude (0-255)")
+    synthetic.add_argument('--frames', type=int, default=200)
+    synthetic.add_argument('--seed', type=int, default=0)
+    synthetic.add_argument('--hold', type=int, default=1, help="Frames each layout is kept for (static scenes)")
+    synthetic.add_argument('--drift', type=int, default=0, help="Pixels per frame circles move during a hold")
+
+    synthetic.add_argument('--mjpeg', type=int, metavar='SCALE', choices=sorted(fc.MJPEG_DECODE_FLAGS),
+                           help="Serve the frames as MJPEG from a local stand-in server and read them with "
+                                "the built-in client, decoding at 1/SCALE resolution")
+    synthetic.add_argument('--cameras', type=int, default=0,
+                           help="Process this many synthetic cameras (different seeds) concurrently, one process each")
+    synthetic.add_argument('--mjpeg-fps', type=float, default=30,
+                           help="Frame rate of the stand-in MJPEG server (0: as fast as the client reads)")
+
+    video = subparsers.add_parser('video', help="Recorded video files")
+    video.add_argument('paths', nargs='+')
+
+    for sub in (synthetic, video):
+        sub.add_argument('--downscale', type=int, default=None,
+                         help="Coarse-to-fine downscale factor (default: COARSE_DOWNSCALE)")
+        sub.add_argument('--min-accuracy', type=float, default=None,
+                         help="Fail if command accuracy (0-1) on synthetic frames is below this")
+        sub.add_argument('--max-p95-ms', type=float, default=None,
+                         help="Fail if the p95 per-frame latency exceeds this many milliseconds")
+        sub.add_argument('--workers', type=int, default=0,
+                         help="Run on the multi-process pipeline with this many detection workers")
+        sub.add_argument('--gui', action='store_true',
+                         help="Compare detection throughput with no GUI, the legacy airplane redraw "
+                              "and the blitted airplane renderer")
+        sub.add_argument('--deadline-ms', type=float, default=None,
+                         help="Enable load shedding with this per-frame deadline")
+        sub.add_argument('--motion-gate', action='store_true',
+                         help="Reuse results on static scenes and re-detect only changed tiles")
+        sub.add_argument('--threads', type=int, default=0,
+                         help="Detect each frame in strips on this many threads (with --downscale 1)")
+        sub.add_argument('--udp', action='store_true',
+                         help="Send commands over UDP to a loopback receiver and report capture-to-packet latency")
+        sub.add_argument('--metrics', action='store_true',
+                         help="Update live metrics every frame, serve them on a free localhost port and "
+                              "scrape the endpoint once at the end")
+        sub.add_argument('--planner', choices=('grid', 'closest'), default=fc.AVOIDANCE_PLANNER,
+                         help="Avoidance planner the commands are made and checked with (default: %(default)s)")
+        sub.add_argument('--verify-downscale', type=int, metavar='FACTOR', default=None,
+                         help="Also check that coarse-to-fine detection at FACTOR finds the same objects as "
+                              "full-resolution detection on every frame, and fail if not")
+        sub.add_argument('--verify-prefilter', action='store_true',
+                         help="Also check that the component prefilter finds the same objects as the contour "
+                              "path on every frame, and fail if not")
+        sub.add_argument('--trace', metavar='PREFIX', default=None,
+                         help="Record per-stage timings to PREFIX.json (Chrome trace) and PREFIX.csv")
+
+    args = parser.parse_args(argv)
+    if args.trace:
+        fc.tracer.enabled = True
+    if args.threads:
+        fc.DETECTION_THREADS = args.threads
+    fc.AVOIDANCE_PLANNER = args.planner
+    metrics_server = None
+    if args.metrics:
+        fc.metrics = fc.tracer.metrics = fc.FlightMetrics()
+        metrics_server = fc.start_metrics_server(fc.metrics, 0)
+
+    if args.source == 'synthetic':
+        def make_source():
+            return SyntheticFrameSource(args.width, args.height, args.triangles, args.squares,
+                                        args.circles, args.noise, args.frames, args.seed, args.hold, args.drift)
+        sources = [(f"synthetic {args.width}x{args.height}", make_source)]
+    else:
+        sources = [(path, path) for path in args.paths]
+
+    runs = []
+    for label, source in sources:
+        if args.threads > 1:
+            label += f" ({args.threads} detection threads)"
+        if args.gui:
+            make_source = source if callable(source) else (lambda path=source: VideoFileSource(path))
+            for renderer, results in run_gui_benchmark(make_source, args.downscale):
+                runs.append((f"{label} (GUI: {renderer})", results))
+            continue
+        if getattr(args, 'cameras', 0):
+            cameras = [SyntheticFrameSource(args.width, args.height, args.triangles, args.squares, args.circles,
+                                            args.noise, args.frames, args.seed + index)
+                       for index in range(args.cameras)]
+            for name, results in run_multi_camera_benchmark(cameras, args.downscale):
+                runs.append((f"{label} ({args.cameras} cameras: {name})", results))
+            continue
+        if getattr(args, 'mjpeg', None):
+            results = run_mjpeg_benchmark(source, args.mjpeg, args.mjpeg_fps or None, args.downscale)
+            runs.append((f"{label} (MJPEG, decoded at 1/{args.mjpeg})", results))
+            continue
+        if args.workers:
+            label += f" ({args.workers} pipeline workers)"
+            expected_commands = None
+            if callable(source):
+                # Replay the same seed locally to learn the expected commands of every frame
+                replica = source()
+                while replica.read()[0]:
+                    pass
+                expected_commands = replica.expected_commands
+                source = source()
+            results = run_pipeline_benchmark(source, args.workers, args.downscale, expected_commands)
+        else:
+            source = source() if callable(source) else VideoFileSource(source)
+            if args.udp:
+                results = run_udp_benchmark(source, downscale=args.downscale)
+            else:
+                results = run_benchmark(source, downscale=args.downscale,
+                                        deadline=args.deadline_ms / 1000.0 if args.deadline_ms else 0,
+                                        motion_gate=args.motion_gate)
+        runs.append((label, results))
+
+    failed = False
+    for label, results in runs:
+        print_results(label, results)
+        if args.min_accuracy is not None and results['accuracy'] is not None \
+                and results['accuracy'] < args.min_accuracy:
+            print(f"FAIL: accuracy below {args.min_accuracy}")
+            failed = True
+        if args.max_p95_ms is not None and results['p95_ms'] > args.max_p95_ms:
+            print(f"FAIL: p95 latency above {args.max_p95_ms} ms")
+            failed = True
+    checks = []
+    if args.verify_downscale:
+        checks.append((f"Coarse-to-fine check (downscale {args.verify_downscale})", "full resolution", "coarse",
+                       lambda frames: fc.verify_coarse_to_fine(frames, args.verify_downscale)))
+    if args.verify_prefilter:
+        checks.append(("Prefilter check", "the contour path", "prefilter", fc.verify_prefilter))
+    for name, reference, variant, check in checks:
+        for label, source in sources:
+            source = source() if callable(source) else VideoFileSource(source)
+            frames, mismatches = run_frame_check(source, check)
+            print(f"{name} ({label}): {frames} frames, {len(mismatches)} differ from {reference}")
+            for index, expected, actual in mismatches[:5]:
+                print(f"  {'built-in frame' if index is None else f'frame {index}'}: "
+                      f"{reference} {expected}, {variant} {actual}")
+            if mismatches:
+                print(f"FAIL: {variant} detection differs from {reference}")
+                failed = True
+    if metrics_server:
+        url = f"http://{fc.METRICS_HOST}:{metrics_server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            exposition = response.read().decode()
+        samples = [line for line in exposition.splitlines() if line and not line.startswith('#')]
+        print(f"Metrics endpoint    : {len(samples)} samples from {url}")
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    if args.trace:
+        fc.tracer.write_chrome_trace(args.trace + ".json")
+        fc.tracer.write_csv(args.trace + ".csv")
+        print(f"Stage trace written to {args.trace}.json and {args.trace}.csv")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
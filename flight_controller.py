@@ -1,225 +1,3334 @@
+import time
+_import_started = time.perf_counter()  # Start of the import-to-first-command time reported by main()
+
 import cv2
 import numpy as np
+import bisect
+import csv
+import heapq
+import itertools
+import json
 import math
+import multiprocessing
+import os
+import queue
+import socket
+import struct
 import sys
+import threading
+import urllib.request
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+# -------------------------------------------------------------------------------------------------------
+#                                           SECTION 1: SETUP
+# -------------------------------------------------------------------------------------------------------
+
+# Using your saved port for the video stream. Overridden by the `source` command-line argument.
+video_url = "http://192.168.0.155:8080/video"
+
+# CHOOSE EXECUTION MODE (or pass --mode):
+    # "animation"   - GUI animation + video processing
+    # "performance" - video processing only (better performance)
+    # "headless"    - detection and commands only, no windows at all (highest frame rate)
+EXECUTION_MODE = "animation"
+
+# Define the lower and upper bounds for each color in the HSV color space.
+color_ranges = {
+    'red': {
+        'lower1': np.array([0, 120, 70]),
+        'upper1': np.array([10, 255, 255]),
+        'lower2': np.array([170, 120, 70]),
+        'upper2': np.array([180, 255, 255])
+    },
+    'green': {
+        'lower': np.array([36, 100, 100]),
+        'upper': np.array([86, 255, 255])
+    },
+    'blue': {
+        'lower': np.array([94, 120, 100]),
+        'upper': np.array([126, 255, 255])
+    }
+}
+
+# MJPEG client: HTTP MJPEG streams are read by a built-in multipart client that keeps only the
+# newest JPEG and decodes it at 1/MJPEG_DECODE_SCALE resolution (1, 2, 4 or 8). MIN_CONTOUR_AREA is
+# scaled to match. Set USE_MJPEG_CLIENT = False to read the stream with cv2.VideoCapture instead.
+USE_MJPEG_CLIENT = True
+MJPEG_DECODE_SCALE = 2
+
+# Multi-camera: with more than one camera listed, every camera is captured and processed in its own
+# process and a fusion stage merges their dangerous obstacles into one command (headless output).
+# Each camera's view is placed in a shared avoidance frame by its in-plane mounting `rotation`
+# (degrees) and the `offset` of its view center in half frame widths; (0, 1) puts a downward
+# camera's view just below the forward one, so obstacles it sees call for a pitch up.
+CAMERAS = []   # e.g. [{'name': 'forward', 'source': video_url},
+               #       {'name': 'down', 'source': "http://192.168.0.156:8080/video", 'offset': (0, 1)}]
+
+# Minimum contour area (in full-resolution pixels) for an object to be classified.
+MIN_CONTOUR_AREA = 400
+
+# Detection rules: the (color, shape) pairs that mean something, with the classification they
+# get, the BGR color they are drawn in and their avoidance role ("avoid": steered away from,
+# "boundary" and "safe": shown only). Each color only runs the shape tests (SHAPE_TESTS) of its
+# own rules. A new class is one more rule, plus a color_ranges entry if its color is new, e.g. a
+# yellow no-fly marker (not enabled):
+#   DetectionRule('yellow', 'pentagon', "No-fly marker", (0, 255, 255), 'avoid'),
+#   color_ranges['yellow'] = {'lower': np.array([20, 100, 100]), 'upper': np.array([34, 255, 255])}
+DetectionRule = namedtuple('DetectionRule', ['color', 'shape', 'classification', 'draw_color', 'role'])
+DETECTION_RULES = [
+    DetectionRule('red', 'triangle', "Dangerous obstacle", (0, 0, 255), 'avoid'),
+    DetectionRule('blue', 'square', "Boundary marker", (255, 0, 0), 'boundary'),
+    DetectionRule('green', 'circle', "Safe zone", (0, 255, 0), 'safe'),
+]
+
+# Avoidance planner: "grid" rasterizes every dangerous obstacle, weighted by its area and its
+# closeness to the frame center, into a 4x4 occupancy grid aligned with the quadrant lines and
+# steers toward the cheapest of eight escape directions, diagonals included. "closest" is the
+# original rule (one of four commands, away from the closest obstacle), for flight controllers
+# that only know command codes 0-4.
+AVOIDANCE_PLANNER = "grid"
+AVOIDANCE_DISTANCE_SCALE = 0.5   # Distance from the center, in half frame sizes, at which an obstacle's weight halves
+
+# Connected-component prefilter: mask components whose bounding box is too small to ever hold
+# MIN_CONTOUR_AREA are dropped in one NumPy batch, and only the survivors get contour extraction
+# and detect_shape, with the same results as the contour path. Labelling costs a full pass over
+# the mask, which only pays off in cluttered scenes, so "auto" switches it on per color once a
+# full-frame mask holds more than PREFILTER_AUTO_BLOBS blobs (and off again when the scene
+# clears). True/False force it.
+USE_COMPONENT_PREFILTER = "auto"
+PREFILTER_AUTO_BLOBS = 2000
+
+# Obstacle tracking: follow objects between frames and search only small windows around their
+# predicted positions, with a full-frame search every TRACKER_FULL_SEARCH_INTERVAL frames or
+# whenever a track is lost. Commands then use hysteresis on the closest obstacle's track.
+ENABLE_TRACKING = False
+TRACKER_FULL_SEARCH_INTERVAL = 10
+
+# Motion gating: a small copy of each frame is compared, tile by tile, with the one
+# detection last ran on. Static scenes reuse the previous detections and command, and when only a
+# few tiles changed only those are re-detected. A full detection still runs at least every
+# MOTION_MAX_STALE_FRAMES frames, or when more than MOTION_FULL_FRACTION of the tiles changed.
+ENABLE_MOTION_GATE = False
+MOTION_GRID = (16, 9)          # Tiles across and down
+MOTION_PIXEL_THRESHOLD = 20    # Change (0-255, any channel) of a downsampled pixel that marks its tile as changed
+MOTION_MAX_STALE_FRAMES = 15
+MOTION_FULL_FRACTION = 0.25
+
+# Multi-process pipeline: number of detection worker processes used in headless mode.
+# 0 keeps detection on a single thread; frames reach the workers through shared-memory slots.
+PIPELINE_WORKERS = 0
+
+# Per-stage tracing: when enabled, stage timings are kept in a ring buffer and written to
+# <TRACE_OUTPUT>.json (Chrome/Perfetto trace) and <TRACE_OUTPUT>.csv on exit.
+TRACE_STAGES = False
+TRACE_OUTPUT = "flight_trace"
+
+# Live metrics: with a port, Prometheus text-format metrics (frame rates, latency histograms,
+# dropped and skipped frames, detections per class, command changes) are served at
+# http://METRICS_HOST:METRICS_PORT/metrics from a background thread. None disables it.
+METRICS_PORT = None
+METRICS_HOST = "127.0.0.1"
+
+# UDP command output: every command decision is sent to the flight controller at this
+# (host, port) as a fixed-size binary packet. None disables it. Unchanged commands are only
+# repeated as keepalives every UDP_KEEPALIVE_INTERVAL seconds, at most UDP_MAX_RATE_HZ per second.
+UDP_COMMAND_TARGET = None     # e.g. ("192.168.0.20", 14650)
+UDP_MAX_RATE_HZ = 50
+UDP_KEEPALIVE_INTERVAL = 0.5
+
+# Load shedding: per-frame processing deadline (seconds) of the processing loops. While frames
+# overrun it the controller degrades step by step (no overlay, half resolution, every other frame,
+# larger minimum area) and recovers as load drops. None or 0 disables it.
+FRAME_DEADLINE = 0.033
+
+# Animation mode frame pacing: the video thread is paced to this rate, sleeping only for what is
+# left of each frame's budget after processing. None runs it at maximum throughput.
+ANIMATION_TARGET_FPS = 30
+
+# Tiled detection: HSV conversion, masking and contour extraction of each frame run on this many
+# threads, one horizontal strip each (OpenCV releases the GIL), for lower single-frame latency.
+# Contour searches reach TILE_OVERLAP rows into the neighbouring strips; objects crossing further
+# are merged across the border. 0 or 1 keeps detection on one thread.
+DETECTION_THREADS = 0
+TILE_OVERLAP = 32
+
+# Coarse-to-fine detection: candidate blobs are found on a copy of the frame downscaled by this
+# factor and only their full-resolution regions are refined. Set to 1 to process the full frame.
+COARSE_DOWNSCALE = 1
+
+# -------------------------------------------------------------------------------------------------------
+#                           SECTION 1B: LOOKUP-TABLE COLOR CLASSIFIER
+# -------------------------------------------------------------------------------------------------------
+
+class ColorClassifier:
+    """
+    Classifies every pixel of an HSV image against `color_ranges` in a single pass.
+    The ranges are compiled into one lookup table per channel (one bit per HSV range);
+    ANDing the three lookups and mapping the bits through a last table gives a label
+    image with one bit per color. Per-color masks are one lookup on that image and match
+    `cv2.inRange` exactly. The tables are rebuilt whenever the ranges change.
+    """
+
+    def __init__(self, ranges=None):
+        self.ranges = color_ranges if ranges is None else ranges
+        self.color_bits = {}          # color name -> bit in the label image
+        self._ranges_key = None
+        self._channel_luts = None
+        self._band_to_label = None
+        self._mask_luts = {}
+
+    def _current_key(self):
+        """Cheap fingerprint of the ranges, used to notice edits (including in-place ones)"""
+        return tuple((color_name, key, np.asarray(bound).tobytes())
+                     for color_name, ranges in self.ranges.items()
+                     for key, bound in sorted(ranges.items()))
+
+    def _compile(self):
+        """Build the per-channel band tables, the band-to-label table and the mask tables"""
+        bands = []  # (color_bit, lower, upper)
+        color_bits = {}
+        for color_name, ranges in self.ranges.items():
+            if len(color_bits) == 8:
+                raise ValueError("ColorClassifier supports at most 8 colors")
+            color_bits[color_name] = 1 << len(color_bits)
+            for key in sorted(ranges):
+                if key.startswith('lower'):
+                    suffix = key[len('lower'):]
+                    bands.append((color_bits[color_name], ranges[key], ranges['upper' + suffix]))
+        if len(bands) > 8:
+            raise ValueError("ColorClassifier supports at most 8 HSV ranges")
+
+        values = np.arange(256)
+        channel_luts = [np.zeros(256, dtype=np.uint8) for _ in range(3)]
+        band_to_label = np.zeros(256, dtype=np.uint8)
+        for band_index, (color_bit, lower, upper) in enumerate(bands):
+            for channel in range(3):
+                inside = (values >= lower[channel]) & (values <= upper[channel])
+                channel_luts[channel][inside] |= 1 << band_index
+            band_to_label[(values >> band_index) & 1 == 1] |= color_bit
+
+        self.color_bits = color_bits
+        self._channel_luts = channel_luts
+        self._band_to_label = band_to_label
+        self._mask_luts = {color_name: np.where(values & bit, 255, 0).astype(np.uint8)
+                           for color_name, bit in color_bits.items()}
+
+    def _ensure_compiled(self):
+        key = self._current_key()
+        if key != self._ranges_key:
+            self._compile()
+            self._ranges_key = key
+
+    def classify(self, hsv, scratch=None):
+        """
+        Return the label image (one bit per color, 0 for none) of an HSV image.
+        `scratch` may hold three preallocated single-channel arrays of the image size; the
+        channels are split into them and the label image is returned in the first one.
+        """
+        self._ensure_compiled()
+        h, s, v = cv2.split(hsv, scratch) if scratch else cv2.split(hsv)
+        cv2.LUT(h, self._channel_luts[0], dst=h)
+        cv2.LUT(s, self._channel_luts[1], dst=s)
+        cv2.LUT(v, self._channel_luts[2], dst=v)
+        cv2.bitwise_and(h, s, dst=h)
+        cv2.bitwise_and(h, v, dst=h)
+        return cv2.LUT(h, self._band_to_label, dst=h)
+
+    def mask(self, labels, color_name, dst=None):
+        """Return the 0/255 mask of one color from a label image produced by classify()"""
+        return cv2.LUT(labels, self._mask_luts[color_name], dst=dst)
+
+# Shared classifier used by both processing loops.
+color_classifier = ColorClassifier()
+
+# -------------------------------------------------------------------------------------------------------
+#                            SECTION 1C: LATEST-FRAME CAPTURE READER
+# -------------------------------------------------------------------------------------------------------
+
+class LatestFrameReader:
+    """
+    Reads a video capture on a background thread and keeps only the newest frame.
+    Frames that arrive before the previous one was consumed are dropped (and counted), so
+    the processing loops always work on the most recent image and the camera-to-command
+    lag stays bounded no matter how slow detection gets.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.cap = None
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self._cond = threading.Condition()
+        self._frame = None
+        self._seq = 0             # Sequence number of the newest captured frame
+        self._timestamp = 0.0     # time.monotonic() when the newest frame was read
+        self._consumed_seq = 0    # Sequence number of the last frame handed out
+        self._finished = False
+        self._running = False
+        self._thread = None
+
+    def open(self):
+        """Open the capture and start the reader thread. Returns False if the source can't be opened"""
+        self.cap = cv2.VideoCapture(self.source)
+        if not self.cap.isOpened():
+            return False
+        self._running = True
+        self._thread = threading.Thread(target=self._reader_loop, name="capture-reader", daemon=True)
+        self._thread.start()
+        return True
+
+    def _reader_loop(self):
+        while self._running:
+            ret, frame = self.cap.read()
+            timestamp = time.monotonic()
+            with self._cond:
+                if not ret:
+                    self._finished = True
+                    self._cond.notify_all()
+                    break
+                if self._seq > self._consumed_seq:
+                    self.frames_dropped += 1  # The previous frame was never consumed
+                self._frame = frame
+                self._seq += 1
+                self._timestamp = timestamp
+                self.frames_captured += 1
+                self._cond.notify_all()
+
+    @property
+    def finished(self):
+        """True once the stream has ended (or the reader was released)"""
+        return self._finished
+
+    def read(self, timeout=None):
+        """
+        Wait for a frame newer than the last one returned.
+        Returns (ok, frame, seq, timestamp); ok is False once the stream has ended or on timeout.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq > self._consumed_seq or self._finished, timeout)
+            if self._seq == self._consumed_seq:
+                return False, None, self._seq, self._timestamp
+            self._consumed_seq = self._seq
+            return True, self._frame, self._seq, self._timestamp
+
+    def release(self):
+        """Stop the reader thread and release the capture"""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+        if self.cap is not None:
+            self.cap.release()
+        with self._cond:
+            self._finished = True
+            self._cond.notify_all()
+
+class SequentialFrameReader(LatestFrameReader):
+    """
+    LatestFrameReader for recorded video files: the reader thread decodes one frame ahead and
+    then waits until it has been consumed, so every frame is processed in order and none is
+    dropped. Same interface as LatestFrameReader.
+    """
+
+    def _reader_loop(self):
+        while self._running:
+            with self._cond:
+                self._cond.wait_for(lambda: self._seq == self._consumed_seq or not self._running)
+                if not self._running:
+                    break
+            ret, frame = self.cap.read()
+            timestamp = time.monotonic()
+            with self._cond:
+                if not ret:
+                    self._finished = True
+                    self._cond.notify_all()
+                    break
+                self._frame = frame
+                self._seq += 1
+                self._timestamp = timestamp
+                self.frames_captured += 1
+                self._cond.notify_all()
+
+    def read(self, timeout=None):
+        result = super().read(timeout)
+        with self._cond:
+            self._cond.notify_all()  # Let the reader thread decode the next frame
+        return result
+
+    def release(self):
+        """Stop the reader thread and release the capture"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        super().release()
+
+# -------------------------------------------------------------------------------------------------------
+#                                 SECTION 1D: PER-STAGE TRACING
+# -------------------------------------------------------------------------------------------------------
+
+class _NullSpan:
+    """Span returned while tracing is disabled - entering and leaving it does nothing"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ('tracer', 'stage', 'start')
+
+    def __init__(self, tracer, stage):
+        self.tracer = tracer
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.stage, self.start, time.perf_counter_ns() - self.start)
+        return False
+
+class StageTracer:
+    """
+    Lightweight timing hooks for the processing stages (HSV conversion, masking, findContours, ...).
+    Timings go into a fixed-size ring buffer and can be dumped as a Chrome/Perfetto trace JSON file
+    or as CSV. While disabled, span() returns a shared no-op context manager, so the hooks can stay
+    in production code.
+    """
+
+    def __init__(self, capacity=65536, enabled=False):
+        self.enabled = enabled
+        self.capacity = capacity
+        self._stage_ids = {}
+        self._stage_names = []
+        self._stages = np.zeros(capacity, dtype=np.int16)
+        self._frames = np.zeros(capacity, dtype=np.int64)
+        self._threads = np.zeros(capacity, dtype=np.int64)
+        self._starts = np.zeros(capacity, dtype=np.int64)      # perf_counter_ns()
+        self._durations = np.zeros(capacity, dtype=np.int64)   # nanoseconds
+        self._counter = itertools.count()
+        self._recorded = 0
+        self._local = threading.local()
+        self._register_lock = threading.Lock()
+        self.metrics = None  # FlightMetrics fed with every span, even while tracing is disabled
+
+    def span(self, stage):
+        """Context manager timing one stage of the current frame"""
+        if not self.enabled and self.metrics is None:
+            return _NULL_SPAN
+        return _Span(self, stage)
+
+    def begin_frame(self, frame_seq):
+        """Mark the start of a frame; later spans on this thread are attributed to it"""
+        if self.enabled:
+            self._local.frame = frame_seq
+            self._local.frame_start = time.perf_counter_ns()
+
+    @property
+    def current_frame(self):
+        """Frame the spans of this thread are attributed to"""
+        return getattr(self._local, 'frame', 0)
+
+    def attach(self, frame_seq):
+        """Attribute later spans on this thread (e.g. a pool thread) to another thread's frame"""
+        if self.enabled:
+            self._local.frame = frame_seq
+
+    def end_frame(self):
+        """Record the whole-frame span started by begin_frame()"""
+        if self.enabled and getattr(self._local, 'frame_start', None) is not None:
+            self._store("frame", self._local.frame_start, time.perf_counter_ns() - self._local.frame_start)
+            self._local.frame_start = None
+
+    def record(self, stage, start_ns, duration_ns):
+        if self.metrics is not None:
+            self.metrics.observe_stage(stage, duration_ns)
+        if self.enabled:
+            self._store(stage, start_ns, duration_ns)
+
+    def _store(self, stage, start_ns, duration_ns):
+        stage_id = self._stage_ids.get(stage)
+        if stage_id is None:
+            with self._register_lock:
+                stage_id = self._stage_ids.get(stage)
+                if stage_id is None:
+                    stage_id = len(self._stage_names)
+                    self._stage_names.append(stage)
+                    self._stage_ids[stage] = stage_id
+        index = next(self._counter)  # Atomic under the GIL, so threads never share a slot
+        slot = index % self.capacity
+        self._stages[slot] = stage_id
+        self._frames[slot] = getattr(self._local, 'frame', 0)
+        self._threads[slot] = threading.get_ident()
+        self._starts[slot] = start_ns
+        self._durations[slot] = duration_ns
+        self._recorded = max(self._recorded, index + 1)
+
+    def events(self):
+        """Return the buffered events, oldest first, as (stage, frame, thread, start_ns, duration_ns)"""
+        count = min(self._recorded, self.capacity)
+        order = np.argsort(self._starts[:count], kind='stable')
+        return [(self._stage_names[self._stages[i]], int(self._frames[i]), int(self._threads[i]),
+                 int(self._starts[i]), int(self._durations[i])) for i in order]
+
+    def write_chrome_trace(self, path):
+        """Write the buffered events as a Chrome/Perfetto trace (open in chrome://tracing or ui.perfetto.dev)"""
+        events = self.events()
+        origin = events[0][3] if events else 0
+        pid = os.getpid()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        trace_events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                         "args": {"name": thread_names.get(tid, str(tid))}}
+                        for tid in sorted({event[2] for event in events})]
+        for stage, frame_seq, tid, start_ns, duration_ns in events:
+            trace_events.append({"name": stage, "cat": "stage", "ph": "X", "pid": pid, "tid": tid,
+                                 "ts": (start_ns - origin) / 1000.0, "dur": duration_ns / 1000.0,
+                                 "args": {"frame": frame_seq}})
+        with open(path, 'w') as trace_file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file)
+
+    def write_csv(self, path):
+        """Write the buffered events as CSV (times in microseconds from the first event)"""
+        events = self.events()
+        origin = events[0][3] if events else 0
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["frame", "stage", "thread", "start_us", "duration_us"])
+            for stage, frame_seq, tid, start_ns, duration_ns in events:
+                writer.writerow([frame_seq, stage, tid, f"{(start_ns - origin) / 1000.0:.1f}",
+                                 f"{duration_ns / 1000.0:.1f}"])
+
+# Shared tracer used by the detection functions and processing loops.
+tracer = StageTracer(enabled=TRACE_STAGES)
+
+# -------------------------------------------------------------------------------------------------------
+#                            SECTION 1E: PREALLOCATED FRAME BUFFERS
+# -------------------------------------------------------------------------------------------------------
+
+class FrameBuffers:
+    """
+    Pool of named working arrays reused from frame to frame. A buffer is only reallocated when it
+    is requested with a different shape or dtype (e.g. after the stream resolution changes), so
+    steady-state processing allocates no frame-sized arrays.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=np.uint8):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+            self.allocations += 1
+        return buffer
+
+    def channels(self, prefix, shape):
+        """Three single-channel buffers, as scratch for ColorClassifier.classify()"""
+        return [self.get(f"{prefix}{index}", shape) for index in range(3)]
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+def _pooled(buffers, name, shape, dtype=np.uint8):
+    """Buffer `name` from a FrameBuffers pool, or None (OpenCV allocates) when there is no pool"""
+    return None if buffers is None else buffers.get(name, shape, dtype)
+
+# -------------------------------------------------------------------------------------------------------
+#                         SECTION 1F: MJPEG HTTP CLIENT (REDUCED-SCALE DECODING)
+# -------------------------------------------------------------------------------------------------------
+
+# cv2.imdecode flags for each supported decode scale (libjpeg scales while decoding, so a
+# reduced decode is much cheaper than a full decode followed by a resize).
+MJPEG_DECODE_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                      4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+class MjpegFrameReader(LatestFrameReader):
+    """
+    Built-in client for HTTP MJPEG (multipart/x-mixed-replace) streams such as IP Webcam's /video.
+    The reader thread only splits the byte stream into JPEGs and keeps the newest one; a JPEG is
+    decoded in read(), at 1/`scale` resolution, so frames dropped while the pipeline is busy are
+    never decoded. Same interface as LatestFrameReader; returned frames are `scale` times smaller.
+    """
+
+    def __init__(self, url, scale=MJPEG_DECODE_SCALE, timeout=10.0):
+        if scale not in MJPEG_DECODE_FLAGS:
+            raise ValueError(f"MJPEG decode scale must be one of {sorted(MJPEG_DECODE_FLAGS)}")
+        super().__init__(url)
+        self.scale = scale
+        self.timeout = timeout
+        self.frames_corrupt = 0
+        self.decode_seconds = 0.0
+        self._response = None
+        self._boundary = None
+        self._in_headers = False   # The last body scan already consumed the next boundary line
+
+    def open(self):
+        """Connect and start the reader thread. Returns False if the URL isn't an MJPEG stream"""
+        try:
+            self._response = urllib.request.urlopen(self.source, timeout=self.timeout)
+        except (OSError, ValueError):
+            return False
+        content_type = self._response.headers.get('Content-Type', '')
+        if not content_type.startswith('multipart/'):
+            self._response.close()
+            return False
+        boundary = content_type.partition('boundary=')[2].split(';')[0].strip().strip('"')
+        self._boundary = b'--' + boundary.encode('latin-1').lstrip(b'-') if boundary else None
+        self._running = True
+        self._thread = threading.Thread(target=self._reader_loop, name="mjpeg-reader", daemon=True)
+        self._thread.start()
+        return True
+
+    def _read_part(self):
+        """Read the body of the next multipart part; returns None at the end of the stream"""
+        stream = self._response
+        headers = {} if self._in_headers else None
+        self._in_headers = False
+        while True:
+            line = stream.readline()
+            if not line:
+                return None
+            line = line.strip()
+            if line.startswith(b'--') and (self._boundary is None or line.startswith(self._boundary)):
+                if line.endswith(b'--') and line != b'--':
+                    return None  # Closing boundary
+                headers = {}
+            elif headers is not None:
+                if not line:
+                    break  # End of the part headers
+                name, _, value = line.partition(b':')
+                headers[name.strip().lower()] = value.strip()
+
+        if b'content-length' in headers:
+            return stream.read(int(headers[b'content-length']))
+        # No length given: the body runs until the next boundary line
+        body = bytearray()
+        while True:
+            line = stream.readline()
+            if not line:
+                break
+            if self._boundary and line.startswith(self._boundary):
+                self._in_headers = not line.rstrip().endswith(b'--')
+                break
+            body += line
+        return bytes(body[:-2] if body.endswith(b'\r\n') else body)
+
+    def _reader_loop(self):
+        while self._running:
+            try:
+                jpeg = self._read_part()
+            except (OSError, ValueError):
+                jpeg = None  # Connection lost or timed out: end of stream
+            timestamp = time.monotonic()
+            with self._cond:
+                if not jpeg:
+                    self._finished = True
+                    self._cond.notify_all()
+                    break
+                if self._seq > self._consumed_seq:
+                    self.frames_dropped += 1  # Replaced before it was decoded
+                self._frame = jpeg
+                self._seq += 1
+                self._timestamp = timestamp
+                self.frames_captured += 1
+                self._cond.notify_all()
+
+    def read(self, timeout=None):
+        """Wait for the next JPEG and decode it; corrupt JPEGs are skipped (and counted)"""
+        while True:
+            ret, jpeg, seq, timestamp = super().read(timeout)
+            if not ret:
+                return ret, None, seq, timestamp
+            started = time.perf_counter()
+            with tracer.span("decode"):
+                frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), MJPEG_DECODE_FLAGS[self.scale])
+            self.decode_seconds += time.perf_counter() - started
+            if frame is not None:
+                return True, frame, seq, timestamp
+            self.frames_corrupt += 1
+
+    def release(self):
+        """Stop the reader thread and close the connection"""
+        self._running = False
+        if self._response is not None:
+            self._response.close()
+        super().release()
+
+def is_file_source(source):
+    """True when a capture source is a recorded video file rather than a live camera or stream"""
+    return isinstance(source, (str, os.PathLike)) and os.path.isfile(source)
+
+def create_frame_reader(source):
+    """
+    Reader for a capture source: SequentialFrameReader for video files (every frame, in order),
+    MjpegFrameReader for HTTP streams (if enabled), else LatestFrameReader.
+    """
+    if is_file_source(source):
+        return SequentialFrameReader(source)
+    if USE_MJPEG_CLIENT and str(source).startswith("http"):
+        return MjpegFrameReader(source, scale=MJPEG_DECODE_SCALE)
+    return LatestFrameReader(source)
+
+# -------------------------------------------------------------------------------------------------------
+#                           SECTION 1G: LIVE METRICS (PROMETHEUS ENDPOINT)
+# -------------------------------------------------------------------------------------------------------
+
+# Upper bounds (seconds) of the latency histogram buckets
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Seconds the frame rate and command change rate gauges are averaged over
+METRICS_RATE_WINDOW = 10.0
+
+# Exported metric families, in output order: name -> (type, help)
+METRIC_FAMILIES = {
+    'flight_frames_captured_total': ('counter', "Frames read from the capture source"),
+    'flight_frames_dropped_total': ('counter', "Frames the capture replaced before they were processed"),
+    'flight_frames_processed_total': ('counter', "Frames that went through detection and avoidance"),
+    'flight_frames_skipped_total': ('counter', "Frames not detected, by reason (load_shedding: not processed, "
+                                               "motion_gate: previous result reused)"),
+    'flight_display_frames_dropped_total': ('counter', "Annotated frames replaced before the window showed them"),
+    'flight_detections_total': ('counter', "Classified objects, by classification"),
+    'flight_command_changes_total': ('counter', "Changes of the avoidance command"),
+    'flight_capture_fps': ('gauge', "Capture frame rate"),
+    'flight_processing_fps': ('gauge', "Processed frame rate"),
+    'flight_command_changes_per_minute': ('gauge', "Command change rate"),
+    'flight_load_shedding_level': ('gauge', "Load shedding level, 0 at full quality"),
+    'flight_frame_latency_seconds': ('histogram', "Processing time of each frame"),
+    'flight_stage_latency_seconds': ('histogram', "Time spent in each processing stage, by stage"),
+}
+
+class _MetricShard:
+    """Counters and histograms updated by one thread only, so updates need no lock"""
+    __slots__ = ('counters', 'histograms', 'sums')
+
+    def __init__(self):
+        self.counters = {}    # (name, labels) -> count
+        self.histograms = {}  # (name, labels) -> per-bucket counts, the last one for +Inf
+        self.sums = {}        # (name, labels) -> total nanoseconds
+
+class FlightMetrics:
+    """
+    Counters, gauges and latency histograms of a running controller, rendered in the Prometheus
+    text format. Every thread writes its own shard of plain dicts, so the hot path takes no lock;
+    a scrape sums the shards and may be a few updates behind. Labels are tuples of (name, value).
+    """
+    def __init__(self, source=None, buckets=METRICS_LATENCY_BUCKETS):
+        self.source = source  # Capture source whose frames_captured / frames_dropped are exported
+        self.buckets = tuple(buckets)
+        self._bounds = [round(bound * 1e9) for bound in self.buckets]
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()  # Taken once per thread, when its shard is created
+        self._stage_labels = {}
+        self._gauges = {}
+        self._last_command = None
+        self._rate_lock = threading.Lock()
+        self._rate_samples = deque([(time.monotonic(), (0, 0, 0))])
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _MetricShard()
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, duration_ns, labels=()):
+        """Add a duration (nanoseconds) to a latency histogram"""
+        shard = self._shard()
+        key = (name, labels)
+        counts = shard.histograms.get(key)
+        if counts is None:
+            counts = shard.histograms[key] = [0] * (len(self._bounds) + 1)
+            shard.sums[key] = 0
+        counts[bisect.bisect_left(self._bounds, duration_ns)] += 1
+        shard.sums[key] += duration_ns
+
+    def observe_stage(self, stage, duration_ns):
+        labels = self._stage_labels.get(stage)
+        if labels is None:
+            labels = self._stage_labels[stage] = (('stage', stage),)
+        self.observe('flight_stage_latency_seconds', duration_ns, labels)
+
+    def set_gauge(self, name, value, labels=()):
+        self._gauges[(name, labels)] = value
+
+    def frame_processed(self, command, classifications, duration_ns):
+        """Count one processed frame: its latency, its detections by class and command changes"""
+        self.inc('flight_frames_processed_total')
+        self.observe('flight_frame_latency_seconds', duration_ns)
+        for classification in classifications:
+            self.inc('flight_detections_total', (('classification', classification),))
+        if command != self._last_command:
+            if self._last_command is not None:
+                self.inc('flight_command_changes_total')
+            self._last_command = command
+
+    def _collect(self):
+        """Counters and histograms summed over the shards"""
+        counters, histograms, sums = {}, {}, {}
+        for shard in list(self._shards):
+            for key, value in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, counts in list(shard.histograms.items()):
+                total = histograms.setdefault(key, [0] * len(counts))
+                for index, count in enumerate(list(counts)):
+                    total[index] += count
+                sums[key] = sums.get(key, 0) + shard.sums.get(key, 0)
+        return counters, histograms, sums
+
+    def _rates(self, counters):
+        """Capture, processing and command change rates over about the last METRICS_RATE_WINDOW seconds"""
+        now = time.monotonic()
+        current = (counters.get(('flight_frames_captured_total', ()), 0),
+                   counters.get(('flight_frames_processed_total', ()), 0),
+                   counters.get(('flight_command_changes_total', ()), 0))
+        with self._rate_lock:
+            samples = self._rate_samples
+            samples.append((now, current))
+            while len(samples) > 2 and now - samples[1][0] >= METRICS_RATE_WINDOW:
+                samples.popleft()
+            then, previous = samples[0]
+        rates = [(new - old) / max(now - then, 1e-9) for new, old in zip(current, previous)]
+        return {('flight_capture_fps', ()): rates[0], ('flight_processing_fps', ()): rates[1],
+                ('flight_command_changes_per_minute', ()): rates[2] * 60.0}
+
+    def render(self):
+        """The current metrics in the Prometheus text exposition format"""
+        counters, histograms, sums = self._collect()
+        if self.source is not None:
+            counters[('flight_frames_captured_total', ())] = self.source.frames_captured
+            counters[('flight_frames_dropped_total', ())] = self.source.frames_dropped
+        else:
+            counters.setdefault(('flight_frames_captured_total', ()),
+                                counters.get(('flight_frames_processed_total', ()), 0))
+        for classification in rule_table.compiled().classifications:
+            counters.setdefault(('flight_detections_total', (('classification', classification),)), 0)
+        for reason in ('load_shedding', 'motion_gate'):
+            counters.setdefault(('flight_frames_skipped_total', (('reason', reason),)), 0)
+        gauges = dict(self._gauges)
+        gauges.update(self._rates(counters))
+
+        lines = []
+        for name, (kind, help_text) in METRIC_FAMILIES.items():
+            values = histograms if kind == 'histogram' else counters if kind == 'counter' else gauges
+            series = sorted((labels, value) for (family, labels), value in values.items() if family == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                if kind != 'histogram':
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}" if isinstance(value, float)
+                                 else f"{name}{_format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (None,), value):
+                    cumulative += count
+                    le = "+Inf" if bound is None else f"{bound:g}"
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {sums[(name, labels)] / 1e9:.9g}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+def start_metrics_server(metrics, port, host=None):
+    """
+    Serve metrics.render() at http://host:port/metrics (default host METRICS_HOST) from a daemon
+    thread. Returns the server; with port 0 its server_address holds the port picked. Stop it
+    with shutdown().
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes would interleave with the command stream on stdout
+
+    server = ThreadingHTTPServer((host or METRICS_HOST, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+# Metrics of this process, fed by the processing loops while set (see METRICS_PORT).
+metrics = None
+
+# -------------------------------------------------------------------------------------------------------
+#                                SECTION 2: SHAPE DETECTION FUNCTION
+# -------------------------------------------------------------------------------------------------------
+
+# Shape tests: the checks a contour must pass to be each shape, as (feature, test) pairs. The
+# features are computed by ContourFeatures on first use.
+SHAPE_TESTS = {
+    'triangle': [('vertices', lambda vertices: vertices == 3)],
+    'square': [('vertices', lambda vertices: vertices == 4),
+               ('aspect_ratio', lambda aspect_ratio: 0.90 <= aspect_ratio <= 1.10)],
+    'rectangle': [('vertices', lambda vertices: vertices == 4),
+                  ('aspect_ratio', lambda aspect_ratio: not 0.90 <= aspect_ratio <= 1.10)],
+    'pentagon': [('vertices', lambda vertices: vertices == 5)],
+    'circle': [('vertices', lambda vertices: vertices not in (3, 4)),
+               ('circularity', lambda circularity: 0.75 < circularity < 1.2)],
+}
+
+# Relative cost of each feature, used to run the cheapest tests first. The area is needed for the
+# size filter anyway; minEnclosingCircle costs about twice approxPolyDP.
+FEATURE_COSTS = {'area': 0, 'vertices': 1, 'aspect_ratio': 2, 'circularity': 3}
+
+class ContourFeatures:
+    """The features of one contour used by the shape tests, each computed once, on first use"""
+    __slots__ = ('contour', 'values', 'approx')
+
+    def __init__(self, contour, area=None):
+        self.contour = contour
+        self.values = {} if area is None else {'area': area}
+        self.approx = None
+
+    def __getitem__(self, name):
+        value = self.values.get(name)
+        if value is None:
+            value = self.values[name] = getattr(self, '_' + name)()
+        return value
+
+    def _area(self):
+        return cv2.contourArea(self.contour)
+
+    def _vertices(self):
+        perimeter = cv2.arcLength(self.contour, True)
+        self.approx = cv2.approxPolyDP(self.contour, 0.04 * perimeter, True)
+        return len(self.approx)
+
+    def _aspect_ratio(self):
+        self['vertices']
+        (x, y, w, h) = cv2.boundingRect(self.approx)
+        return float(w) / h
+
+    def _circularity(self):
+        (x, y), radius = cv2.minEnclosingCircle(self.contour)
+        return self['area'] / (np.pi * (radius**2)) if radius > 0 else 0.0
+
+def detect_shape(contour):
+    """
+    Analyzes a contour and returns its shape as a string.
+    Identifies 'triangle', 'square', 'rectangle', or 'circle'.
+    """
+    features = ContourFeatures(contour)
+    for shape in ('triangle', 'square', 'rectangle', 'circle'):
+        if all(test(features[feature]) for feature, test in SHAPE_TESTS[shape]):
+            return shape
+    return "unknown"
+
+class RuleTable:
+    """
+    DETECTION_RULES compiled for classification: for each color, its rules with their shape tests
+    ordered cheapest first, and the rules ordered by the cost of their first test, so a contour
+    stops at the first failing test. Recompiled whenever the rules change.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = DETECTION_RULES if rules is None else rules
+        self._key = None
+        self.by_color = {}          # color -> [(rule, [(feature, test), ...]), ...]
+        self.classifications = ()   # In rule order
+        self.draw_colors = {}       # classification -> BGR
+        self.avoid = frozenset()    # Classifications with the "avoid" role
+
+    def compiled(self):
+        key = tuple(self.rules)
+        if key != self._key:
+            self._compile(key)
+        return self
+
+    def _compile(self, rules):
+        by_color = {}
+        for rule in rules:
+            if rule.shape not in SHAPE_TESTS:
+                raise ValueError(f"Unknown shape {rule.shape!r} in detection rule {rule.classification!r}")
+            tests = sorted(SHAPE_TESTS[rule.shape], key=lambda step: FEATURE_COSTS[step[0]])
+            by_color.setdefault(rule.color, []).append((rule, tests))
+        for color_rules in by_color.values():
+            color_rules.sort(key=lambda item: FEATURE_COSTS[item[1][0][0]])
+        self.by_color = by_color
+        self.classifications = tuple(dict.fromkeys(rule.classification for rule in rules))
+        self.draw_colors = {rule.classification: rule.draw_color for rule in rules}
+        self.avoid = frozenset(rule.classification for rule in rules if rule.role == 'avoid')
+        self._key = rules
+
+    def match(self, color_name, features):
+        """The first rule of the color whose shape tests the contour passes, or None"""
+        for rule, tests in self.by_color.get(color_name, ()):
+            for feature, test in tests:
+                if not test(features[feature]):
+                    break
+            else:
+                return rule
+        return None
+
+# Shared compiled rules.
+rule_table = RuleTable()
+
+def detection_colors():
+    """The colors of color_ranges that some detection rule uses; masks of other colors are skipped"""
+    by_color = rule_table.compiled().by_color
+    return [color_name for color_name in color_ranges if color_name in by_color]
+
+def is_dangerous(classification):
+    """Whether objects of this classification are steered away from (the "avoid" role)"""
+    return classification in rule_table.compiled().avoid
+
+# -------------------------------------------------------------------------------------------------------
+#                       SECTION 2B: OBJECT DETECTION (FULL FRAME / COARSE-TO-FINE)
+# -------------------------------------------------------------------------------------------------------
+
+# One classified object: its classification, color, shape, contour (full-frame coordinates), centroid
+# and contour area in pixels.
+Detection = namedtuple('Detection', ['classification', 'color', 'shape', 'contour', 'center', 'area'])
+
+def classify_contour(color_name, contour, center=None, min_area=None):
+    """
+    Classify one contour of a color mask. Returns a Detection, or None if it is ignored.
+    Contours smaller than min_area (default MIN_CONTOUR_AREA) are ignored, the others are
+    matched against the detection rules of their color. The centroid of a match is computed
+    from the contour moments unless it is passed in.
+    """
+    area = cv2.contourArea(contour)
+    if area < (MIN_CONTOUR_AREA if min_area is None else min_area):
+        return None
+
+    with tracer.span("detect_shape"):
+        rule = rule_table.compiled().match(color_name, ContourFeatures(contour, area))
+    if rule is None:
+        return None
+
+    if center is None:
+        with tracer.span("moments"):
+            M = cv2.moments(contour)
+        cX = int(M["m10"] / M["m00"]) if M["m00"] != 0 else 0
+        cY = int(M["m01"] / M["m00"]) if M["m00"] != 0 else 0
+    else:
+        cX, cY = center
+    return Detection(rule.classification, color_name, rule.shape, contour, (cX, cY), area)
+
+# Number of blobs last seen in each full-frame mask, used by the "auto" prefilter mode.
+_blob_counts = {}
+
+def _use_prefilter(clutter_key):
+    """Whether the mask identified by clutter_key (None for small ROI masks) should be prefiltered"""
+    if USE_COMPONENT_PREFILTER == "auto":
+        return clutter_key is not None and _blob_counts.get(clutter_key, 0) > PREFILTER_AUTO_BLOBS
+    return bool(USE_COMPONENT_PREFILTER)
+
+def _label_components(mask, labels=None):
+    """cv2.connectedComponentsWithStats with 8-connectivity, matching findContours' notion of a blob"""
+    return cv2.connectedComponentsWithStatsWithAlgorithm(mask, 8, cv2.CV_32S, cv2.CCL_GRANA, labels=labels)
+
+def _find_candidates(mask, offset=(0, 0), clutter_key=None, buffers=None, min_area=None, prefilter=None):
+    """
+    Find the candidate objects of a color mask as (contour, bounding_rect, center) tuples, in
+    full-frame coordinates (`offset` is the position of the mask in the frame).
+
+    With the connected-component prefilter, components whose bounding box can't hold min_area
+    are dropped in one NumPy batch using their stats, and only the survivors get a contour;
+    components inside the hole of another one are dropped too, as findContours would not report
+    them. Otherwise every external contour is returned. Either way the center is left to the
+    moments (None). Component labels go to a `buffers` pool buffer when one is given.
+    `prefilter` overrides the decision _use_prefilter() makes from clutter_key.
+    """
+    offset_x, offset_y = offset
+    if not (_use_prefilter(clutter_key) if prefilter is None else prefilter):
+        with tracer.span("find_contours"):
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+        if clutter_key is not None:
+            _blob_counts[clutter_key] = len(contours)
+        return [(contour, cv2.boundingRect(contour), None) for contour in contours]
+
+    with tracer.span("components"):
+        count, labels, stats, centroids = _label_components(mask, _pooled(buffers, "components", mask.shape, np.int32))
+        if clutter_key is not None:
+            _blob_counts[clutter_key] = count - 1
+        # Row 0 is the background. A contour runs through pixel centers, so its area is at most
+        # (w - 1) * (h - 1): smaller boxes can never pass classify_contour's area test.
+        w = stats[1:, cv2.CC_STAT_WIDTH]
+        h = stats[1:, cv2.CC_STAT_HEIGHT]
+        survivors = np.flatnonzero((w - 1) * (h - 1) >= (MIN_CONTOUR_AREA if min_area is None else min_area)) + 1
+
+    candidates = []
+    with tracer.span("find_contours"):
+        for index in survivors.tolist():
+            x, y, w, h = (int(value) for value in stats[index, :4])
+            component = (labels[y:y + h, x:x + w] == index).view(np.uint8)
+            contours, _ = cv2.findContours(component, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                           offset=(x + offset_x, y + offset_y))
+            candidates.append((contours[0], (x + offset_x, y + offset_y, w, h), None))
+        # A component strictly inside another's box may sit in one of its holes
+        boxes = stats[survivors, :4]
+        x, y, x1, y1 = boxes[:, 0], boxes[:, 1], boxes[:, 0] + boxes[:, 2], boxes[:, 1] + boxes[:, 3]
+        nested = set()
+        for outer in range(len(candidates)):
+            for index in np.flatnonzero((x > x[outer]) & (y > y[outer]) & (x1 < x1[outer]) & (y1 < y1[outer])).tolist():
+                contour = candidates[index][0]
+                point = (float(contour[0][0][0]), float(contour[0][0][1]))
+                if cv2.pointPolygonTest(candidates[outer][0], point, False) > 0:
+                    nested.add(index)
+    return [candidate for index, candidate in enumerate(candidates) if index not in nested]
+
+def _detect_full(frame, buffers=None, min_area=None):
+    """Detect and classify objects on the full-resolution frame"""
+    shape = frame.shape[:2]
+    with tracer.span("hsv"):
+        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV, dst=_pooled(buffers, "hsv", frame.shape))
+    with tracer.span("masks"):
+        labels = color_classifier.classify(hsv, buffers.channels("channel", shape) if buffers else None)
+
+    # One mask buffer serves every color: candidates are extracted before the next mask is built
+    mask_buffer = _pooled(buffers, "mask", shape)
+    detections = []
+    for color_name in detection_colors():
+        with tracer.span("masks"):
+            mask = color_classifier.mask(labels, color_name, mask_buffer)
+        for contour, rect, center in _find_candidates(mask, clutter_key=color_name, buffers=buffers,
+                                                      min_area=min_area):
+            detection = classify_contour(color_name, contour, center, min_area)
+            if detection:
+                detections.append(detection)
+    return detections
+
+# Thread pool of the tiled detection, created on first use: (threads, executor)
+_tile_pool = (0, None)
+
+def _tile_executor(threads):
+    global _tile_pool
+    if _tile_pool[0] != threads:
+        if _tile_pool[1] is not None:
+            _tile_pool[1].shutdown(wait=False)
+        _tile_pool = (threads, ThreadPoolExecutor(max_workers=threads, thread_name_prefix="detect-tile"))
+    return _tile_pool[1]
+
+def _strip_contours(mask, strip, overlap):
+    """
+    External contours of one strip of a mask, searched TILE_OVERLAP rows into its neighbours.
+    A strip owns the objects whose top row lies in it. Returns the owned complete contours and
+    the owned contours cut by the bottom of the search window (to be merged across the border),
+    as (contour, rect) pairs.
+    """
+    height = mask.shape[0]
+    y0, y1 = strip
+    top, bottom = max(0, y0 - overlap), min(height, y1 + overlap)
+    with tracer.span("find_contours"):
+        contours, _ = cv2.findContours(mask[top:bottom], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                       offset=(0, top))
+    complete, crossing = [], []
+    for contour in contours:
+        x, y, w, h = rect = cv2.boundingRect(contour)
+        if not (y0 <= y < y1) or (y == top and top > 0):
+            continue  # Owned by the strip holding its top row
+        (crossing if y + h == bottom and bottom < height else complete).append((contour, rect))
+    return complete, crossing
+
+def _merge_crossing(mask, contour, rect, overlap):
+    """
+    Extract the whole contour of an object cut by a strip's search window: the rows around it are
+    labelled, growing in both directions until the object's component fits, and the contour is
+    taken from that component alone (as the component prefilter does). Parts of one object that
+    only join outside the window all give the same result.
+    """
+    height = mask.shape[0]
+    x, y, w, h = rect
+    px, py = (int(value) for value in contour[0][0])  # A pixel of the object
+    top, bottom = y, y + h
+    while True:
+        top, bottom = max(0, top - overlap), min(height, bottom + overlap)
+        labels = cv2.connectedComponentsWithStats(mask[top:bottom], connectivity=8)
+        label = labels[1][py - top, px]
+        cx, cy, cw, ch = (int(value) for value in labels[2][label, :4])
+        if (cy > 0 or top == 0) and (cy + ch < bottom - top or bottom == height):
+            break
+        overlap *= 2
+    component = (labels[1][cy:cy + ch, cx:cx + cw] == label).view(np.uint8)
+    contours, _ = cv2.findContours(component, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(cx, cy + top))
+    return contours[0], (cx, cy + top, cw, ch)
+
+def _detect_tiled(frame, threads, buffers=None, min_area=None):
+    """
+    _detect_full() on `threads` horizontal strips in parallel, with the same results. HSV
+    conversion, classification and the per-color masks run per strip into frame-sized buffers;
+    contours are then extracted per strip and color, each object by the strip holding its top
+    row. Objects cut by a strip's search window are re-extracted whole around it. An object inside
+    the hole of another one that was cut looks external to the strip; such contours (which the full
+    frame would not report) are dropped. Colors the prefilter handles are processed on the full mask.
+    """
+    if buffers is None:
+        buffers = FrameBuffers()  # The strips write into shared frame-sized arrays
+    shape = frame.shape[:2]
+    height = shape[0]
+    bounds = np.linspace(0, height, threads + 1).astype(int).tolist()
+    strips = list(zip(bounds[:-1], bounds[1:]))
+    hsv = _pooled(buffers, "hsv", frame.shape)
+    channels = buffers.channels("channel", shape)
+    colors = detection_colors()
+    masks = {color_name: _pooled(buffers, f"mask_{color_name}", shape) for color_name in colors}
+    color_classifier._ensure_compiled()  # Before the threads share it
+    executor = _tile_executor(threads)
+    frame_seq = tracer.current_frame
+
+    def classify_strip(strip):
+        y0, y1 = strip
+        tracer.attach(frame_seq)
+        with tracer.span("hsv"):
+            cv2.cvtColor(frame[y0:y1], cv2.COLOR_BGR2HSV, dst=hsv[y0:y1])
+        with tracer.span("masks"):
+            labels = color_classifier.classify(hsv[y0:y1], [channel[y0:y1] for channel in channels])
+            for color_name, mask in masks.items():
+                color_classifier.mask(labels, color_name, mask[y0:y1])
+
+    list(executor.map(classify_strip, strips))
+
+    def prefiltered_candidates(color_names):
+        # One task for all of them: _find_candidates shares the pooled component-label buffer
+        tracer.attach(frame_seq)
+        return {color_name: [(contour, center) for contour, rect, center in
+                             _find_candidates(masks[color_name], clutter_key=color_name, buffers=buffers,
+                                              min_area=min_area)]
+                for color_name in color_names}
+
+    def strip_task(task):
+        color_name, strip = task
+        tracer.attach(frame_seq)
+        return _strip_contours(masks[color_name], strip, TILE_OVERLAP)
+
+    prefiltered = [color_name for color_name in colors if _use_prefilter(color_name)]
+    prefilter_job = executor.submit(prefiltered_candidates, prefiltered) if prefiltered else None
+    tasks = [(color_name, strip) for color_name in colors if color_name not in prefiltered
+             for strip in strips]
+    strip_results = dict(zip(tasks, executor.map(strip_task, tasks)))
+
+    candidates = prefilter_job.result() if prefilter_job else {}
+    # Rows where strip search windows were cut: only objects spanning one can enclose a contour
+    # that a strip wrongly saw as external
+    cut_rows = np.array([max(0, y0 - TILE_OVERLAP) for y0, y1 in strips[1:]] +
+                        [min(height, y1 + TILE_OVERLAP) for y0, y1 in strips[:-1]])
+    for color_name in colors:
+        if color_name in prefiltered:
+            continue
+        found = []      # (contour, rect)
+        merged_rects = set()
+        for strip in strips:
+            complete, crossing = strip_results[(color_name, strip)]
+            found.extend(complete)
+            for contour, rect in crossing:
+                contour, rect = _merge_crossing(masks[color_name], contour, rect, TILE_OVERLAP)
+                if rect not in merged_rects:  # Other parts of one object give the same result
+                    merged_rects.add(rect)
+                    found.append((contour, rect))
+        nested = set()
+        if found:
+            boxes = np.array([rect for contour, rect in found]).reshape(-1, 4)
+            x, y, x1, y1 = boxes[:, 0], boxes[:, 1], boxes[:, 0] + boxes[:, 2], boxes[:, 1] + boxes[:, 3]
+            spanning = np.flatnonzero(((y[:, None] < cut_rows) & (cut_rows < y1[:, None])).any(axis=1))
+            for outer in spanning.tolist():
+                inside = np.flatnonzero((x >= x[outer]) & (y >= y[outer]) & (x1 <= x1[outer]) & (y1 <= y1[outer]))
+                for index in inside.tolist():
+                    contour = found[index][0]
+                    point = (float(contour[0][0][0]), float(contour[0][0][1]))
+                    if index != outer and cv2.pointPolygonTest(found[outer][0], point, False) > 0:
+                        nested.add(index)
+        _blob_counts[color_name] = len(found) - len(nested)
+        candidates[color_name] = [(contour, None) for index, (contour, rect) in enumerate(found)
+                                  if index not in nested]
+
+    detections = []
+    for color_name in colors:
+        for contour, center in candidates[color_name]:
+            detection = classify_contour(color_name, contour, center, min_area)
+            if detection:
+                detections.append(detection)
+    return detections
+
+def _merge_rects(rects):
+    """Merge overlapping or touching (x, y, w, h) rectangles until none overlap"""
+    rects = list(rects)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                ax, ay, aw, ah = rects[i]
+                bx, by, bw, bh = rects[j]
+                if ax <= bx + bw and bx <= ax + aw and ay <= by + bh and by <= ay + ah:
+                    x, y = min(ax, bx), min(ay, by)
+                    rects[i] = (x, y, max(ax + aw, bx + bw) - x, max(ay + ah, by + bh) - y)
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return rects
+
+def _detect_in_rois(frame, rois_by_color, min_area=None):
+    """
+    Detect objects inside full-resolution regions of interest, given per color as (x, y, w, h).
+    Contours touching a region edge that is not also a frame edge belong to an object that is
+    not fully inside the region and are skipped. A region shared by several colors is converted
+    and classified once. Regions use the prefilter when the last full-frame mask of their color
+    was cluttered.
+    """
+    height, width = frame.shape[:2]
+    detections = []
+    roi_labels = {}
+    for color_name, rois in rois_by_color.items():
+        prefilter = _use_prefilter(color_name)
+        for (x, y, w, h) in rois:
+            labels = roi_labels.get((x, y, w, h))
+            if labels is None:
+                with tracer.span("hsv"):
+                    roi_hsv = cv2.cvtColor(frame[y:y + h, x:x + w], cv2.COLOR_BGR2HSV)
+                with tracer.span("masks"):
+                    labels = roi_labels[(x, y, w, h)] = color_classifier.classify(roi_hsv)
+            with tracer.span("masks"):
+                roi_mask = color_classifier.mask(labels, color_name)
+            for contour, (bx, by, bw, bh), center in _find_candidates(roi_mask, (x, y), min_area=min_area,
+                                                                      prefilter=prefilter):
+                if ((bx == x and x > 0) or (by == y and y > 0) or
+                        (bx + bw == x + w and x + w < width) or (by + bh == y + h and y + h < height)):
+                    continue
+                detection = classify_contour(color_name, contour, center, min_area)
+                if detection:
+                    detections.append(detection)
+    return detections
+
+def _detect_coarse_to_fine(frame, downscale, buffers=None, min_area=None):
+    """Find candidate blobs on a downscaled frame, then classify them inside full-resolution ROIs"""
+    height, width = frame.shape[:2]
+    small_shape = (max(1, height // downscale), max(1, width // downscale))
+    with tracer.span("downscale"):
+        small = cv2.resize(frame, small_shape[::-1], dst=_pooled(buffers, "small", small_shape + (3,)),
+                           interpolation=cv2.INTER_AREA)
+    scale_x = width / small.shape[1]
+    scale_y = height / small.shape[0]
+    with tracer.span("hsv"):
+        small_hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV, dst=_pooled(buffers, "small_hsv", small_shape + (3,)))
+    with tracer.span("masks"):
+        small_labels = color_classifier.classify(small_hsv,
+                                                 buffers.channels("small_channel", small_shape) if buffers else None)
+    mask_buffer = _pooled(buffers, "small_mask", small_shape)
+
+    # Blob edges blur when downscaling, so candidates are padded generously and kept whenever
+    # their (slightly grown) bounding box could still hold min_area at full resolution. A blob
+    # can also break into pieces on the coarse mask, some too small to be candidates, so a
+    # candidate's region grows over the chain of blobs at most `gap` coarse pixels apart.
+    if min_area is None:
+        min_area = MIN_CONTOUR_AREA
+    pad = 2 * downscale + 2
+    gap = 4
+    rois_by_color = {}
+    for color_name in detection_colors():
+        with tracer.span("masks"):
+            mask = color_classifier.mask(small_labels, color_name, mask_buffer)
+        clutter_key = ('coarse', color_name)
+        if _use_prefilter(clutter_key):
+            with tracer.span("components"):
+                count, _, stats, _ = _label_components(mask, _pooled(buffers, "small_components", small_shape, np.int32))
+            boxes = stats[1:, :4]
+        else:
+            with tracer.span("find_contours"):
+                contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            boxes = np.array([cv2.boundingRect(contour) for contour in contours], dtype=np.int32).reshape(-1, 4)
+        _blob_counts[clutter_key] = len(boxes)
+        pieces = np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1)  # (x0, y0, x1, y1)
+        rois = []
+        for index in np.flatnonzero((boxes[:, 2] + 2) * scale_x * (boxes[:, 3] + 2) * scale_y >= min_area):
+            # Walk from the candidate to every blob within `gap` pixels of it or of a blob already reached
+            member = np.zeros(len(pieces), dtype=bool)
+            member[index] = True
+            frontier = pieces[index:index + 1]
+            while len(frontier):
+                near = ~member & ((pieces[:, None, 0] <= frontier[None, :, 2] + gap) &
+                                  (frontier[None, :, 0] <= pieces[:, None, 2] + gap) &
+                                  (pieces[:, None, 1] <= frontier[None, :, 3] + gap) &
+                                  (frontier[None, :, 1] <= pieces[:, None, 3] + gap)).any(axis=1)
+                member |= near
+                frontier = pieces[near]
+            left, top = pieces[member, :2].min(axis=0).tolist()
+            right, bottom = pieces[member, 2:].max(axis=0).tolist()
+            x0 = max(0, int(left * scale_x) - pad)
+            y0 = max(0, int(top * scale_y) - pad)
+            x1 = min(width, int(math.ceil(right * scale_x)) + pad)
+            y1 = min(height, int(math.ceil(bottom * scale_y)) + pad)
+            rois.append((x0, y0, x1 - x0, y1 - y0))
+        if rois:
+            rois_by_color[color_name] = _merge_rects(rois)
+
+    return _detect_in_rois(frame, rois_by_color, min_area)
+
+def detect_objects(frame, downscale=None, buffers=None, min_area=None):
+    """
+    Detect and classify the objects in a BGR frame (the Section 4 color/shape rules).
+    With a downscale factor above 1 (default COARSE_DOWNSCALE) the coarse-to-fine path is used,
+    otherwise full frames are split across DETECTION_THREADS threads when it is above 1. Working
+    arrays come from `buffers` (a FrameBuffers pool) when given, and objects smaller than
+    min_area (default MIN_CONTOUR_AREA) are ignored.
+    """
+    if downscale is None:
+        downscale = COARSE_DOWNSCALE
+    if downscale > 1:
+        return _detect_coarse_to_fine(frame, downscale, buffers, min_area)
+    if DETECTION_THREADS > 1:
+        return _detect_tiled(frame, DETECTION_THREADS, buffers, min_area)
+    return _detect_full(frame, buffers, min_area)
+
+def draw_detections(frame, detections, scale=1.0):
+    """
+    Draw the contour and label of each classified object onto the frame. When the frame is a
+    resized copy, `scale` maps detection coordinates, line widths and text size onto it.
+    """
+    draw_colors = rule_table.compiled().draw_colors
+    for detection in detections:
+        cX, cY = round(detection.center[0] * scale), round(detection.center[1] * scale)
+        contour = detection.contour if scale == 1.0 else np.round(detection.contour * scale).astype(np.int32)
+        cv2.drawContours(frame, [contour], -1, draw_colors.get(detection.classification, (255, 255, 255)),
+                         _line_width(3, scale))
+        cv2.putText(frame, detection.classification, (cX - round(50 * scale), cY), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.6 * scale, (255, 255, 255), _line_width(2, scale))
+
+def display_size(frame_shape, display_width):
+    """(width, height) of a frame resized to display_width, keeping its aspect ratio"""
+    height, width = frame_shape[:2]
+    aspect_ratio = height / width
+    return display_width, int(display_width * aspect_ratio)
+
+def _line_width(width, scale):
+    """A full-resolution line width at display scale"""
+    return max(1, round(width * scale))
+
+# Static part of the overlay (quadrant grid and center marker) at display resolution, drawn once
+# per (frame size, display size): {sizes: (image, mask)}
+_static_overlays = {}
+
+def static_overlay(frame_size, display_size):
+    """
+    The quadrant grid and center marker of a frame_size (width, height) frame shown at
+    display_size, as a display-sized image and the mask of its drawn pixels (cached).
+    """
+    key = (frame_size, display_size)
+    if key not in _static_overlays:
+        width, height = frame_size
+        scale = display_size[0] / width
+        image = np.zeros((display_size[1], display_size[0], 3), dtype=np.uint8)
+
+        def point(x, y):
+            return round(x * scale), round(y * scale)
+
+        # Precise center lines for even quadrant distribution
+        center_x, center_y = width // 2, height // 2
+        cv2.line(image, point(center_x, 0), point(center_x, height), (128, 128, 128), _line_width(2, scale))
+        cv2.line(image, point(0, center_y), point(width, center_y), (128, 128, 128), _line_width(2, scale))
+
+        # Additional quadrant lines for better visualization
+        quarter_width = width // 4
+        quarter_height = height // 4
+        cv2.line(image, point(quarter_width, 0), point(quarter_width, height), (64, 64, 64), 1)
+        cv2.line(image, point(3 * quarter_width, 0), point(3 * quarter_width, height), (64, 64, 64), 1)
+        cv2.line(image, point(0, quarter_height), point(width, quarter_height), (64, 64, 64), 1)
+        cv2.line(image, point(0, 3 * quarter_height), point(width, 3 * quarter_height), (64, 64, 64), 1)
+
+        # Sniper-style marker at the center
+        marker_color = (0, 255, 255)  # Bright Yellow
+        cv2.circle(image, point(center_x, center_y), round(25 * scale), marker_color, 1)
+        cv2.line(image, point(center_x - 35, center_y), point(center_x + 35, center_y), marker_color, 1)
+        cv2.line(image, point(center_x, center_y - 35), point(center_x, center_y + 35), marker_color, 1)
+        _static_overlays[key] = (image, image.any(axis=2).astype(np.uint8))
+    return _static_overlays[key]
+
+def draw_overlay(display_frame, result, frame_size):
+    """
+    Annotate a display-sized copy of a frame_size (width, height) frame: detections, closest
+    obstacle and command are drawn scaled to it, then the cached static overlay is composited.
+    """
+    display_size = (display_frame.shape[1], display_frame.shape[0])
+    scale = display_size[0] / frame_size[0]
+    draw_detections(display_frame, result.detections, scale)
+    if result.closest_obstacle:
+        cv2.circle(display_frame, (round(result.closest_obstacle[0] * scale), round(result.closest_obstacle[1] * scale)),
+                   round(30 * scale), (0, 255, 255), _line_width(3, scale))
+
+    # Display the final command
+    cv2.putText(display_frame, f"COMMAND: {result.command}", (round(10 * scale), round(30 * scale)),
+                cv2.FONT_HERSHEY_SIMPLEX, scale, (0, 255, 255), _line_width(3, scale))
+
+    image, mask = static_overlay(frame_size, display_size)
+    cv2.copyTo(image, mask, display_frame)
+
+def _split_blob_frame(downscale):
+    """
+    Test frame with a blue square outline that breaks into pieces on the coarse mask: three of
+    its sides are one pixel wide with small dots along them, so at `downscale` only the thick
+    fourth side and the dots (each too small to be a candidate) are left.
+    """
+    frame = np.full((480, 640, 3), 128, dtype=np.uint8)
+    cv2.rectangle(frame, (220, 140), (420, 340), (220, 0, 0), 1)
+    cv2.rectangle(frame, (220, 340 - 2 * downscale), (420, 340), (220, 0, 0), -1)
+    for step in range(0, 201, 4 * downscale):
+        for x, y in ((220 + step, 140), (220, 140 + step), (420, 140 + step)):
+            cv2.rectangle(frame, (x - downscale // 2, y - downscale // 2), (x + downscale // 2, y + downscale // 2),
+                          (220, 0, 0), -1)
+    return frame
+
+def verify_coarse_to_fine(frames, downscale=4):
+    """
+    Check that coarse-to-fine detection classifies the same objects, at the same centroids, as
+    full-resolution processing of the same frames, and of a built-in frame whose blob breaks
+    into pieces on the coarse mask (frame_index None).
+    Returns a list of (frame_index, full_result, coarse_result) for every frame that differs.
+    """
+    mismatches = []
+    for index, frame in itertools.chain([(None, _split_blob_frame(downscale))], enumerate(frames)):
+        full = sorted((d.classification, d.center) for d in detect_objects(frame, downscale=1))
+        coarse = sorted((d.classification, d.center) for d in detect_objects(frame, downscale=downscale))
+        if full != coarse:
+            mismatches.append((index, full, coarse))
+    return mismatches
+
+def verify_prefilter(frames, downscale=1):
+    """
+    Check that the connected-component prefilter classifies the same objects, at the same
+    centroids, as the contour path on the same frames (whatever USE_COMPONENT_PREFILTER says).
+    Returns a list of (frame_index, contour_result, prefilter_result) for every frame that differs.
+    """
+    global USE_COMPONENT_PREFILTER
+    mode = USE_COMPONENT_PREFILTER
+    mismatches = []
+    try:
+        for index, frame in enumerate(frames):
+            USE_COMPONENT_PREFILTER = False
+            contour = sorted((d.classification, d.center) for d in detect_objects(frame, downscale=downscale))
+            USE_COMPONENT_PREFILTER = True
+            prefilter = sorted((d.classification, d.center) for d in detect_objects(frame, downscale=downscale))
+            if contour != prefilter:
+                mismatches.append((index, contour, prefilter))
+    finally:
+        USE_COMPONENT_PREFILTER = mode
+    return mismatches
+
+# -------------------------------------------------------------------------------------------------------
+#                              SECTION 2C: OBSTACLE AVOIDANCE DECISION
+# -------------------------------------------------------------------------------------------------------
+
+# Animation targets (roll, pitch, elevator) for each avoidance command. The diagonal commands of
+# the grid planner combine a roll and a pitch, each scaled by 1/sqrt(2).
+COMMAND_TARGETS = {
+    "Clear": (0.0, 0.0, 0.0),
+    "Roll Left": (-35, 0.0, 0.0),     # Roll left
+    "Roll Right": (35, 0.0, 0.0),     # Roll right
+    "Pitch Up": (0.0, 20, -15),       # Climb, elevator up (negative deflection)
+    "Pitch Down": (0.0, -20, 15),     # Dive, elevator down (positive deflection)
+    "Pitch Up Left": (-25, 14, -11),
+    "Pitch Up Right": (25, 14, -11),
+    "Pitch Down Left": (-25, -14, 11),
+    "Pitch Down Right": (25, -14, 11),
+}
+
+# Escape directions of the grid planner, as unit (dx, dy) steps in image coordinates (y down).
+AVOIDANCE_DIRECTIONS = {
+    "Roll Left": (-1.0, 0.0),
+    "Roll Right": (1.0, 0.0),
+    "Pitch Up": (0.0, -1.0),
+    "Pitch Down": (0.0, 1.0),
+    "Pitch Up Left": (-math.sqrt(0.5), -math.sqrt(0.5)),
+    "Pitch Up Right": (math.sqrt(0.5), -math.sqrt(0.5)),
+    "Pitch Down Left": (-math.sqrt(0.5), math.sqrt(0.5)),
+    "Pitch Down Right": (math.sqrt(0.5), math.sqrt(0.5)),
+}
+AVOIDANCE_GRID = 4   # Cells across and down; their edges fall on the quadrant lines of the overlay
+
+_DIRECTION_VECTORS = np.array(list(AVOIDANCE_DIRECTIONS.values()))
+_AVOIDANCE_COMMANDS = list(AVOIDANCE_DIRECTIONS)
+
+def _obstacle_positions(dangerous_obstacles):
+    """(N, 2) float array of obstacle positions; fromiter is about twice as fast as asarray on tuples"""
+    if isinstance(dangerous_obstacles, np.ndarray):
+        return dangerous_obstacles.reshape(-1, 2)
+    return np.fromiter(itertools.chain.from_iterable(dangerous_obstacles), np.float64,
+                       2 * len(dangerous_obstacles)).reshape(-1, 2)
+
+def occupancy_grid(dangerous_obstacles, frame_center, areas=None, extent=None):
+    """
+    Rasterize dangerous obstacles into the AVOIDANCE_GRID x AVOIDANCE_GRID occupancy grid around
+    frame_center, each weighted by its area (1 when areas is None) and by its closeness to the
+    center. Returns a (3, grid, grid) array: per cell, the summed weight and the weighted sum of
+    the unit (dx, dy) directions from frame_center to its obstacles, so costs use where the
+    obstacles actually are rather than the cell center. `extent` is the (x, y) half size the
+    grid covers, by default the frame_center itself; obstacles beyond it land in the border cells.
+    """
+    offsets = _obstacle_positions(dangerous_obstacles) - frame_center
+    scaled = offsets / (frame_center if extent is None else extent)
+    weights = np.ones(len(offsets)) if areas is None else np.asarray(areas, dtype=np.float64)
+    weights = weights / (1 + (scaled ** 2).sum(axis=1) / AVOIDANCE_DISTANCE_SCALE ** 2)
+    lengths = np.hypot(offsets[:, 0], offsets[:, 1])
+    directions = offsets * (weights / np.where(lengths > 0, lengths, 1))[:, None]
+    cells = np.clip(np.floor((scaled + 1) * (AVOIDANCE_GRID / 2)), 0, AVOIDANCE_GRID - 1).astype(np.intp)
+    index = cells[:, 1] * AVOIDANCE_GRID + cells[:, 0]
+    grid = np.stack([np.bincount(index, weights, minlength=AVOIDANCE_GRID ** 2),
+                     np.bincount(index, directions[:, 0], minlength=AVOIDANCE_GRID ** 2),
+                     np.bincount(index, directions[:, 1], minlength=AVOIDANCE_GRID ** 2)])
+    return grid.reshape(3, AVOIDANCE_GRID, AVOIDANCE_GRID)
+
+def avoidance_costs(grid):
+    """
+    Cost of every escape direction (in AVOIDANCE_DIRECTIONS order) for an occupancy grid: each
+    cell's weight times how much its obstacles are in the way, from the angle between the
+    direction and the cell's mean obstacle direction. Straight ahead costs 1, straight behind
+    nothing, with a steep falloff in between so one open side beats a crowded one.
+    """
+    weights, sums = grid[0].ravel(), grid[1:].reshape(2, -1)
+    lengths = np.hypot(sums[0], sums[1])
+    cosines = (_DIRECTION_VECTORS @ sums) / np.where(lengths > 0, lengths, 1)
+    return ((1 + cosines) / 2) ** 2 @ weights
+
+def compute_avoidance(dangerous_obstacles, frame_center, areas=None, extent=None):
+    """
+    Pick the avoidance command for the dangerous obstacles (a list of (x, y) or an (N, 2) array),
+    with the AVOIDANCE_PLANNER. Returns (command, closest_obstacle); closest_obstacle is an (x, y)
+    tuple, or None when the path is clear. areas and extent are only used by the grid planner
+    (see occupancy_grid()).
+    """
+    if len(dangerous_obstacles) == 0:
+        return "Clear", None
+
+    frame_center_x, frame_center_y = frame_center
+    if AVOIDANCE_PLANNER == "grid":
+        positions = _obstacle_positions(dangerous_obstacles)
+        closest = int(np.argmin(((positions - frame_center) ** 2).sum(axis=1)))
+        costs = avoidance_costs(occupancy_grid(positions, frame_center, areas, extent))
+        closest_obstacle = dangerous_obstacles[closest]
+        if isinstance(closest_obstacle, np.ndarray):
+            closest_obstacle = tuple(closest_obstacle.tolist())
+        return _AVOIDANCE_COMMANDS[int(np.argmin(costs))], closest_obstacle
+
+    if isinstance(dangerous_obstacles, np.ndarray):
+        dangerous_obstacles = [tuple(position) for position in dangerous_obstacles.reshape(-1, 2).tolist()]
+
+    closest_obstacle = min(dangerous_obstacles,
+                           key=lambda pos: math.sqrt((pos[0] - frame_center_x)**2 + (pos[1] - frame_center_y)**2))
+
+    dx = closest_obstacle[0] - frame_center_x
+    dy = closest_obstacle[1] - frame_center_y
+
+    if abs(dx) > abs(dy):
+        if dx > 0:
+            command = "Roll Left"
+        else:
+            command = "Roll Right"
+    else:
+        if dy > 0:
+            command = "Pitch Up"
+        else:
+            command = "Pitch Down"
+    return command, closest_obstacle
+
+# -------------------------------------------------------------------------------------------------------
+#                      SECTION 2D: OBSTACLE TRACKING AND COMMAND HYSTERESIS
+# -------------------------------------------------------------------------------------------------------
+
+class Track:
+    """One tracked object: a constant-velocity Kalman filter plus its latest detection"""
+
+    def __init__(self, track_id, detection):
+        self.track_id = track_id
+        self.detection = detection
+        self.hits = 1          # Frames in which the object was detected
+        self.misses = 0        # Consecutive frames in which it was not
+        (x, y), (w, h) = detection.center, cv2.boundingRect(detection.contour)[2:]
+        self.size = max(w, h)
+
+        self.kalman = cv2.KalmanFilter(4, 2)
+        self.kalman.transitionMatrix = np.array([[1, 0, 1, 0], [0, 1, 0, 1], [0, 0, 1, 0], [0, 0, 0, 1]], np.float32)
+        self.kalman.measurementMatrix = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], np.float32)
+        self.kalman.processNoiseCov = np.diag([1.0, 1.0, 4.0, 4.0]).astype(np.float32)
+        self.kalman.measurementNoiseCov = np.eye(2, dtype=np.float32) * 4.0
+        self.kalman.errorCovPost = np.diag([4.0, 4.0, 100.0, 100.0]).astype(np.float32)
+        self.kalman.statePost = np.array([[x], [y], [0], [0]], np.float32)
+        self.center = (x, y)
+
+    def predict(self):
+        state = self.kalman.predict()
+        self.center = (int(state[0, 0]), int(state[1, 0]))
+        return self.center
+
+    def correct(self, detection):
+        self.kalman.correct(np.array([[detection.center[0]], [detection.center[1]]], np.float32))
+        self.detection = detection
+        self.center = detection.center
+        self.size = max(cv2.boundingRect(detection.contour)[2:])
+        self.hits += 1
+        self.misses = 0
+
+    def search_window(self, frame_shape, margin=1.0, pad=16):
+        """Full-resolution (x, y, w, h) window around the predicted position"""
+        height, width = frame_shape[:2]
+        half = int(self.size * (0.5 + margin)) + pad
+        x0, y0 = max(0, self.center[0] - half), max(0, self.center[1] - half)
+        x1, y1 = min(width, self.center[0] + half), min(height, self.center[1] + half)
+        return (x0, y0, max(1, x1 - x0), max(1, y1 - y0))
+
+class ObstacleTracker:
+    """
+    Multi-object centroid tracker for the Section 4 classifications. Most frames only search small
+    windows around each track's Kalman-predicted position; the full frame is searched every
+    `full_search_interval` frames, when there are no tracks, or after a track was lost.
+    """
+
+    def __init__(self, full_search_interval=TRACKER_FULL_SEARCH_INTERVAL, max_misses=3, min_hits=2,
+                 gate_distance=80, downscale=None, buffers=None):
+        self.full_search_interval = full_search_interval
+        self.max_misses = max_misses
+        self.min_hits = min_hits          # Detections needed before a track is reported
+        self.gate_distance = gate_distance
+        self.downscale = downscale
+        self.buffers = buffers            # FrameBuffers pool for full-frame searches
+        self.tracks = []
+        self.full_searches = 0
+        self.window_searches = 0
+        self._next_id = 1
+        self._frame_index = 0
+        self._needs_full_search = True
+
+    def _associate(self, detections):
+        """Greedy nearest-neighbour matching of detections to tracks of the same classification"""
+        pairs = []
+        for track in self.tracks:
+            gate = max(self.gate_distance, track.size)
+            for index, detection in enumerate(detections):
+                if detection.classification != track.detection.classification:
+                    continue
+                distance = math.hypot(detection.center[0] - track.center[0], detection.center[1] - track.center[1])
+                if distance <= gate:
+                    pairs.append((distance, track.track_id, index))
+        pairs.sort()
+        matches = {}
+        used = set()
+        for distance, track_id, index in pairs:
+            if track_id in matches or index in used:
+                continue
+            matches[track_id] = index
+            used.add(index)
+        return matches, [detection for index, detection in enumerate(detections) if index not in used]
+
+    def update(self, frame, min_area=None):
+        """Track objects into a new frame and return the detections of the confirmed tracks"""
+        for track in self.tracks:
+            track.predict()
+
+        full_search = (self._needs_full_search or not self.tracks or
+                       self._frame_index % self.full_search_interval == 0)
+        self._frame_index += 1
+        if full_search:
+            self.full_searches += 1
+            detections = detect_objects(frame, downscale=self.downscale, buffers=self.buffers, min_area=min_area)
+        else:
+            self.window_searches += 1
+            rois_by_color = {}
+            for track in self.tracks:
+                rois_by_color.setdefault(track.detection.color, []).append(track.search_window(frame.shape))
+            detections = _detect_in_rois(frame, {color_name: _merge_rects(rois)
+                                                 for color_name, rois in rois_by_color.items()}, min_area)
+        self._needs_full_search = False
+
+        matches, unmatched = self._associate(detections)
+        surviving = []
+        for track in self.tracks:
+            if track.track_id in matches:
+                track.correct(detections[matches[track.track_id]])
+            else:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    self._needs_full_search = True  # Lost: look for it everywhere next frame
+                    continue
+            surviving.append(track)
+        for detection in unmatched:
+            surviving.append(Track(self._next_id, detection))
+            self._next_id += 1
+        self.tracks = surviving
+
+        results = []
+        for track in self.tracks:
+            if track.hits < self.min_hits:
+                continue
+            detection = track.detection
+            if track.misses:
+                # Coasting: shift the last contour to the predicted position
+                dx, dy = track.center[0] - detection.center[0], track.center[1] - detection.center[1]
+                shift = np.array([dx, dy], dtype=detection.contour.dtype)
+                detection = detection._replace(contour=detection.contour + shift, center=track.center)
+            results.append(detection)
+        return results
+
+    def dangerous_tracks(self):
+        """(track_id, center, area) of every confirmed dangerous-obstacle track"""
+        return [(track.track_id, track.center, track.detection.area) for track in self.tracks
+                if track.hits >= self.min_hits and is_dangerous(track.detection.classification)]
+
+class AvoidanceHysteresis:
+    """
+    Avoidance decision with memory: it sticks to the track it is avoiding until another obstacle is
+    clearly closer, needs a clear margin before switching between rolling and pitching (with the
+    grid planner: before leaving a direction that costs at most `axis_margin` more than the best
+    one), and only issues a new command after it has been chosen for `confirm_frames` frames in a row.
+    """
+
+    def __init__(self, switch_ratio=0.8, axis_margin=0.2, confirm_frames=2):
+        self.switch_ratio = switch_ratio
+        self.axis_margin = axis_margin
+        self.confirm_frames = confirm_frames
+        self.command = "Clear"
+        self.target_id = None
+        self._candidate = None
+        self._candidate_frames = 0
+
+    def update(self, dangerous_tracks, frame_center):
+        """Returns (command, closest_obstacle) like compute_avoidance()"""
+        frame_center_x, frame_center_y = frame_center
+
+        def distance(track):
+            return math.hypot(track[1][0] - frame_center_x, track[1][1] - frame_center_y)
+
+        target = None
+        if dangerous_tracks:
+            closest = min(dangerous_tracks, key=distance)
+            current = next((track for track in dangerous_tracks if track[0] == self.target_id), None)
+            if current is not None and distance(closest) >= self.switch_ratio * distance(current):
+                target = current
+            else:
+                target = closest
+        self.target_id = target[0] if target else None
+
+        candidate = "Clear"
+        if target and AVOIDANCE_PLANNER == "grid":
+            costs = avoidance_costs(occupancy_grid([track[1] for track in dangerous_tracks], frame_center,
+                                                   [track[2] for track in dangerous_tracks]))
+            candidate = _AVOIDANCE_COMMANDS[int(np.argmin(costs))]
+            if self.command in AVOIDANCE_DIRECTIONS and \
+                    costs[_AVOIDANCE_COMMANDS.index(self.command)] <= costs.min() * (1 + self.axis_margin):
+                candidate = self.command
+        elif target:
+            dx = target[1][0] - frame_center_x
+            dy = target[1][1] - frame_center_y
+            if self.command.startswith("Roll"):
+                horizontal = abs(dy) <= abs(dx) * (1 + self.axis_margin)
+            elif self.command.startswith("Pitch"):
+                horizontal = abs(dx) > abs(dy) * (1 + self.axis_margin)
+            else:
+                horizontal = abs(dx) > abs(dy)
+            if horizontal:
+                candidate = "Roll Left" if dx > 0 else "Roll Right"
+            else:
+                candidate = "Pitch Up" if dy > 0 else "Pitch Down"
+
+        if candidate == self.command:
+            self._candidate, self._candidate_frames = None, 0
+        elif candidate == self._candidate:
+            self._candidate_frames += 1
+        else:
+            self._candidate, self._candidate_frames = candidate, 1
+        if self._candidate_frames >= self.confirm_frames:
+            self.command = candidate
+            self._candidate, self._candidate_frames = None, 0
+
+        return self.command, (target[1] if target else None)
+
+# -------------------------------------------------------------------------------------------------------
+#                           SECTION 2E: COMMAND STATE BUS AND FRAME PACING
+# -------------------------------------------------------------------------------------------------------
+
+# Immutable snapshot of the avoidance state, published once per processed frame. `version` grows
+# by one on every publish; `obstacle_offset` is the closest obstacle's (dx, dy) from the frame center.
+FlightState = namedtuple('FlightState', ['version', 'seq', 'timestamp', 'command', 'target_roll',
+                                         'target_pitch', 'target_elevator', 'closest_obstacle',
+                                         'obstacle_offset'])
+
+class StateBus:
+    """
+    Hands the latest FlightState from the processing thread to any number of consumers.
+    A publish replaces the whole snapshot under a lock, so readers never see a new command with
+    old targets. Consumers can poll latest() (comparing versions), block in wait_for() until a
+    newer version exists, or subscribe a callback that runs on the publishing thread.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = FlightState(0, 0, None, "Clear", *COMMAND_TARGETS["Clear"], None, None)
+        self._subscribers = []
+
+    def publish(self, seq, timestamp, command, closest_obstacle=None, frame_center=None):
+        """Publish the command decided for frame `seq` and return the new snapshot"""
+        obstacle_offset = None
+        if closest_obstacle is not None and frame_center is not None:
+            obstacle_offset = (closest_obstacle[0] - frame_center[0], closest_obstacle[1] - frame_center[1])
+        with self._condition:
+            state = FlightState(self._state.version + 1, seq, timestamp, command,
+                                *COMMAND_TARGETS[command], closest_obstacle, obstacle_offset)
+            self._state = state
+            subscribers = list(self._subscribers)
+            self._condition.notify_all()
+        for callback in subscribers:
+            callback(state)
+        return state
+
+    def latest(self):
+        return self._state
+
+    def wait_for(self, version, timeout=None):
+        """Block until a snapshot newer than `version` is published; returns the latest snapshot"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._state.version > version, timeout)
+            return self._state
+
+    def subscribe(self, callback):
+        with self._condition:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._condition:
+            self._subscribers.remove(callback)
+
+# Shared bus the processing loops publish to.
+state_bus = StateBus()
+
+class FramePacer:
+    """
+    Paces a loop to `target_fps` using absolute deadlines. wait() sleeps only for what is left of
+    the frame budget after processing; a frame that overran its budget is not made up for by
+    rushing later ones. target_fps=None is max-throughput mode and never sleeps.
+    """
+
+    def __init__(self, target_fps=None):
+        self.interval = 1.0 / target_fps if target_fps else 0.0
+        self.late_frames = 0
+        self._deadline = None
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self._deadline is None:
+            self._deadline = now
+        self._deadline += self.interval
+        remaining = self._deadline - now
+        if remaining > 0:
+            time.sleep(remaining)
+        else:
+            # Over budget: start the next frame's budget from now
+            self.late_frames += 1
+            self._deadline = now
+
+# -------------------------------------------------------------------------------------------------------
+#                              SECTION 2F: UDP COMMAND OUTPUT
+# -------------------------------------------------------------------------------------------------------
+
+# Wire codes of the avoidance commands. Codes 5-8, the diagonal commands, only come from the
+# grid planner.
+COMMAND_CODES = {"Clear": 0, "Roll Left": 1, "Roll Right": 2, "Pitch Up": 3, "Pitch Down": 4,
+                 "Pitch Up Left": 5, "Pitch Up Right": 6, "Pitch Down Left": 7, "Pitch Down Right": 8}
+COMMAND_NAMES = {code: command for command, code in COMMAND_CODES.items()}
+
+# Fixed-size little-endian command packet (33 bytes): magic, version, frame sequence number,
+# capture timestamp (time.monotonic seconds), command code, flags, target roll/pitch/elevator, and
+# the closest obstacle's offset from the frame center in pixels (dx, dy).
+COMMAND_PACKET = struct.Struct('<2sBIdBBfffhh')
+COMMAND_PACKET_MAGIC = b'FC'
+COMMAND_PACKET_VERSION = 1
+PACKET_FLAG_OBSTACLE = 0x01   # dx, dy are valid
+PACKET_FLAG_KEEPALIVE = 0x02  # Repeat of an unchanged command
+
+CommandPacket = namedtuple('CommandPacket', ['seq', 'timestamp', 'command', 'flags', 'target_roll',
+                                             'target_pitch', 'target_elevator', 'dx', 'dy'])
+
+def encode_command_packet(state, flags=0):
+    """Pack a FlightState into a command packet"""
+    dx, dy = state.obstacle_offset or (0, 0)
+    if state.obstacle_offset is not None:
+        flags |= PACKET_FLAG_OBSTACLE
+    return COMMAND_PACKET.pack(COMMAND_PACKET_MAGIC, COMMAND_PACKET_VERSION, state.seq & 0xFFFFFFFF,
+                               state.timestamp or 0.0, COMMAND_CODES[state.command], flags,
+                               state.target_roll, state.target_pitch, state.target_elevator,
+                               max(-32768, min(32767, dx)), max(-32768, min(32767, dy)))
+
+def decode_command_packet(data):
+    """Unpack a command packet into a CommandPacket; raises ValueError if it isn't one"""
+    if len(data) != COMMAND_PACKET.size:
+        raise ValueError(f"Command packet must be {COMMAND_PACKET.size} bytes, got {len(data)}")
+    magic, version, seq, timestamp, code, flags, roll, pitch, elevator, dx, dy = COMMAND_PACKET.unpack(data)
+    if magic != COMMAND_PACKET_MAGIC or version != COMMAND_PACKET_VERSION:
+        raise ValueError("Not a version %d command packet" % COMMAND_PACKET_VERSION)
+    return CommandPacket(seq, timestamp, COMMAND_NAMES[code], flags, roll, pitch, elevator, dx, dy)
+
+class CommandSender:
+    """
+    Sends state bus snapshots to the flight controller as command packets over a non-blocking UDP
+    socket (subscribe it to a StateBus). Unchanged commands are deduplicated, except for a
+    keepalive repeat every `keepalive_interval` seconds, and no more than `max_rate_hz` packets
+    are sent per second; a command change held back by the rate limit goes out with the next
+    publish after the interval. Sending never blocks the processing thread: packets the socket
+    can't take right away are counted as dropped.
+    """
+
+    def __init__(self, address, max_rate_hz=UDP_MAX_RATE_HZ, keepalive_interval=UDP_KEEPALIVE_INTERVAL):
+        self.address = address
+        self.min_interval = 1.0 / max_rate_hz if max_rate_hz else 0.0
+        self.keepalive_interval = keepalive_interval
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.packets_sent = 0
+        self.packets_deduplicated = 0
+        self.packets_rate_limited = 0
+        self.packets_dropped = 0
+        self._last_command = None
+        self._last_sent = -math.inf
+
+    def __call__(self, state):
+        self.send(state)
+
+    def send(self, state):
+        """Send a snapshot if it is due; returns whether a packet was sent"""
+        now = time.monotonic()
+        changed = state.command != self._last_command
+        keepalive = not changed and now - self._last_sent >= self.keepalive_interval
+        if not changed and not keepalive:
+            self.packets_deduplicated += 1
+            return False
+        if now - self._last_sent < self.min_interval:
+            self.packets_rate_limited += 1
+            return False
+        try:
+            self.sock.sendto(encode_command_packet(state, PACKET_FLAG_KEEPALIVE if keepalive else 0), self.address)
+        except OSError:
+            # Full socket buffer, or an ICMP error from an earlier packet: drop, never block
+            self.packets_dropped += 1
+            return False
+        self.packets_sent += 1
+        self._last_command = state.command
+        self._last_sent = now
+        return True
+
+    def close(self):
+        self.sock.close()
+
+class CommandReceiver:
+    """
+    Loopback stand-in for the flight controller: a thread that receives command packets and
+    records the latency from frame capture to packet arrival. The capture timestamp is
+    time.monotonic(), so the receiver has to run on the same machine as the sender.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.1)
+        self.address = self.sock.getsockname()
+        self.packets = []
+        self.latencies = []
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._receive_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def _receive_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                data = self.sock.recv(COMMAND_PACKET.size + 1)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            received = time.monotonic()
+            try:
+                packet = decode_command_packet(data)
+            except (ValueError, KeyError):
+                continue
+            self.packets.append(packet)
+            self.latencies.append(received - packet.timestamp)
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+        self.sock.close()
+
+# -------------------------------------------------------------------------------------------------------
+#                           SECTION 2G: DEADLINE-AWARE LOAD SHEDDING
+# -------------------------------------------------------------------------------------------------------
+
+class LoadShedder:
+    """
+    Keeps command latency bounded under load instead of maximizing visual quality. The
+    processing time of each frame is smoothed and compared with the per-frame deadline; while
+    it overruns, the shedder degrades one level at a time, each level keeping the measures of
+    the ones below:
+        1: skip overlay drawing
+        2: detect at half resolution
+        3: process only every other frame (the per-frame budget doubles)
+        4: double the minimum contour area
+    Once the time has stayed well under the budget of the level below for a while, it recovers
+    one level. A level that is left again right after recovering to it waits twice as long
+    before the next attempt. Every level change is printed with its reason and kept in `decisions`.
+    The deadline defaults to FRAME_DEADLINE; 0 disables shedding.
+    """
+
+    LEVELS = ("full quality", "overlay skipped", "half resolution", "every other frame", "raised area threshold")
+
+    def __init__(self, deadline=None, smoothing=0.2, recover_ratio=0.5, escalate_frames=5,
+                 recover_frames=60):
+        self.deadline = FRAME_DEADLINE if deadline is None else deadline
+        self.smoothing = smoothing
+        self.recover_ratio = recover_ratio
+        self.escalate_frames = escalate_frames
+        self.recover_frames = recover_frames
+        self.level = 0
+        self.frame_time = None        # Smoothed processing time (s) at the current level
+        self.decisions = []           # (frame_seq, level, reason)
+        self.frames_skipped = 0
+        self._frames_at_level = 0
+        self._recover_holds = {}      # level -> frames to wait before recovering from it
+        self._skip_next = False
+
+    @property
+    def draw_overlay(self):
+        return self.level < 1
+
+    @property
+    def resolution_scale(self):
+        return 2 if self.level >= 2 else 1
+
+    @property
+    def min_area(self):
+        """Minimum contour area to detect with, or None for MIN_CONTOUR_AREA"""
+        return MIN_CONTOUR_AREA * 2 if self.level >= 4 else None
+
+    def _budget(self, level):
+        return self.deadline * (2 if level >= 3 else 1)
+
+    def should_process(self):
+        """Whether the next frame should be processed (False for the frames skipped at level 3+)"""
+        if self.level < 3:
+            return True
+        self._skip_next = not self._skip_next
+        if self._skip_next:
+            return True
+        self.frames_skipped += 1
+        return False
+
+    def update(self, frame_time, frame_seq=0):
+        """Account for the processing time (s) of one frame and change level if needed"""
+        if not self.deadline:
+            return
+        if self.frame_time is None:
+            self.frame_time = frame_time
+        else:
+            self.frame_time += self.smoothing * (frame_time - self.frame_time)
+        self._frames_at_level += 1
+
+        budget_ms = self._budget(self.level) * 1000.0
+        if (self.level < len(self.LEVELS) - 1 and self._frames_at_level >= self.escalate_frames and
+                self.frame_time > self._budget(self.level)):
+            hold = self._recover_holds.get(self.level + 1, self.recover_frames)
+            if self._frames_at_level < hold:
+                # Recovering to this level didn't last: wait longer before trying again
+                self._recover_holds[self.level + 1] = min(16 * self.recover_frames, 2 * hold)
+            self._change_level(self.level + 1, frame_seq,
+                               f"frame time {self.frame_time * 1000.0:.1f} ms over the {budget_ms:.0f} ms budget")
+        elif self.level > 0:
+            lower_budget = self._budget(self.level - 1)
+            if self.frame_time >= self.recover_ratio * lower_budget:
+                return
+            hold = self._recover_holds.get(self.level, self.recover_frames)
+            if self._frames_at_level >= hold:
+                self._change_level(self.level - 1, frame_seq,
+                                   f"frame time {self.frame_time * 1000.0:.1f} ms, under "
+                                   f"{self.recover_ratio * lower_budget * 1000.0:.1f} ms for {hold} frames")
+
+    def _change_level(self, level, frame_seq, reason):
+        if level < self.level and self._frames_at_level >= 2 * self._recover_holds.get(self.level, self.recover_frames):
+            self._recover_holds.pop(self.level, None)  # Load has been low for long: forget the back-off
+        self.level = level
+        self.frame_time = None
+        self._frames_at_level = 0
+        self.decisions.append((frame_seq, level, reason))
+        print(f"[frame {frame_seq}] Load shedding level {level} ({self.LEVELS[level]}): {reason}", flush=True)
 
 # -------------------------------------------------------------------------------------------------------
-#                                           SECTION 1: SETUP
+#                               SECTION 2H: MOTION-GATED PROCESSING
 # -------------------------------------------------------------------------------------------------------
 
-# Using your saved port for the video stream.
-video_url = "http://192.168.0.155:8080/video"
+def _rects_overlap(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    return ax < bx + bw and bx < ax + aw and ay < by + bh and by < ay + ah
 
-# Initialize the video capture object.
-cap = cv2.VideoCapture(video_url)
+class MotionGate:
+    """
+    Cheap change detector deciding how much of each frame needs detection. The frame is reduced
+    to a small image, `cell` pixels per tile of the grid, and compared with the image detection
+    last ran on; a tile has changed when any channel of any of its pixels moved by more than the
+    threshold. Color is kept because detection is by color: a green object on a gray background
+    barely changes the gray level. check() returns one of:
+        "reuse"   - no tile changed: keep the previous detections and command
+        "partial" - a few tiles changed: re-detect only inside the returned (x, y, w, h) regions
+        "full"    - too many tiles changed, the frame size or scale changed, or the last full
+                    detection is max_stale frames old
+    Comparing against the last detected image rather than the previous frame means slow drift
+    still adds up to a change. record() collects the decisions and an estimate of the CPU time
+    saved against running full detection on every frame.
+    """
 
-# Check if the video stream was opened successfully.
-if not cap.isOpened():
-    sys.exit("Error: Could not open video stream.")
+    DECISIONS = ("reuse", "partial", "full")
 
-# Define the lower and upper bounds for each color in the HSV color space.
-color_ranges = {
-    'red': {
-        'lower1': np.array([0, 120, 70]),
-        'upper1': np.array([10, 255, 255]),
-        'lower2': np.array([170, 120, 70]),
-        'upper2': np.array([180, 255, 255])
-    },
-    'green': {
-        'lower': np.array([36, 100, 100]),
-        'upper': np.array([86, 255, 255])
-    },
-    'blue': {
-        'lower': np.array([94, 120, 100]),
-        'upper': np.array([126, 255, 255])
-    }
-}
+    def __init__(self, buffers=None, grid=None, threshold=None, max_stale=None, full_fraction=None, cell=8):
+        self.buffers = FrameBuffers() if buffers is None else buffers
+        self.grid = MOTION_GRID if grid is None else grid
+        self.threshold = MOTION_PIXEL_THRESHOLD if threshold is None else threshold
+        self.max_stale = MOTION_MAX_STALE_FRAMES if max_stale is None else max_stale
+        self.full_fraction = MOTION_FULL_FRACTION if full_fraction is None else full_fraction
+        self.cell = cell
+        self.counts = dict.fromkeys(self.DECISIONS, 0)
+        self.seconds = dict.fromkeys(self.DECISIONS, 0.0)
+        self.reference = None
+        self._key = None              # (frame shape, scale) the reference belongs to
+        self._stale = 0
+
+    def _small(self, frame):
+        tiles_x, tiles_y = self.grid
+        small_shape = (tiles_y * self.cell, tiles_x * self.cell, 3)
+        with tracer.span("motion"):
+            return cv2.resize(frame, small_shape[1::-1], dst=self.buffers.get("motion_small", small_shape),
+                              interpolation=cv2.INTER_AREA)
+
+    def check(self, frame, scale=1):
+        """Decide how to process the frame: ("reuse" | "partial" | "full", regions or None)"""
+        small = self._small(frame)
+        key = (frame.shape, scale)
+        if self.reference is None or key != self._key or self._stale + 1 >= self.max_stale:
+            self.reference = small.copy()
+            self._key = key
+            self._stale = 0
+            return "full", None
+        self._stale += 1
+
+        tiles_x, tiles_y = self.grid
+        with tracer.span("motion"):
+            diff = cv2.absdiff(small, self.reference, dst=self.buffers.get("motion_diff", small.shape))
+            changed = (diff > self.threshold).reshape(tiles_y, self.cell, tiles_x, self.cell * 3).any(axis=(1, 3))
+        changed_tiles = int(np.count_nonzero(changed))
+        if not changed_tiles:
+            return "reuse", None
+        if scale != 1 or changed_tiles > self.full_fraction * changed.size:
+            self.reference[...] = small
+            self._stale = 0
+            return "full", None
+
+        # Changed tiles grown by one tile, so objects moving across a tile border stay inside
+        regions = cv2.dilate(changed.view(np.uint8), np.ones((3, 3), np.uint8))
+        redetected = regions.astype(bool)
+        tiles_shape = (tiles_y, self.cell, tiles_x, self.cell * 3)
+        self.reference.reshape(tiles_shape).swapaxes(1, 2)[redetected] = \
+            small.reshape(tiles_shape).swapaxes(1, 2)[redetected]
+        height, width = frame.shape[:2]
+        tile_w, tile_h = width / tiles_x, height / tiles_y
+        _, _, stats, _ = cv2.connectedComponentsWithStats(regions, connectivity=8)
+        rects = []
+        for x, y, w, h in stats[1:, :4].tolist():
+            x0, y0 = int(x * tile_w), int(y * tile_h)
+            x1, y1 = min(width, int(math.ceil((x + w) * tile_w))), min(height, int(math.ceil((y + h) * tile_h)))
+            rects.append((x0, y0, x1 - x0, y1 - y0))
+        return "partial", rects
+
+    def record(self, decision, seconds):
+        """Account for one processed frame: the gate's decision and the time (s) processing took"""
+        self.counts[decision] += 1
+        self.seconds[decision] += seconds
+
+    @property
+    def skipped_fraction(self):
+        """Fraction of frames that reused the previous result"""
+        frames = sum(self.counts.values())
+        return self.counts["reuse"] / frames if frames else 0.0
+
+    @property
+    def cpu_saved(self):
+        """Estimated seconds saved: every gated frame priced at the mean full-detection time"""
+        if not self.counts["full"]:
+            return 0.0
+        full_time = self.seconds["full"] / self.counts["full"]
+        return sum(self.counts[d] * full_time - self.seconds[d] for d in ("reuse", "partial"))
+
+    def summary(self):
+        spent = sum(self.seconds.values())
+        saved = self.cpu_saved
+        return (f"{self.skipped_fraction:.0%} of frames reused, {self.counts['partial']} partial, "
+                f"{self.counts['full']} full; ~{saved:.2f} s CPU saved "
+                f"({saved / (saved + spent) if saved + spent > 0 else 0.0:.0%})")
 
 # -------------------------------------------------------------------------------------------------------
-#                                SECTION 2: SHAPE DETECTION FUNCTION
+#                       SECTION 3: CORE VIDEO PROCESSING (FRAME PROCESSOR ENGINE)
 # -------------------------------------------------------------------------------------------------------
 
-def detect_shape(contour):
+# Outcome of one processed frame: the classified objects and the avoidance decision.
+FrameResult = namedtuple('FrameResult', ['seq', 'timestamp', 'detections', 'command', 'closest_obstacle',
+                                         'frame_center'])
+
+class FrameProcessor:
     """
-    Analyzes a contour and returns its shape as a string.
-    Identifies 'triangle', 'square', 'rectangle', or 'circle'.
+    The per-frame engine shared by every processing loop: object detection (Section 4), the
+    avoidance decision (Section 5) and the overlay and display frame (Section 6). Frame-sized
+    working arrays, including the display frame, come from one FrameBuffers pool and are passed
+    to OpenCV as dst= arguments, so they are allocated once per stream resolution.
     """
-    shape = "unknown"
-    perimeter = cv2.arcLength(contour, True)
-    approx = cv2.approxPolyDP(contour, 0.04 * perimeter, True)
-    
-    if len(approx) == 3:
-        shape = "triangle"
-    elif len(approx) == 4:
-        (x, y, w, h) = cv2.boundingRect(approx)
-        aspect_ratio = float(w) / h
-        if 0.90 <= aspect_ratio <= 1.10:
-            shape = "square"
+
+    def __init__(self, tracking=None, downscale=None, bus=None, deadline=None, motion_gate=None):
+        self.buffers = FrameBuffers()
+        self.bus = state_bus if bus is None else bus
+        self.downscale = downscale
+        if tracking is None:
+            tracking = ENABLE_TRACKING
+        self.obstacle_tracker = ObstacleTracker(downscale=downscale, buffers=self.buffers) if tracking else None
+        self.avoidance_hysteresis = AvoidanceHysteresis()
+        self.shedder = LoadShedder(deadline)
+        if motion_gate is None:
+            motion_gate = ENABLE_MOTION_GATE
+        self.motion_gate = MotionGate(self.buffers) if motion_gate else None
+        self._scale = 1
+        self._last_result = None
+
+    def process(self, frame, seq=0, timestamp=None, scale=1, min_area=None):
+        """
+        Detect the objects in a BGR frame and decide the avoidance command. With a scale above 1
+        detection runs on a frame `scale` times smaller (with the area threshold scaled to match);
+        the result is still in full-frame coordinates. With the motion gate, static frames reuse
+        the previous result and frames with a few changed tiles are only re-detected there.
+        """
+        if self.motion_gate is None:
+            return self._process(frame, seq, timestamp, scale, min_area)
+        started = time.perf_counter()
+        decision, regions = self.motion_gate.check(frame, scale)
+        if decision == "reuse" and self._last_result is not None:
+            result = self._last_result._replace(seq=seq, timestamp=timestamp)
+            if metrics:
+                metrics.inc('flight_frames_skipped_total', (('reason', 'motion_gate'),))
+        elif decision == "partial" and self._last_result is not None and not self.obstacle_tracker:
+            result = self._process_regions(frame, seq, timestamp, regions, min_area)
         else:
-            shape = "rectangle"
-    else:
-        area = cv2.contourArea(contour)
-        (x, y), radius = cv2.minEnclosingCircle(contour)
-        if radius > 0:
-            circle_area = np.pi * (radius**2)
-            circularity = area / circle_area
-            if 0.75 < circularity < 1.2:
-                shape = "circle"
-                
-    return shape
+            decision = "full"
+            result = self._process(frame, seq, timestamp, scale, min_area)
+        self._last_result = result
+        self.motion_gate.record(decision, time.perf_counter() - started)
+        return result
+
+    def _process_regions(self, frame, seq, timestamp, regions, min_area=None):
+        """Re-detect inside the changed regions and keep the previous detections elsewhere"""
+        previous = self._last_result.detections
+        height, width = frame.shape[:2]
+        boxes = []
+        pad = 8  # Room for noisy edges and a few pixels of motion: _detect_in_rois skips objects touching a region edge
+        for detection in previous:
+            x, y, w, h = cv2.boundingRect(detection.contour)
+            x0, y0 = max(0, x - pad), max(0, y - pad)
+            boxes.append((x0, y0, min(width, x + w + pad) - x0, min(height, y + h + pad) - y0))
+        # Grow the regions over every previous object they touch, so it is re-detected whole
+        while True:
+            grown = _merge_rects(regions + [box for box in boxes
+                                            if any(_rects_overlap(box, region) for region in regions)])
+            if grown == regions:
+                break
+            regions = grown
+        kept = [d for d, box in zip(previous, boxes) if not any(_rects_overlap(box, region) for region in regions)]
+        detections = kept + _detect_in_rois(frame, {color_name: regions for color_name in detection_colors()}, min_area)
+        dangerous = [d for d in detections if is_dangerous(d.classification)]
+        frame_center = self._last_result.frame_center
+        command, closest_obstacle = compute_avoidance([d.center for d in dangerous], frame_center,
+                                                      [d.area for d in dangerous])
+        return FrameResult(seq, timestamp, detections, command, closest_obstacle, frame_center)
+
+    def _process(self, frame, seq, timestamp, scale=1, min_area=None):
+        height, width = frame.shape[:2]
+        frame_center = (width // 2, height // 2)
+        if scale != self._scale and self.obstacle_tracker:
+            # Tracks can't carry over to another resolution
+            self.obstacle_tracker = ObstacleTracker(downscale=self.downscale, buffers=self.buffers)
+            self.avoidance_hysteresis = AvoidanceHysteresis()
+        self._scale = scale
+        if scale > 1:
+            reduced_shape = (height // scale, width // scale)
+            with tracer.span("downscale"):
+                frame = cv2.resize(frame, reduced_shape[::-1], dst=self.buffers.get("reduced", reduced_shape + (3,)),
+                                   interpolation=cv2.INTER_AREA)
+            min_area = (MIN_CONTOUR_AREA if min_area is None else min_area) / scale ** 2
+        detection_center = (frame.shape[1] // 2, frame.shape[0] // 2)
+
+# -------------------------------------------------------------------------------------------------------
+#                        SECTION 4: OBJECT DETECTION AND CLASSIFICATION
+# -------------------------------------------------------------------------------------------------------
+
+        if self.obstacle_tracker:
+            detections = self.obstacle_tracker.update(frame, min_area)
+        else:
+            detections = detect_objects(frame, downscale=self.downscale, buffers=self.buffers, min_area=min_area)
+
+        # Red Triangles, whose (cX, cY) and areas drive the avoidance decision
+        dangerous = [d for d in detections if is_dangerous(d.classification)]
+
+# -------------------------------------------------------------------------------------------------------
+#                               SECTION 5: OBSTACLE AVOIDANCE LOGIC
+# -------------------------------------------------------------------------------------------------------
+
+        if self.obstacle_tracker:
+            command, closest_obstacle = self.avoidance_hysteresis.update(self.obstacle_tracker.dangerous_tracks(),
+                                                                         detection_center)
+        else:
+            command, closest_obstacle = compute_avoidance([d.center for d in dangerous], detection_center,
+                                                          [d.area for d in dangerous])
+
+        if scale > 1:
+            # Back to full-frame coordinates
+            detections = [d._replace(contour=d.contour * scale, center=(d.center[0] * scale, d.center[1] * scale),
+                                     area=d.area * scale ** 2)
+                          for d in detections]
+            if closest_obstacle:
+                closest_obstacle = (closest_obstacle[0] * scale, closest_obstacle[1] * scale)
+
+        return FrameResult(seq, timestamp, detections, command, closest_obstacle, frame_center)
+
+    def run(self, frame_source, display_width=None, on_result=None, target_fps=None):
+        """
+        Process frames until the source ends or 'q' is pressed, publishing every decision to the
+        state bus. With a display_width the annotated frame is shown in the "Avoidance System"
+        window by a DisplayThread; without one nothing is drawn and no HighGUI call is made.
+        `on_result` is called with the FrameResult of every frame, and frames are paced to
+        `target_fps` if given.
+        The load shedder degrades processing whenever frames overrun the deadline.
+        """
+        try:
+            self._run(frame_source, display_width, on_result, target_fps)
+        finally:
+            if self.motion_gate:
+                print(f"Motion gate: {self.motion_gate.summary()}")
+
+    def _run(self, frame_source, display_width, on_result, target_fps):
+        pacer = FramePacer(target_fps)
+        display = DisplayThread(display_width) if display_width else None
+        try:
+            self._loop(frame_source, display, on_result, pacer)
+        finally:
+            if display:
+                display.close()
+
+    def _loop(self, frame_source, display, on_result, pacer):
+        shedder = self.shedder
+        while True:
+            ret, frame, frame_seq, frame_timestamp = frame_source.read()
+            if not ret:
+                break
+            if not shedder.should_process():
+                if metrics:
+                    metrics.inc('flight_frames_skipped_total', (('reason', 'load_shedding'),))
+                continue
+            started = time.perf_counter()
+            tracer.begin_frame(frame_seq)
+            resolution_scale, min_area = shedder.resolution_scale, shedder.min_area
+            result = self.process(frame, frame_seq, frame_timestamp, resolution_scale, min_area)
+            self.bus.publish(result.seq, result.timestamp, result.command, result.closest_obstacle,
+                             result.frame_center)
+            if on_result:
+                on_result(result)
+
+            if display:
+                display.show(frame, result, overlay=shedder.draw_overlay)
+            tracer.end_frame()
+            elapsed = time.perf_counter() - started
+            shedder.update(elapsed, frame_seq)
+            if metrics:
+                metrics.frame_processed(result.command, [d.classification for d in result.detections],
+                                        round(elapsed * 1e9))
+                metrics.set_gauge('flight_load_shedding_level', shedder.level)
+            # Recorded outside the measured time, so recording never makes the shedder drop quality
+            if flight_recorder:
+                flight_recorder.write(frame, result, resolution_scale, min_area)
+
+            # Exit loop if 'q' is pressed
+            if display and display.closed.is_set():
+                break
+            pacer.wait()
+
+class DisplayThread:
+    """
+    Shows annotated frames in a HighGUI window from its own thread, so a slow window system never
+    holds up detection. show() only resizes the frame to the display width (so the full frame is
+    not kept) and hands it over; the overlay is drawn and shown on the display thread. When that
+    is still busy with an earlier frame, the waiting one is replaced by the newest (latest wins).
+    If showing a frame fails (e.g. OpenCV built without GUI support), the thread stores the
+    error and sets `closed`; later frames are skipped and close() re-raises the error.
+    """
+    def __init__(self, display_width, window_name="Avoidance System"):
+        self.display_width = display_width
+        self.window_name = window_name
+        self.buffers = FrameBuffers()
+        self.closed = threading.Event()  # Set when 'q' is pressed in the window
+        self.shown = 0
+        self.dropped = 0
+        self.skipped = 0        # Frames not shown because the display failed
+        self.error = None
+        self._showing = False   # Whether the display thread holds a frame it has not shown yet
+        self._free = [0, 1, 2]  # Display buffers: one being shown, one waiting, one being filled
+        self._pending = None    # (buffer index, display frame, result, frame size, overlay)
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="display", daemon=True)
+        self._thread.start()
+
+    def show(self, frame, result, overlay=True):
+        """Queue a frame and its FrameResult for display; never waits for the window"""
+        size = display_size(frame.shape, self.display_width)
+        with self._condition:
+            if self.error:
+                self.skipped += 1
+                return
+            index = self._free.pop()
+        with tracer.span("resize"):
+            display_frame = cv2.resize(frame, size, dst=self.buffers.get(f"display{index}", size[::-1] + (3,)))
+        with self._condition:
+            if self._pending:
+                self._free.append(self._pending[0])
+                self.dropped += 1
+                if metrics:
+                    metrics.inc('flight_display_frames_dropped_total')
+            self._pending = (index, display_frame, result, frame.shape[1::-1], overlay)
+            self._condition.notify()
+
+    def _run(self):
+        try:
+            self._show_frames()
+        except Exception as e:
+            with self._condition:
+                self.error = e
+                # The frame being shown and the one waiting (if any) never reach the window
+                self.skipped += self._showing + (self._pending is not None)
+                self._pending = None
+            self.closed.set()
+
+    def _show_frames(self):
+        shown_any = False
+        while True:
+            with self._condition:
+                if self._pending is None and not self._stopping:
+                    self._condition.wait(0.05)
+                pending, self._pending = self._pending, None
+                if pending is None and self._stopping:
+                    return
+            if pending is None:
+                if shown_any and cv2.waitKey(1) & 0xFF == ord('q'):  # Keep the window responsive
+                    self.closed.set()
+                continue
+            self._showing = True
+            index, display_frame, result, frame_size, overlay = pending
+            tracer.attach(result.seq)
 
 # -------------------------------------------------------------------------------------------------------
-#                       SECTION 3: CORE VIDEO PROCESSING (Performance MODE)
+#                            SECTION 6: DISPLAY COMMAND AND VISUAL AIDS
 # -------------------------------------------------------------------------------------------------------
 
-def main_obstacle_detection():
+            if overlay:
+                with tracer.span("overlay"):
+                    draw_overlay(display_frame, result, frame_size)
+            with tracer.span("imshow"):
+                cv2.imshow(self.window_name, display_frame)
+                key = cv2.waitKey(1) & 0xFF
+            shown_any = True
+            with self._condition:
+                self._free.append(index)
+                self.shown += 1
+                self._showing = False
+            if key == ord('q'):
+                self.closed.set()
+
+    def close(self):
+        """
+        Show the last queued frame, stop the thread and report how many frames were dropped.
+        Re-raises the error the display failed with, if any.
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+        if self.error:
+            print(f"Display: {self.shown} frames shown, {self.dropped} dropped while the window was busy, "
+                  f"{self.skipped} skipped after the display failed")
+            raise self.error
+        print(f"Display: {self.shown} frames shown, {self.dropped} dropped while the window was busy")
+
+def main_obstacle_detection(frame_source, display_width=1200):
     """Main video processing loop for obstacle detection and avoidance - Performance mode"""
-    
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
+    FrameProcessor().run(frame_source, display_width=display_width)
 
-        height, width, _ = frame.shape
-        frame_center_x, frame_center_y = width // 2, height // 2
-        
-        dangerous_obstacles = []  # Stores (cX, cY) of Red Triangles
+# -------------------------------------------------------------------------------------------------------
+#                     SECTION 6B: HEADLESS MODE (NO DRAWING, NO GUI CALLS)
+# -------------------------------------------------------------------------------------------------------
+
+def headless_obstacle_detection(frame_source):
+    """
+    Detection and avoidance only (Sections 4-5) for production use: no overlay drawing, no resize
+    and no HighGUI calls, so it also runs on machines without a display server.
+    Each command change is printed to stdout as the command stream.
+    """
+    last_command = None
 
-        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    def print_command(result):
+        nonlocal last_command
+        if result.command != last_command:
+            print(f"[frame {result.seq}] COMMAND: {result.command}", flush=True)
+            last_command = result.command
+
+    FrameProcessor().run(frame_source, on_result=print_command)
 
 # -------------------------------------------------------------------------------------------------------
-#                        SECTION 4: OBJECT DETECTION AND CLASSIFICATION
+#                    SECTION 6C: MULTI-PROCESS PIPELINE (SHARED-MEMORY FRAMES)
 # -------------------------------------------------------------------------------------------------------
-        
-        for color_name, ranges in color_ranges.items():
-            mask = None
-            if color_name == 'red':
-                mask1 = cv2.inRange(hsv, ranges['lower1'], ranges['upper1'])
-                mask2 = cv2.inRange(hsv, ranges['lower2'], ranges['upper2'])
-                mask = cv2.bitwise_or(mask1, mask2)
-            else:
-                mask = cv2.inRange(hsv, ranges['lower'], ranges['upper'])
-            
-            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-            for contour in contours:
-                if cv2.contourArea(contour) < 400:
-                    continue
+# Result of one frame processed by a pipeline worker. `detections` holds (classification, center,
+# area) tuples; contours stay in the worker so results are cheap to send back.
+PipelineResult = namedtuple('PipelineResult', ['seq', 'timestamp', 'frame_shape', 'detections',
+                                               'processing_time'])
+
+def _read_source_frames(source):
+    """Yield (frame, timestamp) from a capture URL/file/index, or from an object with a read() method"""
+    if hasattr(source, 'read'):
+        while True:
+            ret, frame, frame_seq, frame_timestamp = source.read()
+            if not ret:
+                return
+            yield frame, frame_timestamp
+    else:
+        cap = cv2.VideoCapture(source)
+        try:
+            while cap.isOpened():
+                ret, frame = cap.read()
+                if not ret:
+                    return
+                yield frame, time.monotonic()
+        finally:
+            cap.release()
+
+def _pipeline_capture_process(source, slot_count, drop_frames, worker_count, task_queue, free_slots,
+                              status_queue, stop_event, workers_done, frames_captured, frames_dropped):
+    """
+    Capture process: copies each frame into a free shared-memory slot and hands the slot to the
+    workers. When every slot is still in use the frame is dropped (or, with drop_frames=False,
+    capture waits for a slot).
+    """
+    shm = None
+    seq = 0
+    try:
+        for frame, timestamp in _read_source_frames(source):
+            if shm is None:
+                shm = shared_memory.SharedMemory(create=True, size=frame.nbytes * slot_count)
+                slots = np.ndarray((slot_count,) + frame.shape, dtype=frame.dtype, buffer=shm.buf)
+                status_queue.put(True)
+            if stop_event.is_set():
+                break
+            frames_captured.value += 1
+            if frame.shape != slots.shape[1:]:
+                frames_dropped.value += 1  # The stream changed resolution mid-run
+                continue
+            slot = None
+            while slot is None and not stop_event.is_set():
+                try:
+                    slot = free_slots.get(block=not drop_frames, timeout=None if drop_frames else 0.5)
+                except queue.Empty:
+                    if drop_frames:
+                        break
+            if slot is None:
+                frames_dropped.value += 1
+                continue
+            slots[slot] = frame
+            seq += 1
+            task_queue.put((seq, timestamp, shm.name, slot_count, frame.shape, slot))
+    finally:
+        if shm is None:
+            status_queue.put(False)
+        for _ in range(worker_count):
+            task_queue.put(None)
+        if shm is not None:
+            # Workers map the block by name, so it is only unlinked once they are all done.
+            workers_done.wait(timeout=10.0)
+            del slots
+            shm.close()
+            shm.unlink()
+
+def _pipeline_worker_process(config, task_queue, result_queue, free_slots):
+    """Detection worker: classifies frames straight out of their shared-memory slot"""
+    # Workers are spawned, so they start from the module defaults; apply the parent's settings.
+    color_ranges.clear()
+    color_ranges.update(config['color_ranges'])
+    DETECTION_RULES[:] = config['detection_rules']
+    globals()['MIN_CONTOUR_AREA'] = config['min_contour_area']
+
+    attached = {}
+    buffers = FrameBuffers()
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            seq, timestamp, shm_name, slot_count, shape, slot = task
+            if shm_name not in attached:
+                attached[shm_name] = shared_memory.SharedMemory(name=shm_name)
+            buffer = attached[shm_name].buf
+            frame = np.ndarray((slot_count,) + shape, dtype=np.uint8, buffer=buffer)[slot]
+
+            started = time.perf_counter()
+            try:
+                detections = [(d.classification, d.center, d.area)
+                              for d in detect_objects(frame, downscale=config['downscale'], buffers=buffers)]
+            except Exception as e:
+                # Still report the frame, otherwise the sequencer would wait for it forever
+                print(f"Pipeline worker error on frame {seq}: {e}")
+                detections = []
+            del frame
+            free_slots.put(slot)
+            result_queue.put(PipelineResult(seq, timestamp, shape, detections, time.perf_counter() - started))
+    finally:
+        for shm in attached.values():
+            shm.close()
+        result_queue.put(None)
+
+class FramePipeline:
+    """
+    Runs capture in one process and detection in a pool of worker processes. Frames travel through
+    `multiprocessing.shared_memory` ring slots instead of being pickled, and results() re-orders the
+    worker output by frame number, so commands are still issued in frame order.
+    """
+
+    def __init__(self, source, workers=None, slots=None, downscale=None, drop_frames=True):
+        self.source = source
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.slot_count = slots or 2 * self.workers
+        self.downscale = COARSE_DOWNSCALE if downscale is None else downscale
+        self.drop_frames = drop_frames
+        self._context = multiprocessing.get_context('spawn')
+        self._frames_captured = self._context.Value('Q', 0)
+        self._frames_dropped = self._context.Value('Q', 0)
+        self._processes = []
+
+    @property
+    def frames_captured(self):
+        return self._frames_captured.value
+
+    @property
+    def frames_dropped(self):
+        return self._frames_dropped.value
+
+    def open(self, timeout=30.0):
+        """Start the capture and worker processes. Returns False if the source can't be read"""
+        context = self._context
+        self._task_queue = context.Queue()
+        self._result_queue = context.Queue()
+        self._free_slots = context.Queue()
+        self._status_queue = context.Queue()
+        self._stop_event = context.Event()
+        self._workers_done = context.Event()
+        for slot in range(self.slot_count):
+            self._free_slots.put(slot)
+
+        config = {'color_ranges': color_ranges, 'detection_rules': DETECTION_RULES,
+                  'min_contour_area': MIN_CONTOUR_AREA, 'downscale': self.downscale}
+        self._capture = context.Process(
+            target=_pipeline_capture_process, name="pipeline-capture", daemon=True,
+            args=(self.source, self.slot_count, self.drop_frames, self.workers, self._task_queue,
+                  self._free_slots, self._status_queue, self._stop_event, self._workers_done,
+                  self._frames_captured, self._frames_dropped))
+        self._processes = [self._capture] + [
+            context.Process(target=_pipeline_worker_process, name=f"pipeline-worker-{index}", daemon=True,
+                            args=(config, self._task_queue, self._result_queue, self._free_slots))
+            for index in range(self.workers)]
+        for process in self._processes:
+            process.start()
+
+        try:
+            return self._status_queue.get(timeout=timeout)
+        except queue.Empty:
+            return False
+
+    def results(self):
+        """Yield PipelineResults in frame order until the source ends or release() is called"""
+        pending = []
+        next_seq = 1
+        running_workers = self.workers
+        while running_workers:
+            result = self._result_queue.get()
+            if result is None:
+                running_workers -= 1
+                continue
+            heapq.heappush(pending, (result.seq, result))
+            while pending and pending[0][0] == next_seq:
+                yield heapq.heappop(pending)[1]
+                next_seq += 1
+        self._workers_done.set()
+        # Anything left was stranded by a stopped capture; hand it out in order anyway
+        while pending:
+            yield heapq.heappop(pending)[1]
 
-                shape = detect_shape(contour)
-                
-                M = cv2.moments(contour)
-                cX = int(M["m10"] / M["m00"]) if M["m00"] != 0 else 0
-                cY = int(M["m01"] / M["m00"]) if M["m00"] != 0 else 0
-
-                classification = ""
-                if color_name == 'red' and shape == 'triangle':
-                    classification = "Dangerous obstacle"
-                    dangerous_obstacles.append((cX, cY)) 
-                    cv2.drawContours(frame, [contour], -1, (0, 0, 255), 3)
-                elif color_name == 'blue' and shape == 'square':
-                    classification = "Boundary marker"
-                    cv2.drawContours(frame, [contour], -1, (255, 0, 0), 3)
-                elif color_name == 'green' and shape == 'circle':
-                    classification = "Safe zone"
-                    cv2.drawContours(frame, [contour], -1, (0, 255, 0), 3)
-                
-                if classification:
-                    cv2.putText(frame, classification, (cX - 50, cY), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+    def release(self):
+        """Stop capturing and shut the processes down"""
+        if not self._processes:
+            return
+        self._stop_event.set()
+        self._workers_done.set()
+        for process in self._processes:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+
+def pipeline_obstacle_detection(pipeline):
+    """
+    Headless command stream fed by a FramePipeline: the avoidance logic runs on the re-ordered
+    results, so commands follow frame order even though frames are detected in parallel.
+    """
+    last_command = None
+    for result in pipeline.results():
+        height, width = result.frame_shape[:2]
+        dangerous = [(center, area) for classification, center, area in result.detections
+                     if is_dangerous(classification)]
+        command, closest_obstacle = compute_avoidance([center for center, area in dangerous], (width // 2, height // 2),
+                                                      [area for center, area in dangerous])
+        state_bus.publish(result.seq, result.timestamp, command, closest_obstacle, (width // 2, height // 2))
+        if metrics:
+            metrics.frame_processed(command, [detection[0] for detection in result.detections],
+                                    round(result.processing_time * 1e9))
+
+        if command != last_command:
+            latency_ms = (time.monotonic() - result.timestamp) * 1000.0
+            print(f"[frame {result.seq}] COMMAND: {command} (latency {latency_ms:.1f} ms)", flush=True)
+            last_command = command
 
 # -------------------------------------------------------------------------------------------------------
-#                               SECTION 5: OBSTACLE AVOIDANCE LOGIC
+#                      SECTION 6D: MULTI-CAMERA PROCESSING AND COMMAND FUSION
 # -------------------------------------------------------------------------------------------------------
-        
-        command = "Clear"
 
-        if dangerous_obstacles:
-            closest_obstacle = min(dangerous_obstacles, 
-                                   key=lambda pos: math.sqrt((pos[0] - frame_center_x)**2 + (pos[1] - frame_center_y)**2))
-            
-            closest_obs_x, closest_obs_y = closest_obstacle
-            cv2.circle(frame, (closest_obs_x, closest_obs_y), 30, (0, 255, 255), 3)
+# Dangerous obstacles seen by one camera in one frame, as (cX, cY) pixel positions in that camera's
+# frame, and their areas in pixels.
+CameraResult = namedtuple('CameraResult', ['camera', 'seq', 'timestamp', 'frame_shape', 'dangerous_obstacles',
+                                           'dangerous_areas', 'processing_time'])
+
+def _camera_process(camera, config, result_queue, status_queue, stop_event):
+    """Capture and detection for one camera, in its own process"""
+    # Processes are spawned, so they start from the module defaults; apply the parent's settings.
+    color_ranges.clear()
+    color_ranges.update(config['color_ranges'])
+    DETECTION_RULES[:] = config['detection_rules']
+    globals()['MIN_CONTOUR_AREA'] = config['min_contour_area']
+    globals()['FRAME_DEADLINE'] = config['frame_deadline']
+    globals()['ENABLE_MOTION_GATE'] = config['motion_gate']
 
-            dx = closest_obs_x - frame_center_x
-            dy = closest_obs_y - frame_center_y
+    source = camera['source']
+    reader = source if hasattr(source, 'read') else create_frame_reader(source)
+    opened = reader.open() if hasattr(reader, 'open') else True
+    status_queue.put((camera['name'], opened))
+    if isinstance(reader, MjpegFrameReader):
+        globals()['MIN_CONTOUR_AREA'] = MIN_CONTOUR_AREA / reader.scale ** 2
 
-            if abs(dx) > abs(dy):
-                if dx > 0:
-                    command = "Roll Left"
-                else:
-                    command = "Roll Right"
+    processor = FrameProcessor(downscale=config['downscale'])
+    shedder = processor.shedder
+    try:
+        while opened and not stop_event.is_set():
+            ret, frame, frame_seq, frame_timestamp = reader.read(timeout=0.5)
+            if not ret:
+                if getattr(reader, 'finished', True):
+                    break
+                continue  # Timed out: check stop_event and wait again
+            if not shedder.should_process():
+                continue
+            started = time.perf_counter()
+            result = processor.process(frame, frame_seq, frame_timestamp, shedder.resolution_scale, shedder.min_area)
+            dangerous = [d for d in result.detections if is_dangerous(d.classification)]
+            processing_time = time.perf_counter() - started
+            shedder.update(processing_time, frame_seq)
+            result_queue.put(CameraResult(camera['name'], frame_seq, frame_timestamp, frame.shape,
+                                          [d.center for d in dangerous], [d.area for d in dangerous], processing_time))
+    finally:
+        reader.release()
+        # End marker carrying the capture counters
+        result_queue.put((camera['name'], getattr(reader, 'frames_captured', 0), getattr(reader, 'frames_dropped', 0)))
+
+class MultiCameraRunner:
+    """
+    Processes several cameras concurrently: each camera gets its own process running capture and
+    a FrameProcessor, so throughput scales with the number of cores. `cameras` is a list of dicts
+    with a 'name' and a 'source' (capture URL/file/index, or a picklable object with read()).
+    results() yields CameraResults as they arrive, from every camera.
+    """
+
+    def __init__(self, cameras, downscale=None):
+        self.cameras = cameras
+        self.downscale = COARSE_DOWNSCALE if downscale is None else downscale
+        self.capture_counts = {camera['name']: (0, 0) for camera in cameras}  # name -> (captured, dropped)
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = []
+
+    @property
+    def frames_captured(self):
+        return sum(captured for captured, dropped in self.capture_counts.values())
+
+    @property
+    def frames_dropped(self):
+        return sum(dropped for captured, dropped in self.capture_counts.values())
+
+    def open(self, timeout=30.0):
+        """Start one process per camera. Returns False if any camera can't be opened"""
+        context = self._context
+        self._result_queue = context.Queue()
+        self._status_queue = context.Queue()
+        self._stop_event = context.Event()
+        config = {'color_ranges': color_ranges, 'detection_rules': DETECTION_RULES,
+                  'min_contour_area': MIN_CONTOUR_AREA, 'frame_deadline': FRAME_DEADLINE,
+                  'motion_gate': ENABLE_MOTION_GATE, 'downscale': self.downscale}
+        self._processes = [
+            context.Process(target=_camera_process, name=f"camera-{camera['name']}", daemon=True,
+                            args=(camera, config, self._result_queue, self._status_queue, self._stop_event))
+            for camera in self.cameras]
+        for process in self._processes:
+            process.start()
+
+        opened = True
+        try:
+            for _ in self.cameras:
+                name, camera_opened = self._status_queue.get(timeout=timeout)
+                if not camera_opened:
+                    print(f"Error: Could not open camera '{name}'.")
+                    opened = False
+        except queue.Empty:
+            return False
+        return opened
+
+    def results(self):
+        """Yield CameraResults until every camera's source ends or release() is called"""
+        running_cameras = len(self._processes)
+        while running_cameras:
+            item = self._result_queue.get()
+            if isinstance(item, CameraResult):
+                yield item
             else:
-                if dy > 0:
-                    command = "Pitch Up"
-                else:
-                    command = "Pitch Down"
+                name, captured, dropped = item
+                self.capture_counts[name] = (captured, dropped)
+                running_cameras -= 1
+
+    def release(self):
+        """Stop the camera processes"""
+        if not self._processes:
+            return
+        self._stop_event.set()
+        for process in self._processes:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+
+class CameraStats:
+    """Frame rate, processing time and capture-to-fusion latency of one camera's results"""
+
+    def __init__(self, window=1000):
+        self.frames = 0
+        self.first_arrival = None
+        self.last_arrival = None
+        self.processing_times = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+
+    def add(self, result, now):
+        self.frames += 1
+        if self.first_arrival is None:
+            self.first_arrival = now
+        self.last_arrival = now
+        self.processing_times.append(result.processing_time)
+        self.latencies.append(now - result.timestamp)
+
+    @property
+    def fps(self):
+        elapsed = (self.last_arrival or 0.0) - (self.first_arrival or 0.0)
+        return (self.frames - 1) / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        latencies_ms = np.array(self.latencies) * 1000.0
+        return (f"{self.frames} frames, {self.fps:.1f} FPS, processing {np.mean(self.processing_times) * 1000.0:.1f} ms, "
+                f"latency p50/p95 {np.percentile(latencies_ms, 50):.1f} / {np.percentile(latencies_ms, 95):.1f} ms"
+                if self.frames else "no frames")
+
+class CommandFusion:
+    """
+    Merges the latest dangerous obstacles of every camera into one avoidance decision.
+    Each camera's obstacles are turned into offsets from its own frame center, scaled to a
+    virtual `frame_width`-wide camera, rotated by the camera's mounting `rotation` (degrees) and
+    shifted by its view `offset` (in half frame widths), which places all cameras in one shared
+    avoidance frame centered on (0, 0). compute_avoidance() then runs on the merged list, with the
+    grid planner's occupancy grid covering one half frame width around the center in both directions.
+    Results older than `max_age` seconds are ignored, so a stalled camera can't hold a stale obstacle.
+    """
+
+    def __init__(self, cameras, frame_width=1280, max_age=0.5):
+        self.half_width = frame_width / 2
+        self.geometry = {camera['name']: (math.radians(camera.get('rotation', 0)), camera.get('offset', (0, 0)))
+                         for camera in cameras}
+        self.max_age = max_age
+        self.latest = {}
+        self.stats = {camera['name']: CameraStats() for camera in cameras}
+
+    def to_avoidance_frame(self, result):
+        """The dangerous obstacles of a CameraResult as (positions, areas) in the shared avoidance frame"""
+        height, width = result.frame_shape[:2]
+        scale = self.half_width / (width / 2)
+        rotation, (offset_x, offset_y) = self.geometry[result.camera]
+        cos, sin = math.cos(rotation), math.sin(rotation)
+        positions = []
+        for x, y in result.dangerous_obstacles:
+            dx, dy = (x - width // 2) * scale, (y - height // 2) * scale
+            positions.append((int(round(offset_x * self.half_width + dx * cos - dy * sin)),
+                              int(round(offset_y * self.half_width + dx * sin + dy * cos))))
+        return positions, [area * scale ** 2 for area in result.dangerous_areas]
+
+    def update(self, result):
+        """Take a camera's newest result and return the fused (command, closest_obstacle)"""
+        now = time.monotonic()
+        self.stats[result.camera].add(result, now)
+        self.latest[result.camera] = result
+        dangerous_obstacles, areas = [], []
+        for camera_result in self.latest.values():
+            if now - camera_result.timestamp <= self.max_age:
+                positions, camera_areas = self.to_avoidance_frame(camera_result)
+                dangerous_obstacles.extend(positions)
+                areas.extend(camera_areas)
+        return compute_avoidance(dangerous_obstacles, (0, 0), areas, (self.half_width, self.half_width))
+
+def multi_camera_obstacle_detection(runner):
+    """
+    Headless command stream fed by every camera of a MultiCameraRunner: each result updates the
+    fused decision, which is published to the state bus (positions in the shared avoidance frame)
+    and printed when the command changes. Per-camera statistics are printed at the end.
+    """
+    fusion = CommandFusion(runner.cameras)
+    last_command = None
+    try:
+        for decision_seq, result in enumerate(runner.results(), 1):
+            command, closest_obstacle = fusion.update(result)
+            state_bus.publish(decision_seq, result.timestamp, command, closest_obstacle, (0, 0))
+            if metrics:  # Cameras only report the positions of obstacles to avoid, not their classes
+                metrics.frame_processed(command, (), round(result.processing_time * 1e9))
+            if command != last_command:
+                print(f"[{result.camera} frame {result.seq}] COMMAND: {command}", flush=True)
+                last_command = command
+    finally:
+        for name, stats in fusion.stats.items():
+            print(f"Camera '{name}': {stats.summary()}")
 
 # -------------------------------------------------------------------------------------------------------
-#                            SECTION 6: DISPLAY COMMAND AND VISUAL AIDS
+#                        SECTION 6E: FLIGHT RECORDING AND REPLAY (MEMORY-MAPPED)
 # -------------------------------------------------------------------------------------------------------
-        
-        # Display the final command
-        cv2.putText(frame, f"COMMAND: {command}", (10, 30), 
-                    cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 255), 3)
-        
-        # Draw precise center lines for even quadrant distribution
-        cv2.line(frame, (frame_center_x, 0), (frame_center_x, height), (128, 128, 128), 2)
-        cv2.line(frame, (0, frame_center_y), (width, frame_center_y), (128, 128, 128), 2)
-        
-        # Draw additional quadrant lines for better visualization
-        quarter_width = width // 4
-        quarter_height = height // 4
-        cv2.line(frame, (quarter_width, 0), (quarter_width, height), (64, 64, 64), 1)
-        cv2.line(frame, (3 * quarter_width, 0), (3 * quarter_width, height), (64, 64, 64), 1)
-        cv2.line(frame, (0, quarter_height), (width, quarter_height), (64, 64, 64), 1)
-        cv2.line(frame, (0, 3 * quarter_height), (width, 3 * quarter_height), (64, 64, 64), 1)
 
-        # --- NEW: Draw a sniper-style marker at the center ---
-        marker_color = (0, 255, 255)  # Bright Yellow
-        # Draw the central circle
-        cv2.circle(frame, (frame_center_x, frame_center_y), 25, marker_color, 1)
-        # Draw the crosshairs
-        cv2.line(frame, (frame_center_x - 35, frame_center_y), (frame_center_x + 35, frame_center_y), marker_color, 1)
-        cv2.line(frame, (frame_center_x, frame_center_y - 35), (frame_center_x, frame_center_y + 35), marker_color, 1)
-
-        # Resize the final frame for a consistent window size
-        display_width = 1200
-        aspect_ratio = height / width
-        display_height = int(display_width * aspect_ratio)
-        display_frame = cv2.resize(frame, (display_width, display_height))
-
-        # Show the final frame
-        cv2.imshow("Avoidance System", display_frame)
-        
-        # Exit loop if 'q' is pressed
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+# A recording is a small header followed by fixed-size records, one per processed frame:
+#   b'FCREC' + version byte, header length (<I), JSON header (frame shape, detection slots and the
+#   settings that affect detection), zero padding to RECORDING_ALIGNMENT
+#   records: seq, timestamp, command code, detection scale and minimum area used, the detections
+#   (classification code, an index into the header's classifications; center, bounding box) and
+#   the raw BGR frame
+# Records are appended as they are produced, so a recording cut short by a crash is only missing
+# its last partial record. Replay maps the file with np.memmap and reads frames without copying.
+RECORDING_MAGIC = b'FCREC'
+RECORDING_VERSION = 1
+RECORDING_ALIGNMENT = 4096
+
+RECORDED_DETECTION = np.dtype([('classification', 'u1'), ('center', '<i4', 2), ('box', '<i4', 4)])
+
+def recording_dtype(frame_shape, max_detections):
+    """Record layout for frames of frame_shape with up to max_detections detections"""
+    return np.dtype([('seq', '<u4'), ('timestamp', '<f8'), ('command', 'u1'), ('scale', 'u1'),
+                     ('min_area', '<f4'), ('detection_count', '<u2'),
+                     ('detections', RECORDED_DETECTION, (max_detections,)), ('frame', 'u1', tuple(frame_shape))])
+
+class FlightRecorder:
+    """
+    Appends every processed frame, its detections and its command to a recording file. The file is
+    created with the shape of the first frame; frames of another shape are skipped (and counted),
+    and detections beyond max_detections are left out of the record.
+    """
+
+    def __init__(self, path, max_detections=32):
+        self.path = path
+        self.max_detections = max_detections
+        self.frames_recorded = 0
+        self.frames_skipped = 0
+        self._file = None
+        self._record = None
+        self._frame_shape = None
+        self._classification_codes = {}
+
+    def _create(self, frame_shape):
+        classifications = rule_table.compiled().classifications
+        self._classification_codes = {classification: code for code, classification in enumerate(classifications)}
+        header = json.dumps({
+            'frame_shape': list(frame_shape), 'max_detections': self.max_detections,
+            'commands': [COMMAND_NAMES[code] for code in sorted(COMMAND_NAMES)],
+            'classifications': list(classifications),
+            'settings': {'color_ranges': {color_name: {key: np.asarray(bound).tolist() for key, bound in ranges.items()}
+                                          for color_name, ranges in color_ranges.items()},
+                         'detection_rules': [list(rule) for rule in DETECTION_RULES],
+                         'min_contour_area': MIN_CONTOUR_AREA, 'downscale': COARSE_DOWNSCALE,
+                         'tracking': ENABLE_TRACKING, 'motion_gate': ENABLE_MOTION_GATE,
+                         'avoidance_planner': AVOIDANCE_PLANNER},
+        }).encode()
+        preamble = RECORDING_MAGIC + bytes([RECORDING_VERSION]) + struct.pack('<I', len(header)) + header
+        padding = -len(preamble) % RECORDING_ALIGNMENT
+        self._file = open(self.path, 'wb')
+        self._file.write(preamble + bytes(padding))
+        self._record = np.zeros(1, dtype=recording_dtype(frame_shape, self.max_detections))
+        self._frame_shape = frame_shape
+
+    def write(self, frame, result, scale=1, min_area=None):
+        """Record one processed frame (before any overlay is drawn on it) and its FrameResult"""
+        if self._file is None:
+            self._create(frame.shape)
+        elif frame.shape != self._frame_shape:
+            if not self.frames_skipped:
+                print(f"Recording: skipping frames of shape {frame.shape}, the recording holds {self._frame_shape}")
+            self.frames_skipped += 1
+            return
+        record = self._record[0]
+        record['seq'] = result.seq
+        record['timestamp'] = np.nan if result.timestamp is None else result.timestamp
+        record['command'] = COMMAND_CODES[result.command]
+        record['scale'] = scale
+        record['min_area'] = MIN_CONTOUR_AREA if min_area is None else min_area
+        detections = result.detections[:self.max_detections]
+        record['detection_count'] = len(detections)
+        slots = record['detections']
+        slots[:] = 0
+        for slot, detection in zip(slots, detections):
+            slot['classification'] = self._classification_codes[detection.classification]
+            slot['center'] = detection.center
+            slot['box'] = cv2.boundingRect(detection.contour)
+        record['frame'] = frame
+        self._file.write(self._record.tobytes())
+        self.frames_recorded += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+# Recorder the processing loops write to (set by main() with --record), or None.
+flight_recorder = None
+
+class FlightReplay:
+    """
+    Frame source replaying a recording through the same read() interface as LatestFrameReader.
+    Frames are read-only views into the memory-mapped file (copy one before drawing on it). With
+    `realtime` frames are handed out at the pace they were recorded; otherwise as fast as they
+    are read. No frame is ever dropped, so a replay is deterministic.
+    """
+
+    def __init__(self, path, realtime=False):
+        self.path = path
+        self.realtime = realtime
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.records = None
+        self.header = None
+        self._index = 0
+        self._started = None
+
+    def open(self):
+        """Map the recording. Returns False if the file can't be read"""
+        try:
+            with open(self.path, 'rb') as file:
+                preamble = file.read(len(RECORDING_MAGIC) + 5)
+                magic, version = preamble[:len(RECORDING_MAGIC)], preamble[len(RECORDING_MAGIC)]
+                if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+                    print(f"Error: {self.path} is not a version {RECORDING_VERSION} flight recording")
+                    return False
+                header_size, = struct.unpack('<I', preamble[len(RECORDING_MAGIC) + 1:])
+                self.header = json.loads(file.read(header_size))
+        except (OSError, ValueError) as e:
+            print(f"Error: could not read {self.path}: {e}")
+            return False
+        offset = len(preamble) + header_size
+        offset += -offset % RECORDING_ALIGNMENT
+        dtype = recording_dtype(self.header['frame_shape'], self.header['max_detections'])
+        count = (os.path.getsize(self.path) - offset) // dtype.itemsize  # A cut-off last record is ignored
+        self.records = np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=(count,)) if count else \
+            np.zeros(0, dtype=dtype)
+        return True
+
+    @property
+    def finished(self):
+        return self.records is None or self._index >= len(self.records)
+
+    def __len__(self):
+        return 0 if self.records is None else len(self.records)
+
+    def read_record(self):
+        """Next record (a read-only view), or None at the end of the recording"""
+        if self.finished:
+            return None
+        record = self.records[self._index]
+        self._index += 1
+        self.frames_captured += 1
+        if self.realtime and not math.isnan(record['timestamp']):
+            if self._started is None:
+                self._started = (time.monotonic(), float(record['timestamp']))
+            start_time, start_timestamp = self._started
+            delay = start_time + (float(record['timestamp']) - start_timestamp) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return record
+
+    def read(self, timeout=None):
+        record = self.read_record()
+        if record is None:
+            return False, None, self._index, 0.0
+        return True, record['frame'], int(record['seq']), float(record['timestamp'])
+
+    def recorded_commands(self):
+        """(seq, command) of every recorded frame"""
+        names = self.header['commands']
+        return [(int(seq), names[code]) for seq, code in zip(self.records['seq'], self.records['command'])]
+
+    def release(self):
+        self.records = None
+
+def apply_recorded_settings(settings):
+    """
+    Restore the color ranges, detection rules and avoidance planner a recording was made with
+    (replay changes the global ones). Recordings made before detection rules existed keep the
+    current rules; those made before the grid planner used the closest-obstacle one.
+    """
+    color_ranges.clear()
+    color_ranges.update({color_name: {key: np.array(bound) for key, bound in ranges.items()}
+                         for color_name, ranges in settings['color_ranges'].items()})
+    if 'detection_rules' in settings:
+        DETECTION_RULES[:] = [DetectionRule(color, shape, classification, tuple(draw_color), role)
+                              for color, shape, classification, draw_color, role in settings['detection_rules']]
+    globals()['AVOIDANCE_PLANNER'] = settings.get('avoidance_planner', "closest")
+
+def replay_obstacle_detection(replay, display_width=None):
+    """
+    Feed a recording through detection and avoidance again, with the settings it was recorded
+    with and each frame's recorded scale and minimum area, and compare every command with the
+    recorded one. Every difference is printed as it is found, in frame order, and returned as
+    (seq, recorded, replayed) tuples.
+    """
+    settings = replay.header['settings']
+    apply_recorded_settings(settings)
+    processor = FrameProcessor(tracking=settings['tracking'], downscale=settings['downscale'], deadline=0,
+                               motion_gate=settings['motion_gate'])
+    names = replay.header['commands']
+    display = DisplayThread(display_width) if display_width else None
+    mismatches = []
+    frames = 0
+    while True:
+        record = replay.read_record()
+        if record is None:
             break
+        frames += 1
+        seq, timestamp = int(record['seq']), float(record['timestamp'])
+        result = processor.process(record['frame'], seq, timestamp, int(record['scale']), float(record['min_area']))
+        processor.bus.publish(result.seq, result.timestamp, result.command, result.closest_obstacle,
+                              result.frame_center)
+        recorded = names[record['command']]
+        if result.command != recorded:
+            print(f"[frame {seq}] recorded: {recorded}, replayed: {result.command}", flush=True)
+            mismatches.append((seq, recorded, result.command))
+        if display:
+            display.show(record['frame'], result)
+            if display.closed.is_set():
+                break
+    if display:
+        display.close()
+    print(f"Replay: {frames} frames, {len(mismatches)} commands differ from the recording")
+    return mismatches
 
 # -------------------------------------------------------------------------------------------------------
 #            SECTION 7: AIRPLANE ANIMATION IMPORTS (COMMENT THIS SECTION TO DISABLE)
 # -------------------------------------------------------------------------------------------------------
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from matplotlib.animation import FuncAnimation
-import threading
-import time
+# matplotlib is only needed by the airplane GUI, so it is imported on first use: Performance and
+# Headless modes start without it.
+plt = None
+patches = None
+Affine2D = None
 
-# Global variables for airplane animation
+def import_animation_modules():
+    """Import matplotlib for the airplane GUI (once) and return pyplot"""
+    global plt, patches, Affine2D
+    if plt is None:
+        import matplotlib.pyplot as pyplot
+        import matplotlib.patches as mpatches
+        from matplotlib.transforms import Affine2D as affine
+        plt, patches, Affine2D = pyplot, mpatches, affine
+    return plt
+
+# Global variables for airplane animation (owned by the GUI thread; commands and targets come
+# from the state bus)
 airplane_roll = 0.0  # Roll angle in degrees
 airplane_pitch = 0.0  # Pitch offset (vertical movement)
 elevator_angle = 0.0  # Elevator deflection angle
-current_command = "Clear"
 animation_speed = 2.0  # Speed of animation
-target_roll = 0.0
-target_pitch = 0.0
-target_elevator = 0.0
+
+# Command text box color for each kind of command
+COMMAND_BOX_COLORS = {"Clear": 'lightgreen', "Roll": 'orange', "Pitch": 'red'}
 
 # -------------------------------------------------------------------------------------------------------
 #               SECTION 8: AIRPLANE GUI CLASS (COMMENT THIS SECTION TO DISABLE)
 # -------------------------------------------------------------------------------------------------------
 
 class AirplaneGUI:
-    def __init__(self):
+    """
+    Airplane back view driven by the latest state on the state bus. With `blit` (the default) the static axes,
+    grid and labels are drawn once into a cached background and every tick only redraws the
+    moving parts over it; ticks where the airplane has settled and the command is unchanged
+    draw nothing. Without `blit` every tick redraws the whole figure.
+    """
+
+    def __init__(self, blit=True, bus=None):
+        import_animation_modules()
+        self.blit = blit
+        self.bus = state_bus if bus is None else bus
+        self.background = None
+        self.displayed_command = None
+        self.rendered_ticks = 0
+        self.skipped_ticks = 0
+        self.timer = None
         self.fig, self.ax = plt.subplots(figsize=(10, 8))
         self.ax.set_xlim(-120, 120)
         self.ax.set_ylim(-90, 90)
@@ -348,15 +3457,71 @@ class AirplaneGUI:
         self.ax.axhline(y=-45, color='gray', linestyle=':', alpha=0.3)
         self.ax.axvline(x=60, color='gray', linestyle=':', alpha=0.3)
         self.ax.axvline(x=-60, color='gray', linestyle=':', alpha=0.3)
-        
+
+        self.animated_artists = [self.fuselage, self.cockpit, self.left_wing, self.right_wing,
+                                 self.left_aileron, self.right_aileron, self.vertical_stabilizer,
+                                 self.rudder, self.horizontal_stabilizer_left, self.horizontal_stabilizer_right,
+                                 self.elevator_left, self.elevator_right, self.command_text]
+        if self.blit:
+            # Moving parts are left out of full redraws and drawn over the cached background
+            for artist in self.animated_artists:
+                artist.set_animated(True)
+            self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+
+        # Roll transforms are created once and updated in place on every tick
+        self.left_wing_rotation = Affine2D()
+        self.right_wing_rotation = Affine2D()
+        self.left_aileron_rotation = Affine2D()
+        self.right_aileron_rotation = Affine2D()
+        self.left_wing.set_transform(self.left_wing_rotation + self.ax.transData)
+        self.right_wing.set_transform(self.right_wing_rotation + self.ax.transData)
+        self.left_aileron.set_transform(self.left_aileron_rotation + self.ax.transData)
+        self.right_aileron.set_transform(self.right_aileron_rotation + self.ax.transData)
+
+    def on_draw(self, event):
+        """After a full redraw (first show, resize): cache the background and draw the moving parts"""
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self.animated_artists:
+            self.fig.draw_artist(artist)
+
+    def start(self, interval=50):
+        """Tick the animation every `interval` ms on the GUI event loop"""
+        self.timer = self.fig.canvas.new_timer(interval=interval)
+        self.timer.add_callback(self.tick)
+        self.timer.start()
+
+    def tick(self):
+        """Advance the animation one step and redraw whatever changed"""
+        if not self.update_airplane(None):
+            self.skipped_ticks += 1
+            return
+        self.rendered_ticks += 1
+        canvas = self.fig.canvas
+        if self.blit and self.background is not None:
+            canvas.restore_region(self.background)
+            for artist in self.animated_artists:
+                self.fig.draw_artist(artist)
+            canvas.blit(self.fig.bbox)
+            canvas.flush_events()
+        else:
+            canvas.draw_idle()
+
     def update_airplane(self, frame):
-        """Update airplane position and rotation based on current command"""
-        global airplane_roll, airplane_pitch, elevator_angle, current_command, target_roll, target_pitch, target_elevator
+        """
+        Update airplane position and rotation based on current command.
+        Returns the changed artists, or an empty list once the airplane has settled.
+        """
+        global airplane_roll, airplane_pitch, elevator_angle
+        state = self.bus.latest()  # One consistent snapshot for the whole tick
+        current_command = state.command
         
         # Smooth animation towards target positions
-        roll_diff = target_roll - airplane_roll
-        pitch_diff = target_pitch - airplane_pitch
-        elevator_diff = target_elevator - elevator_angle
+        roll_diff = state.target_roll - airplane_roll
+        pitch_diff = state.target_pitch - airplane_pitch
+        elevator_diff = state.target_elevator - elevator_angle
+        if (current_command == self.displayed_command and
+                max(abs(roll_diff), abs(pitch_diff), abs(elevator_diff)) < 0.01):
+            return []
         
         airplane_roll += roll_diff * 0.12  # Smooth interpolation
         airplane_pitch += pitch_diff * 0.12
@@ -400,39 +3565,22 @@ class AirplaneGUI:
         self.elevator_left.set_y(32 + airplane_pitch + elevator_deflection)
         self.elevator_right.set_y(32 + airplane_pitch + elevator_deflection)
         
-        # Create rotation transforms for wings during roll
+        # Rotate the wings around their centers during roll
         wing_roll_angle = -airplane_roll  
-        left_transform = plt.matplotlib.transforms.Affine2D().rotate_deg_around(
-            -47.5, left_wing_y + 8, wing_roll_angle) + self.ax.transData
-        right_transform = plt.matplotlib.transforms.Affine2D().rotate_deg_around(
-            47.5, right_wing_y + 8, wing_roll_angle) + self.ax.transData
+        self.left_wing_rotation.clear().rotate_deg_around(-47.5, left_wing_y + 8, wing_roll_angle)
+        self.right_wing_rotation.clear().rotate_deg_around(47.5, right_wing_y + 8, wing_roll_angle)
         
-        # Apply transforms
-        self.left_wing.set_transform(left_transform)
-        self.right_wing.set_transform(right_transform)
-        
-        # Aileron transforms 
+        # Aileron rotations 
         left_aileron_angle = wing_roll_angle + 5 * math.sin(roll_rad)   
         right_aileron_angle = wing_roll_angle - 5 * math.sin(roll_rad)  
+        self.left_aileron_rotation.clear().rotate_deg_around(-62.5, left_aileron_y + 2, left_aileron_angle)
+        self.right_aileron_rotation.clear().rotate_deg_around(62.5, right_aileron_y + 2, right_aileron_angle)
         
-        left_aileron_transform = plt.matplotlib.transforms.Affine2D().rotate_deg_around(
-            -62.5, left_aileron_y + 2, left_aileron_angle) + self.ax.transData
-        right_aileron_transform = plt.matplotlib.transforms.Affine2D().rotate_deg_around(
-            62.5, right_aileron_y + 2, right_aileron_angle) + self.ax.transData
-        
-        self.left_aileron.set_transform(left_aileron_transform)
-        self.right_aileron.set_transform(right_aileron_transform)
-        
-        # Update command text
-        self.command_text.set_text(f'COMMAND: {current_command}')
-        
-        # Color coding for commands with more detailed feedback
-        if current_command == "Clear":
-            self.command_text.set_bbox(dict(boxstyle='round', facecolor='lightgreen', alpha=0.9))
-        elif "Roll" in current_command:
-            self.command_text.set_bbox(dict(boxstyle='round', facecolor='orange', alpha=0.9))
-        elif "Pitch" in current_command:
-            self.command_text.set_bbox(dict(boxstyle='round', facecolor='red', alpha=0.9))
+        # Update command text and its color coding only when the command changes
+        if current_command != self.displayed_command:
+            self.command_text.set_text(f'COMMAND: {current_command}')
+            self.command_text.get_bbox_patch().set_facecolor(COMMAND_BOX_COLORS[current_command.split()[0]])
+            self.displayed_command = current_command
         
         return [self.fuselage, self.cockpit, self.left_wing, self.right_wing, 
                 self.left_aileron, self.right_aileron, self.vertical_stabilizer, 
@@ -443,196 +3591,221 @@ class AirplaneGUI:
 #            SECTION 9: VIDEO PROCESSING WITH ANIMATION (COMMENT THIS SECTION TO DISABLE)
 # -------------------------------------------------------------------------------------------------------
 
-def video_processing_thread():
-    """Process video stream and update airplane commands with threading for GUI"""
-    global current_command, target_roll, target_pitch, target_elevator
-    
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
+def video_processing_thread(frame_source, display_width=800):
+    """Process video stream and publish airplane commands to the state bus for the GUI thread"""
+    # Smaller display width to fit alongside the GUI
+    FrameProcessor().run(frame_source, display_width=display_width, target_fps=ANIMATION_TARGET_FPS)
 
-        height, width, _ = frame.shape
-        frame_center_x, frame_center_y = width // 2, height // 2
-        
-        dangerous_obstacles = []  # Stores (cX, cY) of Red Triangles
+# -------------------------------------------------------------------------------------------------------
+#                                SECTION 10: MAIN EXECUTION CONTROLLER
+# -------------------------------------------------------------------------------------------------------
 
-        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+def parse_args(argv=None):
+    """Command-line options; their defaults are the Section 1 settings"""
+    import argparse
 
-        # --------------------------------------------------------------------------
-        #                   OBJECT DETECTION AND CLASSIFICATION
-        # --------------------------------------------------------------------------
-        
-        for color_name, ranges in color_ranges.items():
-            mask = None
-            if color_name == 'red':
-                mask1 = cv2.inRange(hsv, ranges['lower1'], ranges['upper1'])
-                mask2 = cv2.inRange(hsv, ranges['lower2'], ranges['upper2'])
-                mask = cv2.bitwise_or(mask1, mask2)
-            else:
-                mask = cv2.inRange(hsv, ranges['lower'], ranges['upper'])
-            
-            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    parser = argparse.ArgumentParser(description="Color and shape based UAV obstacle avoidance")
+    parser.add_argument('source', nargs='?', default=video_url,
+                        help=f"Camera stream URL, video file or camera index (default: {video_url})")
+    parser.add_argument('--mode', choices=("animation", "performance", "headless"), default=EXECUTION_MODE,
+                        help=f"Execution mode (default: {EXECUTION_MODE})")
+    parser.add_argument('--display-width', type=int, default=None,
+                        help="Width of the video window (default: 1200, or 800 next to the animation GUI)")
+    parser.add_argument('--min-area', type=float, default=MIN_CONTOUR_AREA,
+                        help=f"Minimum contour area in full-resolution pixels (default: {MIN_CONTOUR_AREA})")
+    parser.add_argument('--deadline-ms', type=float,
+                        default=FRAME_DEADLINE * 1000.0 if FRAME_DEADLINE else 0,
+                        help="Per-frame deadline for load shedding, 0 disables it (default: %(default)g)")
+    parser.add_argument('--downscale', type=int, default=COARSE_DOWNSCALE,
+                        help=f"Coarse-to-fine detection factor, 1 for full frames (default: {COARSE_DOWNSCALE})")
+    parser.add_argument('--threads', type=int, default=DETECTION_THREADS,
+                        help="Threads detecting each full-resolution frame in strips (default: %(default)s)")
+    parser.add_argument('--planner', choices=("grid", "closest"), default=AVOIDANCE_PLANNER,
+                        help="Avoidance planner; closest keeps the four original commands (default: %(default)s)")
+    parser.add_argument('--tracking', action='store_true', default=ENABLE_TRACKING,
+                        help="Track obstacles between frames")
+    parser.add_argument('--motion-gate', action='store_true', default=ENABLE_MOTION_GATE,
+                        help="Reuse the previous result on static scenes and re-detect only changed tiles")
+    parser.add_argument('--workers', type=int, default=PIPELINE_WORKERS,
+                        help="Detection worker processes in headless mode (default: %(default)s)")
+    parser.add_argument('--udp', metavar='HOST:PORT', default=None,
+                        help="Send command packets to the flight controller at HOST:PORT")
+    parser.add_argument('--record', metavar='PATH', default=None,
+                        help="Record every processed frame, its detections and its command to PATH")
+    parser.add_argument('--replay', metavar='PATH', default=None,
+                        help="Replay a recording instead of a live source and compare the commands")
+    parser.add_argument('--realtime', action='store_true',
+                        help="Replay at the recorded pace instead of as fast as possible")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help=f"Serve Prometheus metrics at http://{METRICS_HOST}:PORT/metrics")
+    parser.add_argument('--trace', action='store_true', default=TRACE_STAGES,
+                        help=f"Record per-stage timings to {TRACE_OUTPUT}.json and {TRACE_OUTPUT}.csv")
+    args = parser.parse_args(argv)
+    if args.udp:
+        host, _, port = args.udp.rpartition(':')
+        if not host or not port.isdigit():
+            parser.error("--udp expects HOST:PORT")
+        args.udp = (host, int(port))
+    else:
+        args.udp = UDP_COMMAND_TARGET
+    if args.source.isdigit():
+        args.source = int(args.source)  # Local camera index
+    return args
 
-            for contour in contours:
-                if cv2.contourArea(contour) < 400:
-                    continue
+def main(argv=None):
+    """
+    Entry point: apply the command-line options, open the capture and run the chosen mode.
+    Returns the exit status (1 on an error or when a replay's commands differ from the recording).
+    """
+    global flight_recorder, EXECUTION_MODE, MIN_CONTOUR_AREA, FRAME_DEADLINE, COARSE_DOWNSCALE
+    global ENABLE_TRACKING, ENABLE_MOTION_GATE, PIPELINE_WORKERS, DETECTION_THREADS, METRICS_PORT
+    global AVOIDANCE_PLANNER, metrics
+    main_started = time.perf_counter()
+    args = parse_args(argv)
+    EXECUTION_MODE = args.mode
+    MIN_CONTOUR_AREA = args.min_area
+    FRAME_DEADLINE = args.deadline_ms / 1000.0
+    COARSE_DOWNSCALE = args.downscale
+    DETECTION_THREADS = args.threads
+    AVOIDANCE_PLANNER = args.planner
+    ENABLE_TRACKING = args.tracking
+    ENABLE_MOTION_GATE = args.motion_gate
+    PIPELINE_WORKERS = args.workers
+    METRICS_PORT = args.metrics_port
+    tracer.enabled = args.trace
 
-                shape = detect_shape(contour)
-                
-                M = cv2.moments(contour)
-                cX = int(M["m10"] / M["m00"]) if M["m00"] != 0 else 0
-                cY = int(M["m01"] / M["m00"]) if M["m00"] != 0 else 0
-
-                classification = ""
-                if color_name == 'red' and shape == 'triangle':
-                    classification = "Dangerous obstacle"
-                    dangerous_obstacles.append((cX, cY)) 
-                    cv2.drawContours(frame, [contour], -1, (0, 0, 255), 3)
-                elif color_name == 'blue' and shape == 'square':
-                    classification = "Boundary marker"
-                    cv2.drawContours(frame, [contour], -1, (255, 0, 0), 3)
-                elif color_name == 'green' and shape == 'circle':
-                    classification = "Safe zone"
-                    cv2.drawContours(frame, [contour], -1, (0, 255, 0), 3)
-                
-                if classification:
-                    cv2.putText(frame, classification, (cX - 50, cY), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-
-        # --------------------------------------------------------------------------
-        #                       OBSTACLE AVOIDANCE LOGIC
-        # --------------------------------------------------------------------------
-        
-        command = "Clear"
-        new_target_roll = 0.0
-        new_target_pitch = 0.0
-        new_target_elevator = 0.0
-
-        if dangerous_obstacles:
-            closest_obstacle = min(dangerous_obstacles, 
-                                   key=lambda pos: math.sqrt((pos[0] - frame_center_x)**2 + (pos[1] - frame_center_y)**2))
-            
-            closest_obs_x, closest_obs_y = closest_obstacle
-            cv2.circle(frame, (closest_obs_x, closest_obs_y), 30, (0, 255, 255), 3)
-
-            dx = closest_obs_x - frame_center_x
-            dy = closest_obs_y - frame_center_y
-
-            if abs(dx) > abs(dy):
-                if dx > 0:
-                    command = "Roll Left"
-                    new_target_roll = -35  # Roll left
-                else:
-                    command = "Roll Right"
-                    new_target_roll = 35   # Roll right
-            else:
-                if dy > 0:
-                    command = "Pitch Up"
-                    new_target_pitch = 20   # Pitch up (climb)
-                    new_target_elevator = -15  # Elevator up (negative deflection)
-                else:
-                    command = "Pitch Down"
-                    new_target_pitch = -20  # Pitch down (dive)
-                    new_target_elevator = 15   # Elevator down (positive deflection)
-        
-        # Update global variables for airplane animation
-        current_command = command
-        target_roll = new_target_roll
-        target_pitch = new_target_pitch
-        target_elevator = new_target_elevator
-
-        # --------------------------------------------------------------------------
-        #                       DISPLAY COMMAND AND VISUAL AIDS
-        # --------------------------------------------------------------------------
-        
-        # Display the final command
-        cv2.putText(frame, f"COMMAND: {command}", (10, 30), 
-                    cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 255), 3)
-        
-        # Draw precise center lines for even quadrant distribution
-        cv2.line(frame, (frame_center_x, 0), (frame_center_x, height), (128, 128, 128), 2)
-        cv2.line(frame, (0, frame_center_y), (width, frame_center_y), (128, 128, 128), 2)
-        
-        # Draw additional quadrant lines for better visualization
-        quarter_width = width // 4
-        quarter_height = height // 4
-        cv2.line(frame, (quarter_width, 0), (quarter_width, height), (64, 64, 64), 1)
-        cv2.line(frame, (3 * quarter_width, 0), (3 * quarter_width, height), (64, 64, 64), 1)
-        cv2.line(frame, (0, quarter_height), (width, quarter_height), (64, 64, 64), 1)
-        cv2.line(frame, (0, 3 * quarter_height), (width, 3 * quarter_height), (64, 64, 64), 1)
+    # Startup time: report how long it took from importing this module to the first command
+    def report_first_command(state):
+        state_bus.unsubscribe(report_first_command)
+        print(f"Startup: first command {time.perf_counter() - _import_started:.2f} s after import "
+              f"(import {main_started - _import_started:.2f} s, "
+              f"stream opened after {opened_at - _import_started:.2f} s)", flush=True)
 
-        # --- Draw a sniper-style marker at the center ---
-        marker_color = (0, 255, 255)  # Bright Yellow
-        # Draw the central circle
-        cv2.circle(frame, (frame_center_x, frame_center_y), 25, marker_color, 1)
-        # Draw the crosshairs
-        cv2.line(frame, (frame_center_x - 35, frame_center_y), (frame_center_x + 35, frame_center_y), marker_color, 1)
-        cv2.line(frame, (frame_center_x, frame_center_y - 35), (frame_center_x, frame_center_y + 35), marker_color, 1)
-
-        # Resize the final frame for display (smaller when GUI is active)
-        display_width = 800  # Smaller width to fit alongside GUI
-        aspect_ratio = height / width
-        display_height = int(display_width * aspect_ratio)
-        display_frame = cv2.resize(frame, (display_width, display_height))
-
-        # Show the final frame
-        cv2.imshow("Avoidance System", display_frame)
-        
-        # Exit loop if 'q' is pressed
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-        
-        time.sleep(0.033)  # ~30 FPS
+    # Start the capture reader; frames are read on a background thread and only the newest is kept
+    # (a video file is read frame by frame instead, so none is dropped).
+    # Headless mode with PIPELINE_WORKERS > 0 captures and detects in separate processes instead.
+    # HTTP MJPEG streams use the built-in client, which decodes at reduced scale.
+    # Several CAMERAS are each captured and processed in their own process.
+    # A replay reads a recording instead, with the settings it was recorded with.
+    if args.replay:
+        frame_source = FlightReplay(args.replay, realtime=args.realtime)
+    elif len(CAMERAS) > 1:
+        frame_source = MultiCameraRunner(CAMERAS)
+    elif EXECUTION_MODE == "headless" and PIPELINE_WORKERS > 0:
+        frame_source = FramePipeline(args.source, workers=PIPELINE_WORKERS, drop_frames=not is_file_source(args.source))
+    else:
+        frame_source = create_frame_reader(args.source)
+        if isinstance(frame_source, MjpegFrameReader):
+            # Frames are MJPEG_DECODE_SCALE times smaller, so is the area of every object
+            MIN_CONTOUR_AREA = MIN_CONTOUR_AREA / MJPEG_DECODE_SCALE ** 2
+    if not frame_source.open():
+        sys.exit("Error: Could not open video stream.")
+    opened_at = time.perf_counter()
+    state_bus.subscribe(report_first_command)
+    if args.record:
+        flight_recorder = FlightRecorder(args.record)
+    status = 0
 
-# -------------------------------------------------------------------------------------------------------
-#                                SECTION 10: MAIN EXECUTION CONTROLLER
-# -------------------------------------------------------------------------------------------------------
+    # Live metrics for monitoring, served from a background thread
+    metrics_server = None
+    if METRICS_PORT is not None:
+        metrics = FlightMetrics(frame_source)
+        tracer.metrics = metrics
+        metrics_server = start_metrics_server(metrics, METRICS_PORT)
+        print(f"Metrics: http://{METRICS_HOST}:{metrics_server.server_address[1]}/metrics")
 
-if __name__ == "__main__":
-    # CHOOSE EXECUTION MODE:
-        # Set to True for GUI animation + video processing
-        # Set to False for video processing only (better performance)
-    ENABLE_ANIMATION = True
+    # Send every command decision to the flight controller
+    command_sender = None
+    if args.udp:
+        command_sender = CommandSender(args.udp)
+        state_bus.subscribe(command_sender)
     
     try:
-        if ENABLE_ANIMATION:
+        if isinstance(frame_source, FlightReplay):
+            # --------------------------------------------------------------------------
+            #   REPLAY: a recording through detection again, diffed against its commands
+            # --------------------------------------------------------------------------
+            print(f"Replaying {args.replay} ({len(frame_source)} frames)...")
+            display_width = None if EXECUTION_MODE == "headless" else args.display_width or 1200
+            if replay_obstacle_detection(frame_source, display_width):
+                status = 1
+
+        elif isinstance(frame_source, MultiCameraRunner):
+            # --------------------------------------------------------------------------
+            #   MULTI-CAMERA: per-camera processes, fused command stream (no GUI)
+            # --------------------------------------------------------------------------
+            print(f"Starting multi-camera mode ({len(CAMERAS)} cameras, command stream only)...")
+            multi_camera_obstacle_detection(frame_source)
+
+        elif EXECUTION_MODE == "animation":
             # --------------------------------------------------------------------------
             #       ANIMATION MODE: Run both video processing & airplane GUI
             # --------------------------------------------------------------------------
             print("Starting with airplane animation GUI...")
             
-            # Create airplane GUI
+            # Create airplane GUI (imports matplotlib)
             airplane_gui = AirplaneGUI()
             
             # Start video processing in a separate thread
-            video_thread = threading.Thread(target=video_processing_thread, daemon=True)
+            video_thread = threading.Thread(target=video_processing_thread,
+                                            args=(frame_source, args.display_width or 800), daemon=True)
             video_thread.start()
             
-            # Start airplane animation
-            anim = FuncAnimation(airplane_gui.fig, airplane_gui.update_airplane, 
-                                interval=50, blit=False, cache_frame_data=False)
+            # Start airplane animation (blitted, ticks every 50 ms)
+            airplane_gui.start(interval=50)
             
             # Show the matplotlib GUI
             plt.show()
             
+        elif EXECUTION_MODE == "headless":
+            # --------------------------------------------------------------------------
+            #   HEADLESS MODE: Detection and command stream only (no drawing, no GUI)
+            # --------------------------------------------------------------------------
+            print("Starting in headless mode (command stream only)...")
+            if isinstance(frame_source, FramePipeline):
+                pipeline_obstacle_detection(frame_source)
+            else:
+                headless_obstacle_detection(frame_source)
+
         else:
             # --------------------------------------------------------------------------
             #   PERFORMANCE MODE: Run only core obstacle detection (no animation)
             # --------------------------------------------------------------------------
             print("Starting in performance mode (no animation)...")
-            main_obstacle_detection()
+            main_obstacle_detection(frame_source, args.display_width or 1200)
             
     except KeyboardInterrupt:
         print("\nProgram interrupted by user")
     except Exception as e:
         print(f"An error occurred: {e}")
+        status = 1
     finally:
 # -------------------------------------------------------------------------------------------------------
 #                                       SECTION 11: CLEANUP
 # -------------------------------------------------------------------------------------------------------
         print("Cleaning up...")
-        cap.release()
-        cv2.destroyAllWindows()
-        if 'plt' in globals():
+        frame_source.release()
+        print(f"Frames captured: {frame_source.frames_captured}, dropped: {frame_source.frames_dropped}")
+        if flight_recorder:
+            flight_recorder.close()
+            print(f"Recorded {flight_recorder.frames_recorded} frames to {flight_recorder.path}")
+        if metrics_server:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        if command_sender:
+            command_sender.close()
+            print(f"Command packets sent: {command_sender.packets_sent}, "
+                  f"deduplicated: {command_sender.packets_deduplicated}, "
+                  f"rate-limited: {command_sender.packets_rate_limited}, dropped: {command_sender.packets_dropped}")
+        if tracer.enabled:
+            tracer.write_chrome_trace(TRACE_OUTPUT + ".json")
+            tracer.write_csv(TRACE_OUTPUT + ".csv")
+            print(f"Stage trace written to {TRACE_OUTPUT}.json and {TRACE_OUTPUT}.csv")
+        if EXECUTION_MODE != "headless" and not isinstance(frame_source, MultiCameraRunner):
+            cv2.destroyAllWindows()
+        if plt is not None:
             plt.close('all')
-        print("Program ended successfully")
\ No newline at end of file
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())